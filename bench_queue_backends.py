@@ -0,0 +1,69 @@
+'''
+MJP : Throughput benchmark of the queue backends (see queue_backends.py)
+
+Usage:
+$ python3 bench_queue_backends.py [N_MESSAGES] [SQS_QUEUE_URL]
+ - times sending, receiving & deleting N_MESSAGES (default 20000) in batches
+   of 10 (the SQS limit), on the in-memory & sqlite backends
+ - ... and on AWS SQS if a (test!) queue-url is given : every message on
+   that queue will be received & deleted
+
+'''
+
+# Import third-party packages
+# --------------------------------------------------------------
+import sys, os
+import tempfile
+import time
+
+# Import neighboring packages
+# --------------------------------------------------------------
+import queue_backends
+
+
+def benchmark(backend, queue_url, n_messages=20000, batch_size=10):
+    '''
+    Send, then receive, then delete n_messages in batches
+    returns dict of messages-per-second for each of 'send', 'receive' & 'delete'
+    '''
+    entries = [{'Id': str(n), 'MessageBody': f'body{n}',
+                'MessageAttributes': {'trackletID': {'DataType': 'String', 'StringValue': f'trk{n}'}}}
+               for n in range(batch_size)]
+    results = {}
+
+    start = time.perf_counter()
+    for i in range(0, n_messages, batch_size):
+        backend.send_message_batch(QueueUrl=queue_url, Entries=entries[:min(batch_size, n_messages - i)])
+    results['send'] = n_messages / (time.perf_counter() - start)
+
+    start, receipt_handles = time.perf_counter(), []
+    while len(receipt_handles) < n_messages:
+        messages = backend.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=batch_size,
+                                           VisibilityTimeout=600, WaitTimeSeconds=1).get('Messages', [])
+        if not messages:
+            break
+        receipt_handles.extend(m['ReceiptHandle'] for m in messages)
+    results['receive'] = len(receipt_handles) / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(0, len(receipt_handles), batch_size):
+        backend.delete_message_batch(QueueUrl=queue_url,
+                                     Entries=[{'Id': str(n), 'ReceiptHandle': receipt_handle}
+                                              for n, receipt_handle in enumerate(receipt_handles[i:i + batch_size])])
+    results['delete'] = len(receipt_handles) / (time.perf_counter() - start)
+    return results
+
+
+if __name__ == '__main__':
+    n_messages  = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    sqs_url     = sys.argv[2] if len(sys.argv) > 2 else None
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        backends = [('memory', queue_backends.MemoryBackend(), 'bench'),
+                    ('sqlite', queue_backends.SQLiteBackend(os.path.join(tmpdir, 'queues.sqlite')), 'bench')]
+        if sqs_url is not None:
+            backends.append(('sqs', queue_backends.SQSBackend(), sqs_url))
+
+        for name, backend, queue_url in backends:
+            results = benchmark(backend, queue_url, n_messages=n_messages)
+            print(f'{name:8s}' + ''.join(f'{k:>10s}: {v:10.0f} msg/s' for k, v in results.items()))
@@ -0,0 +1,181 @@
+'''
+MJP : Start-up time benchmark of the entry points
+
+Every cgi hit (& every CLI invocation) starts a new python interpreter,
+so the time to import our modules is paid on every single request
+
+Usage:
+$ python3 bench_startup.py [N_REPEATS]
+ - for each entry point, in fresh interpreters (median of N_REPEATS, default 5):
+    import        : time to import its modules (cold, i.e. in a new interpreter)
+    first_request : time from starting the interpreter to having the reply to a first request
+ - ... & which (if any) of the heavy_modules were imported at start-up
+ - exits with status 1 if any entry point is over budget (see budgets)
+
+Entry points:
+ - remote_test.cgi  : the cgi-script (& the modules deploy_client.py copies alongside it), on a test request
+ - deploy_server.py : a test server (as "deploy_server.py T" starts), until it has replied to a request
+ - remote.py        : remote.Remote, making a test request (via a gateway)
+
+'''
+
+# Import third-party packages
+# --------------------------------------------------------------
+import sys, os
+import contextlib
+import json
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+from wsgiref.simple_server import make_server
+
+# Import neighboring packages
+# --------------------------------------------------------------
+import sockets_class as sc
+import remote_gateway
+
+
+# Seconds allowed for the (median) import & first-request times of each entry point
+budgets = { 'remote_test.cgi'   : {'import': 0.15, 'first_request': 0.5},
+            'deploy_server.py'  : {'import': 0.15, 'first_request': 0.5},
+            'remote.py'         : {'import': 0.20, 'first_request': 0.6}}
+
+# Modules that are only to be imported when they are first needed
+heavy_modules = ('numpy', 'requests', 'pytest', 'boto3', 'subprocess', 'urllib.request')
+
+# The modules imported by each entry point
+entry_imports = {   'remote_test.cgi'   : 'import json, remote_general',
+                    'deploy_server.py'  : 'import sockets_class',
+                    'remote.py'         : 'import remote'}
+
+# Where the entry points live
+directory = os.path.dirname(os.path.abspath(__file__))
+
+sample_json = json.dumps({'k': 'v'})
+
+
+@contextlib.contextmanager
+def scratch_directory():
+    '''
+    run the entry points in an empty directory, finding our modules via PYTHONPATH,
+    so that anything they write (e.g. log-files) never lands in the repo
+    yields the keyword-arguments for subprocess
+    '''
+    with tempfile.TemporaryDirectory() as scratch:
+        pythonpath = os.pathsep.join(p for p in [directory, os.environ.get('PYTHONPATH')] if p)
+        yield {'cwd': scratch, 'env': dict(os.environ, PYTHONPATH=pythonpath, MPC_LOG_DIR=scratch)}
+
+
+def time_import(entry_point):
+    ''' (seconds to import the modules of an entry point in a new interpreter, heavy modules imported) '''
+    code = ('import time; _start = time.perf_counter()\n'
+            f'{entry_imports[entry_point]}\n'
+            '_elapsed = time.perf_counter() - _start\n'
+            'import sys, json\n'
+            f'print(json.dumps([_elapsed, [m for m in {heavy_modules!r} if m in sys.modules]]))')
+    with scratch_directory() as kwargs:
+        output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True, **kwargs).stdout
+    elapsed, heavy = json.loads(output.splitlines()[-1])
+    return elapsed, heavy
+
+
+def time_first_request(entry_point, server_port, gateway_url):
+    ''' seconds from starting a new interpreter to having the reply to its first request '''
+    with scratch_directory() as kwargs:
+        return _time_first_request(entry_point, server_port, gateway_url, kwargs)
+
+
+def _time_first_request(entry_point, server_port, gateway_url, kwargs):
+    start = time.perf_counter()
+
+    if entry_point == 'remote_test.cgi':
+        # The cgi-script, pointed at the local server
+        code = ('import sockets_class as sc\n'
+                f'sc.Shared.default_server_host, sc.Shared.default_server_port = "127.0.0.1", {server_port}\n'
+                f'import runpy; runpy.run_path({os.path.join(directory, "remote_test.cgi")!r})')
+        output = subprocess.run([sys.executable, '-c', code], input=sample_json,
+                                capture_output=True, text=True, check=True, **kwargs).stdout
+        reply = json.loads(output.split('\n\n', 1)[1])
+
+    elif entry_point == 'deploy_server.py':
+        # A test server on an ephemeral port : it tells us the port, & we send it a request
+        code = ('import sockets_class as sc\n'
+                'S = sc.Server(host="127.0.0.1", port=0)\n'
+                'S.sock.listen(5)\n'
+                'print(S.sock.getsockname()[1], flush=True)\n'
+                'S._listen()')
+        process = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE, text=True, **kwargs)
+        try:
+            port = int(process.stdout.readline())
+            reply = sc.Client(host='127.0.0.1', port=port).connect({'test': json.loads(sample_json)})
+        finally:
+            process.kill()
+            process.wait()
+            process.stdout.close()
+
+    elif entry_point == 'remote.py':
+        code = f'import remote, json; print(json.dumps(remote.Remote(base_url="{gateway_url}").request_test_json({sample_json!r})))'
+        output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True, **kwargs).stdout
+        reply = json.loads(output.splitlines()[-1])
+
+    elapsed = time.perf_counter() - start
+    assert reply == {'tested': {'test': json.loads(sample_json)}}, f'unexpected reply from {entry_point}: {reply}'
+    return elapsed
+
+
+def benchmark(n_repeats=5):
+    '''
+    Time each entry point n_repeats times (against a local test server & gateway)
+    returns dict of entry-point : {'import': median-seconds, 'first_request': median-seconds, 'heavy_modules': [...]}
+    '''
+    server = sc.Server(host='127.0.0.1', port=0)
+    threading.Thread(target=server._listen, daemon=True).start()
+    server_port = server.sock.getsockname()[1]
+
+    app = remote_gateway.Gateway(host='127.0.0.1', port=server_port)
+    httpd = make_server('127.0.0.1', 0, app, server_class=remote_gateway.ThreadingWSGIServer,
+                        handler_class=remote_gateway.QuietWSGIRequestHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    gateway_url = f'http://127.0.0.1:{httpd.server_port}/cgi-bin/cgipy'
+
+    results = {}
+    try:
+        for entry_point in entry_imports:
+            imports = [time_import(entry_point) for _ in range(n_repeats)]
+            results[entry_point] = {'import'        : statistics.median(elapsed for elapsed, _ in imports),
+                                    'first_request' : statistics.median(time_first_request(entry_point, server_port, gateway_url)
+                                                                        for _ in range(n_repeats)),
+                                    'heavy_modules' : sorted(set(m for _, heavy in imports for m in heavy))}
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        app.pool.close()
+        server.sock.close()
+    return results
+
+
+def over_budget(results):
+    ''' list of the ways in which the benchmark results exceed the budgets (empty if none) '''
+    problems = []
+    for entry_point, result in results.items():
+        for k, budget in budgets[entry_point].items():
+            if result[k] > budget:
+                problems.append(f'{entry_point} {k} took {result[k]:.3f}s (budget {budget:.3f}s)')
+        if result['heavy_modules']:
+            problems.append(f'{entry_point} imports {", ".join(result["heavy_modules"])} at start-up')
+    return problems
+
+
+if __name__ == '__main__':
+    n_repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    results = benchmark(n_repeats=n_repeats)
+    for entry_point, result in results.items():
+        print(f'{entry_point:18s} import: {result["import"]:6.3f}s   first_request: {result["first_request"]:6.3f}s')
+
+    problems = over_budget(results)
+    for problem in problems:
+        print('OVER BUDGET:', problem)
+    sys.exit(1 if problems else 0)
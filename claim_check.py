@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+
+'''
+    --------------------------------------------------------------
+    Claim-check offload of large payloads
+
+    SQS messages (& their attributes) are limited in size, and large
+    socket frames tie up a connection for as long as they take to send.
+    Instead, a payload over a threshold is written (once, compressed)
+    to a blob-store, and only a small content-addressed reference (the
+    "claim-check") is sent through the queue / socket. The receiver
+    fetches the payload from the blob-store when (& if) it needs it.
+
+     - BlobStore  : content-addressed, compressed blobs in a directory
+                    (a local-filesystem stand-in for an object-store, which
+                    can be shared between machines, e.g. over NFS),
+                    with reference-counts so that unused blobs can be
+                    garbage-collected
+     - ClaimCheck : the threshold / offload / resolve / release logic,
+                    with a local (in-memory, LRU) cache of fetched blobs
+
+    Expected usage:
+    ----------------
+    CC  = claim_check.ClaimCheck(claim_check.BlobStore('/shared/mpc_blobs'))
+
+    # Queues : large message bodies are offloaded on send, resolved on demand
+    OES = mpc_sqs.OrbfitExtensionSQS(claim_check=CC)
+    body = OES.resolve_body(record)
+
+    # Sockets : large frames are offloaded by both clients & servers
+    sockets_class.Shared.claim_check = CC
+
+    # Periodically (e.g. from cron) delete blobs that are no longer referenced
+    CC.gc()
+    --------------------------------------------------------------
+'''
+
+
+# Import third-party packages
+# --------------------------------------------------------------
+import collections
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+
+
+class BlobStore():
+    '''
+    Content-addressed store of compressed blobs in a directory
+     - a blob is stored at <root>/<key[:2]>/<key>, where key = sha256 of the (uncompressed) data,
+       so the same data is only ever stored once
+     - writes are atomic (write to a temporary file, then rename)
+     - reference-counts (& last-use times) are kept in <root>/refs.sqlite
+    '''
+
+    default_root                = os.path.join(os.path.expanduser('~'), '.mpc_blobs')
+    default_compression_level   = 6
+
+    def __init__(self, root=None, compression_level=None):
+        self.root               = root if root is not None else self.default_root
+        self.compression_level  = compression_level if compression_level is not None else self.default_compression_level
+        os.makedirs(self.root, exist_ok=True)
+
+        self._lock  = threading.Lock()
+        self._db    = sqlite3.connect(os.path.join(self.root, 'refs.sqlite'), check_same_thread=False, timeout=30)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS blobs (
+                                key         TEXT PRIMARY KEY,
+                                refs        INTEGER,
+                                size        INTEGER,
+                                created     REAL,
+                                last_used   REAL)''')
+        self._db.commit()
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def put(self, data):
+        ''' store data (if not already stored) & add a reference to it : returns the key '''
+        data    = bytes(data)
+        key     = hashlib.sha256(data).hexdigest()
+
+        # Reference first (so that gc() leaves the blob alone), then make sure the blob is there
+        now = time.time()
+        with self._lock:
+            self._db.execute('''INSERT INTO blobs VALUES (?,1,?,?,?)
+                                ON CONFLICT(key) DO UPDATE SET refs=refs+1, last_used=excluded.last_used''',
+                             (key, len(data), now, now))
+            self._db.commit()
+
+        path = self._path(key)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write(zlib.compress(data, self.compression_level))
+            os.replace(tmp_path, path)
+        return key
+
+    def get(self, key):
+        ''' the data stored under key : raises KeyError if there is none (or it is corrupt) '''
+        try:
+            with open(self._path(key), 'rb') as fh:
+                data = zlib.decompress(fh.read())
+        except (OSError, zlib.error) as e:
+            raise KeyError(f'No blob {key}: {e}')
+        if hashlib.sha256(data).hexdigest() != key:
+            raise KeyError(f'Blob {key} is corrupt')
+        return data
+
+    def retain(self, key):
+        ''' add a reference to an existing blob '''
+        self._change_refs(key, +1)
+
+    def release(self, key):
+        ''' remove a reference : the blob can be garbage-collected once it has none '''
+        self._change_refs(key, -1)
+
+    def _change_refs(self, key, change):
+        with self._lock:
+            self._db.execute('UPDATE blobs SET refs=MAX(0, refs+?), last_used=? WHERE key=?', (change, time.time(), key))
+            self._db.commit()
+
+    def refs(self, key):
+        with self._lock:
+            row = self._db.execute('SELECT refs FROM blobs WHERE key=?', (key,)).fetchone()
+        return row[0] if row is not None else 0
+
+    def gc(self, grace=3600, max_age=14 * 24 * 3600):
+        '''
+        delete blobs that are no longer referenced
+         - grace   : only once they have been unreferenced (/unused) for this many seconds,
+                     so that we cannot race with a put() of the same data
+         - max_age : blobs that have not been used (put, retained or released) for this many
+                     seconds are deleted whatever their reference-count, as their references have
+                     been lost (e.g. SQS deletes messages after 14 days)
+        returns the number of blobs deleted
+        '''
+        now = time.time()
+        with self._lock:
+            keys = [row[0] for row in self._db.execute('SELECT key FROM blobs WHERE (refs<=0 AND last_used<?) OR last_used<?',
+                                                       (now - grace, now - max_age))]
+            for key in keys:
+                try:
+                    os.remove(self._path(key))
+                except FileNotFoundError:
+                    pass
+            self._db.executemany('DELETE FROM blobs WHERE key=?', [(key,) for key in keys])
+            self._db.commit()
+        return len(keys)
+
+    def close(self,):
+        self._db.close()
+
+
+class ClaimCheck():
+    '''
+    Offload payloads over "threshold" bytes to a BlobStore, passing on a reference instead
+
+    store       : BlobStore
+    threshold   : payloads of (at least) this many bytes are offloaded
+    cache_bytes : max size of the local cache of fetched blobs
+    '''
+
+    default_threshold   = 64 * 1024
+    default_cache_bytes = 64 * 1024 * 1024
+
+    # References in text (e.g. an SQS message body) are "claim-check:<key>"
+    prefix = 'claim-check:'
+
+    def __init__(self, store=None, threshold=None, cache_bytes=None):
+        self.store          = store if store is not None else BlobStore()
+        self.threshold      = threshold if threshold is not None else self.default_threshold
+        self.cache_bytes    = cache_bytes if cache_bytes is not None else self.default_cache_bytes
+        self._cache         = collections.OrderedDict()
+        self._cached_bytes  = 0
+        self._lock          = threading.Lock()
+
+    # ----- bytes (e.g. socket frames) ---------------------------------
+    def put(self, data):
+        ''' store data : returns its key '''
+        return self.store.put(data)
+
+    def fetch(self, key):
+        ''' the data for a key, from the local cache if possible '''
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        data = self.store.get(key)
+        if len(data) <= self.cache_bytes:
+            with self._lock:
+                if key not in self._cache:
+                    self._cache[key] = data
+                    self._cached_bytes += len(data)
+                while self._cached_bytes > self.cache_bytes:
+                    _, evicted = self._cache.popitem(last=False)
+                    self._cached_bytes -= len(evicted)
+        return data
+
+    def release(self, key):
+        ''' the reference has been dealt with (e.g. the message carrying it was deleted) '''
+        self.store.release(key)
+
+    # ----- text (e.g. queue message bodies) ---------------------------------
+    def is_reference(self, text):
+        return isinstance(text, str) and text.startswith(self.prefix)
+
+    def offload(self, text):
+        '''
+        returns text unchanged if it is small, else a reference to it
+         - if text is already a reference (e.g. a message being forwarded to
+           another queue), the blob gets another reference
+        '''
+        if self.is_reference(text):
+            self.store.retain(text[len(self.prefix):])
+            return text
+        data = text.encode()
+        if len(data) < self.threshold:
+            return text
+        return self.prefix + self.put(data)
+
+    def resolve(self, text):
+        ''' the original text, fetching it if text is a reference '''
+        if self.is_reference(text):
+            return self.fetch(text[len(self.prefix):]).decode()
+        return text
+
+    def release_reference(self, text):
+        ''' release the blob that text refers to (if it is a reference) '''
+        if self.is_reference(text):
+            self.release(text[len(self.prefix):])
+
+    def gc(self, **kwargs):
+        ''' garbage-collect unreferenced blobs (see BlobStore.gc) '''
+        return self.store.gc(**kwargs)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+'''
+    --------------------------------------------------------------
+    Content-Encoding support for the http bodies passed between
+    remote.Remote and the gateway (remote_gateway.py)
+
+    Orbfit payloads (lots of repeated keys and 'None' strings) compress
+    very well, so compressing them saves a lot of transfer time over
+    the public link.
+
+    Supported encodings (both from the standard library):
+     - "deflate" : zlib at a low compression level : fast, the default
+     - "gzip"    : better compression, slower
+    --------------------------------------------------------------
+'''
+
+
+# Import third-party packages
+# --------------------------------------------------------------
+import zlib
+
+
+# Encodings : name -> (compression-level, zlib wbits)
+encodings = {
+    'deflate'   : (1, zlib.MAX_WBITS),
+    'gzip'      : (6, zlib.MAX_WBITS | 16),
+}
+
+# Order of preference when the caller accepts several encodings
+preferred_encodings = ('deflate', 'gzip')
+
+# Bodies smaller than this are not worth compressing
+min_compress_bytes = 1024
+
+
+def compress(data, encoding):
+    ''' compress bytes with the given encoding '''
+    level, wbits = encodings[encoding]
+    compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+    return compressor.compress(data) + compressor.flush()
+
+def decompress(data, encoding):
+    ''' decompress bytes with the given encoding '''
+    return zlib.decompress(data, encodings[encoding][1])
+
+def decompressor(encoding):
+    ''' streaming decompressor (call .decompress(chunk) on each chunk, then .flush()) '''
+    return zlib.decompressobj(encodings[encoding][1])
+
+def is_supported(encoding):
+    ''' None or "identity" mean no compression '''
+    return encoding in (None, '', 'identity') or encoding in encodings
+
+def choose_encoding(accept_encoding):
+    '''
+    choose an encoding for a response, given the value of the
+    Accept-Encoding header from the request (None if no compression)
+    '''
+    accepted = {}
+    for item in (accept_encoding or '').split(','):
+        parts = item.strip().split(';')
+        name, q = parts[0].strip().lower(), 1.0
+        for param in parts[1:]:
+            param = param.strip()
+            if param.startswith('q='):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        if name:
+            accepted[name] = q
+
+    for encoding in preferred_encodings:
+        if accepted.get(encoding, accepted.get('*', 0.0)) > 0:
+            return encoding
+    return None
+
+
+class CompressingIterable():
+    '''
+    Compresses the chunks of an iterable of bytes (e.g. a WSGI response)
+    as they are produced, passing close() on to the underlying iterable
+    '''
+
+    def __init__(self, iterable, encoding):
+        self.iterable   = iterable
+        level, wbits    = encodings[encoding]
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+    def __iter__(self,):
+        for chunk in self.iterable:
+            compressed = self.compressor.compress(chunk)
+            if compressed:
+                yield compressed
+        yield self.compressor.flush()
+
+    def close(self,):
+        if hasattr(self.iterable, 'close'):
+            self.iterable.close()
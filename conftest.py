@@ -0,0 +1,17 @@
+# Import third-party packages
+# --------------------------------------------------------------
+import sys, os
+import pytest
+
+# Import neighboring packages
+# ---------------------------------------------------------------
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+import mpc_logging
+
+
+@pytest.fixture(autouse=True, scope='session')
+def log_dir(tmp_path_factory):
+    ''' Keep the log-files written during the tests out of the working directory '''
+    mpc_logging.configure(str(tmp_path_factory.mktemp('logs')))
+    yield
+    mpc_logging.configure(None)
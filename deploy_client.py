@@ -30,7 +30,9 @@ for script in [ "remote_test.cgi",
                 "remote_checker.cgi",
                 "remote_general.py",
                 "sockets_class.py",
-                "sample_data.py"]:
+                "mpc_logging.py",
+                "tracing.py",
+                "request_policies.py"]:
     # copy the script over
     command = "sudo cp %s /var/www/cgi-bin/cgipy" % script
     print("\t", command)
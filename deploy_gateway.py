@@ -0,0 +1,29 @@
+'''
+MJP : Dirt-simple script to help me deploy on machines ...
+
+Usage:
+$ python3 deploy_gateway.py [GATEWAY_PORT] [SERVER_HOST] [SERVER_PORT]
+ - deploy on public-facing web-server, e.g. "mpcweb1"
+ - persistent alternative to copying the remote_*.cgi scripts over (see deploy_client.py)
+
+'''
+
+# Import third-party packages
+# --------------------------------------------------------------
+import sys, os
+
+# Import neighboring packages
+# --------------------------------------------------------------
+import remote_gateway
+
+
+
+# This is for the web-server (e.g. mpcweb1) ...
+#  - The gateway listens for incoming http requests and passes the data
+#    onto a server that is listening on marsden/docker/...
+#    using a pool of persistent connections
+gateway_port    = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+server_host     = sys.argv[2] if len(sys.argv) > 2 else None
+server_port     = int(sys.argv[3]) if len(sys.argv) > 3 else None
+
+remote_gateway.serve(port=gateway_port, server_host=server_host, server_port=server_port)
@@ -5,6 +5,11 @@ Usage:
 $ python3 deploy_server.py W
  - deply on internal computation machine, e.g. "marsden" or "docker"s
 
+$ python3 deploy_server.py S [setting=value ...]
+ - synthetic-workload server for load-testing, e.g.
+   python3 deploy_server.py S cpu_seconds=0.05 latency_distribution=lognormal latency_mean=0.2 failure_rate=0.01
+ - see sockets_class.SyntheticServer for the settings
+
 '''
 
 # Import third-party packages
@@ -32,6 +37,14 @@ elif sys.argv[1] == "E":
 elif sys.argv[1] == "I":
     TS = sc.OrbfitIODServer()
 
+# Launch a synthetic-workload server ...
+elif sys.argv[1] == "S":
+    settings = dict(arg.split('=', 1) for arg in sys.argv[2:])
+    for k in settings:
+        if k not in ('latency_distribution', 'failure_mode'):
+            settings[k] = int(settings[k]) if k in ('port', 'response_bytes', 'seed') else float(settings[k])
+    TS = sc.SyntheticServer(**settings)
+
 # don't know what's wanted
 else:
     print(f"should not be able to see this error: sys.argv[1]={sys.argv[1]}")
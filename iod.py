@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+
+'''
+    --------------------------------------------------------------
+    Vectorised initial orbit determination (IOD)
+
+    Gauss's method, run on whole batches of tracklets at once with numpy
+    (there is no python-level loop over tracklets in the numerical work):
+
+     - three observations are chosen from each obslist (the first, the
+       last, & the one closest to the middle of the arc)
+     - the Gauss 8th-order polynomial in r2 is solved for every tracklet
+       at once (as the eigenvalues of a stack of companion matrices), and
+       every positive real root gives a candidate orbit
+     - each candidate is refined iteratively (Curtis, "Orbital Mechanics
+       for Engineering Students", algorithm 5.6) using exact Lagrange f & g
+       coefficients from a (vectorised) universal-variable Kepler solver,
+       with light-time correction
+     - candidates are ranked by the rms of their residuals against all of
+       the tracklet's observations
+
+    Approximations (adequate for IOD, which is then improved by a full fit)
+     - the observer is at the geocentre (no topocentric parallax)
+     - the Earth's position is from an analytic (Keplerian) ephemeris of
+       the Earth-Moon barycentre (JPL "approximate positions", 1800-2050)
+     - TT - UTC is taken to be its current value, 69.184s
+     - two-body motion about the Sun
+
+    Orbits are returned as eq0dicts (see testdict.json & orbit_state.py) :
+    heliocentric, ecliptic J2000, epoch (MJD TDT) at the light-time-corrected
+    middle observation, with CAR & COM sections (plus EQU & KEP for bound orbits)
+
+    Expected usage:
+    ----------------
+    results = iod.GaussIOD().fit({'trk1': {'obslist': [obs, obs, obs, ...]}, ...})
+    results['trk1']['eq0dict'], results['trk1']['candidates']
+    --------------------------------------------------------------
+'''
+
+
+# Import third-party packages
+# --------------------------------------------------------------
+import numpy as np
+
+# Import neighboring packages
+# --------------------------------------------------------------
+import orbit_state
+
+
+# Constants (au, days)
+# --------------------------------------------------------------
+gm_sun          = 0.01720209895 ** 2
+speed_of_light  = 173.1446326846693
+obliquity       = np.radians(84381.448 / 3600)
+tt_minus_utc    = 69.184 / 86400
+mjd_j2000       = 51544.5
+arcsec          = np.radians(1 / 3600)
+
+
+class GaussIOD():
+    '''
+    Initial orbit determination for batches of tracklets
+
+    max_candidates   : max number of candidate orbits returned per tracklet
+    max_eccentricity : candidates more eccentric than this are rejected
+    max_iterations   : max number of refinement iterations
+    tolerance        : refinement stops when no topocentric distance changes by more than this (au)
+    '''
+
+    default_max_candidates      = 3
+    default_max_eccentricity    = 1.5
+    default_max_iterations      = 500
+    default_tolerance           = 1e-8
+
+    def __init__(self, max_candidates=None, max_eccentricity=None, max_iterations=None, tolerance=None):
+        self.max_candidates     = max_candidates if max_candidates is not None else self.default_max_candidates
+        self.max_eccentricity   = max_eccentricity if max_eccentricity is not None else self.default_max_eccentricity
+        self.max_iterations     = max_iterations if max_iterations is not None else self.default_max_iterations
+        self.tolerance          = tolerance if tolerance is not None else self.default_tolerance
+
+    def fit(self, data):
+        '''
+        inputs
+        -------
+        data : dict of {key : {'obslist': [obs-dict, ...]}}
+         - each obs-dict needs (at least) 'obstime' (ISO-8601 UTC), 'ra' & 'dec' (deg, J2000)
+
+        returns
+        -------
+        dict of {key : {'eq0dict'    : the best candidate orbit ({} if there is none),
+                        'candidates' : [{'eq0dict': ..., 'rms_arcsec': ...}, ...] (best first)}}
+         - with an 'exception' if the tracklet could not be used
+        '''
+        keys        = list(data)
+        results     = {key: {'eq0dict': {}, 'candidates': []} for key in keys}
+        t, ra, dec  = _observation_arrays([data[key]['obslist'] for key in keys])
+
+        # Tracklets we can use : at least three observations at different times
+        n_obs   = np.sum(np.isfinite(t), axis=1)
+        arc     = np.nanmax(t, axis=1, initial=-np.inf) - np.nanmin(t, axis=1, initial=np.inf)
+        usable  = (n_obs >= 3) & (arc > 0)
+        for i in np.nonzero(~usable)[0]:
+            results[keys[i]]['exception'] = 'IOD needs at least three observations at different times'
+        if not np.any(usable):
+            return results
+        index       = np.nonzero(usable)[0]
+        t, ra, dec  = t[index], ra[index], dec[index]
+
+        # Geometry of every observation : observer position & line-of-sight (ecliptic)
+        R = earth_position(t)
+        L = line_of_sight(ra, dec)
+
+        # Gauss on three observations per tracklet, then rank by all of the observations
+        tracklet, r2, v2, epoch = self._solve(*_select_three(t, R, L))
+        rms                     = self._residuals(tracklet, r2, v2, epoch, t, R, L)
+
+        # Reject unphysical / non-converged candidates, then sort each tracklet's by rms
+        elements    = cartesian_to_elements(r2, v2, epoch)
+        good        = np.isfinite(rms) & (elements['e'] < self.max_eccentricity)
+        order       = np.lexsort((rms, tracklet))
+        order       = order[good[order]]
+        for m in order:
+            candidates = results[keys[index[tracklet[m]]]]['candidates']
+            if len(candidates) < self.max_candidates:
+                candidates.append({ 'eq0dict'       : _eq0dict(keys[index[tracklet[m]]], {k: v[m] for k, v in elements.items()}),
+                                    'rms_arcsec'    : float(rms[m] / arcsec)})
+        for key in keys:
+            if results[key]['candidates']:
+                results[key]['eq0dict'] = results[key]['candidates'][0]['eq0dict']
+            elif 'exception' not in results[key]:
+                results[key]['exception'] = 'No orbit found'
+        return results
+
+    # ----- Gauss's method ---------------------------------
+    def _solve(self, t, R, L):
+        '''
+        t (N,3), R (N,3,3), L (N,3,3) : times, observer positions & lines-of-sight of three observations
+        returns (tracklet-index, r2, v2, epoch) of every candidate (M,), (M,3), (M,3), (M,)
+        '''
+        tau1, tau3  = t[:, 0] - t[:, 1], t[:, 2] - t[:, 1]
+        tau         = tau3 - tau1
+        P           = np.stack([np.cross(L[:, 1], L[:, 2]), np.cross(L[:, 0], L[:, 2]), np.cross(L[:, 0], L[:, 1])], axis=1)
+        D0          = np.einsum('nk,nk->n', L[:, 0], P[:, 0])
+        D           = np.einsum('nik,njk->nij', R, P)         # D[n,i,j] = R_i . p_j
+
+        # The 8th-order polynomial r^8 + a r^6 + b r^3 + c = 0 ...
+        A   = (-D[:, 0, 1] * tau3 / tau + D[:, 1, 1] + D[:, 2, 1] * tau1 / tau) / D0
+        B   = (D[:, 0, 1] * (tau3**2 - tau**2) * tau3 / tau + D[:, 2, 1] * (tau**2 - tau1**2) * tau1 / tau) / (6 * D0)
+        E   = np.einsum('nk,nk->n', R[:, 1], L[:, 1])
+        a   = -(A**2 + 2 * A * E + np.einsum('nk,nk->n', R[:, 1], R[:, 1]))
+        b   = -2 * gm_sun * B * (A + E)
+        c   = -gm_sun**2 * B**2
+
+        # ... whose roots are the eigenvalues of its companion matrix
+        companion           = np.zeros((len(t), 8, 8))
+        companion[:, 0, 1]  = -a
+        companion[:, 0, 4]  = -b
+        companion[:, 0, 7]  = -c
+        companion[:, np.arange(1, 8), np.arange(7)] = 1
+        with np.errstate(all='ignore'):
+            roots = np.linalg.eigvals(companion)
+        real = (np.abs(roots.imag) <= 1e-8 * np.abs(roots)) & (roots.real > 0)
+
+        # Every positive real root is a candidate
+        tracklet, _ = np.nonzero(real)
+        r2          = roots.real[real]
+        t, R, L, D, D0, tau1, tau3 = t[tracklet], R[tracklet], L[tracklet], D[tracklet], D0[tracklet], tau1[tracklet], tau3[tracklet]
+
+        # First approximation : f & g series truncated after the mu/r^3 term
+        u       = gm_sun / r2**3
+        f1, g1  = 1 - u * tau1**2 / 2, tau1 - u * tau1**3 / 6
+        f3, g3  = 1 - u * tau3**2 / 2, tau3 - u * tau3**3 / 6
+        rho, r, v2 = _positions(f1, g1, f3, g3, D, D0, R, L)
+
+        # Refine with exact f & g, & light-time corrected times
+        #  - only the candidates that have not yet converged are iterated on
+        active = np.arange(len(r2))
+        with np.errstate(all='ignore'):
+            for _ in range(self.max_iterations):
+                tc          = t[active] - rho[active] / speed_of_light
+                tau1, tau3  = tc[:, 0] - tc[:, 1], tc[:, 2] - tc[:, 1]
+                r2n         = np.linalg.norm(r[active, 1], axis=1)
+                alpha       = 2 / r2n - np.einsum('nk,nk->n', v2[active], v2[active]) / gm_sun
+                vr2         = np.einsum('nk,nk->n', r[active, 1], v2[active]) / r2n
+                f1, g1      = _lagrange_fg(tau1, r2n, vr2, alpha)
+                f3, g3      = _lagrange_fg(tau3, r2n, vr2, alpha)
+                new_rho, r[active], v2[active] = _positions(f1, g1, f3, g3, D[active], D0[active], R[active], L[active])
+                changing    = np.any(np.abs(new_rho - rho[active]) > self.tolerance, axis=1) & np.all(np.isfinite(new_rho), axis=1)
+                rho[active] = new_rho
+                active      = active[changing]
+                if not len(active):
+                    break
+
+            # Only candidates in front of the observer, that have converged
+            converged           = np.ones(len(r2), dtype=bool)
+            converged[active]   = False
+            ok = converged & np.all(rho > 0, axis=1) & np.all(np.isfinite(v2), axis=1)
+        epoch = t[:, 1] - rho[:, 1] / speed_of_light
+        return tracklet[ok], r[ok, 1], v2[ok], epoch[ok]
+
+    def _residuals(self, tracklet, r2, v2, epoch, t, R, L):
+        ''' rms angular residual (radians) of each candidate against all of the observations of its tracklet '''
+        t, R, L     = t[tracklet], R[tracklet], L[tracklet]
+        valid       = np.isfinite(t)
+        shape       = t.shape
+        r0, v0      = np.repeat(r2, shape[1], axis=0), np.repeat(v2, shape[1], axis=0)
+        dt          = np.where(valid, t - epoch[:, None], 0).ravel()
+
+        with np.errstate(all='ignore'):
+            # Propagate to the observation times (twice, to correct for light-time)
+            position = propagate(r0, v0, dt)
+            for _ in range(2):
+                rho      = np.linalg.norm(position - R.reshape(-1, 3), axis=1)
+                position = propagate(r0, v0, dt - rho / speed_of_light)
+            predicted   = position - R.reshape(-1, 3)
+            predicted  /= np.linalg.norm(predicted, axis=1)[:, None]
+            cos         = np.clip(np.einsum('nk,nk->n', predicted, L.reshape(-1, 3)), -1, 1)
+            residual    = np.where(valid, np.arccos(cos).reshape(shape), 0)
+            return np.sqrt(np.sum(residual**2, axis=1) / np.sum(valid, axis=1))
+
+
+# ----- geometry ---------------------------------
+def earth_position(mjd_tt):
+    '''
+    heliocentric ecliptic J2000 position (au) of the Earth(-Moon barycentre) at the given times (MJD TT)
+     - Keplerian elements & rates from Standish, "Keplerian Elements for Approximate Positions of the Major Planets"
+    '''
+    T           = (np.asarray(mjd_tt, dtype=np.float64) - mjd_j2000) / 36525
+    a           = 1.00000261 + 0.00000562 * T
+    e           = 0.01671123 - 0.00004392 * T
+    inc         = np.radians(-0.00001531 - 0.01294668 * T)
+    mean_long   = 100.46457166 + 35999.37244981 * T
+    long_peri   = 102.93768193 + 0.32327364 * T
+    M           = np.radians((mean_long - long_peri + 180) % 360 - 180)
+
+    # Solve Kepler's equation (Newton's method converges in a few steps for e ~ 0.017)
+    E = M + e * np.sin(M)
+    for _ in range(5):
+        E -= (E - e * np.sin(E) - M) / (1 - e * np.cos(E))
+    x, y = a * (np.cos(E) - e), a * np.sqrt(1 - e**2) * np.sin(E)
+
+    # Rotate from the orbital plane (the node is fixed at zero longitude)
+    w = np.radians(long_peri)
+    xw, yw = x * np.cos(w) - y * np.sin(w), x * np.sin(w) + y * np.cos(w)
+    return np.stack([xw, yw * np.cos(inc), yw * np.sin(inc)], axis=-1)
+
+
+def line_of_sight(ra, dec):
+    ''' ecliptic J2000 unit vectors from (equatorial J2000) ra & dec (deg) '''
+    ra, dec = np.radians(ra), np.radians(dec)
+    x, y, z = np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)
+    ce, se  = np.cos(obliquity), np.sin(obliquity)
+    return np.stack([x, ce * y + se * z, -se * y + ce * z], axis=-1)
+
+
+def radec(vectors):
+    ''' inverse of line_of_sight : (equatorial J2000) ra & dec (deg) of ecliptic vectors '''
+    x, y, z = np.moveaxis(np.asarray(vectors), -1, 0)
+    ce, se  = np.cos(obliquity), np.sin(obliquity)
+    y, z    = ce * y - se * z, se * y + ce * z
+    return np.degrees(np.arctan2(y, x)) % 360, np.degrees(np.arctan2(z, np.hypot(x, y)))
+
+
+# ----- two-body motion ---------------------------------
+def _stumpff(z):
+    ''' Stumpff functions C(z) & S(z) '''
+    C, S            = np.empty_like(z), np.empty_like(z)
+    pos, neg        = z > 1e-6, z < -1e-6
+    small           = ~(pos | neg)
+    sz              = np.sqrt(z[pos])
+    C[pos], S[pos]  = (1 - np.cos(sz)) / z[pos], (sz - np.sin(sz)) / sz**3
+    sz              = np.sqrt(-z[neg])
+    C[neg], S[neg]  = (np.cosh(sz) - 1) / -z[neg], (np.sinh(sz) - sz) / sz**3
+    zs              = z[small]
+    C[small]        = 1 / 2 - zs / 24 + zs**2 / 720
+    S[small]        = 1 / 6 - zs / 120 + zs**2 / 5040
+    return C, S
+
+
+def _universal_anomaly(dt, r0, vr0, alpha, max_iterations=50, tolerance=1e-13):
+    ''' solve the universal Kepler equation for the universal anomaly (Newton's method, on all that have not converged) '''
+    sqrt_mu = np.sqrt(gm_sun)
+    chi     = sqrt_mu * np.abs(alpha) * dt
+    active  = np.arange(len(chi))
+    for _ in range(max_iterations):
+        x, r, vr, a = chi[active], r0[active], vr0[active], alpha[active]
+        z           = a * x**2
+        C, S        = _stumpff(z)
+        F           = r * vr / sqrt_mu * x**2 * C + (1 - a * r) * x**3 * S + r * x - sqrt_mu * dt[active]
+        dF          = r * vr / sqrt_mu * x * (1 - z * S) + (1 - a * r) * x**2 * C + r
+        step        = F / dF
+        chi[active] = x - step
+        active      = active[np.abs(step) > tolerance * np.maximum(1, np.abs(x))]
+        if not len(active):
+            break
+    return chi
+
+
+def _lagrange_fg(dt, r0, vr0, alpha):
+    ''' Lagrange f & g coefficients for a time-step dt from a state with |r| = r0 & radial velocity vr0 '''
+    chi     = _universal_anomaly(dt, r0, vr0, alpha)
+    C, S    = _stumpff(alpha * chi**2)
+    return 1 - chi**2 / r0 * C, dt - chi**3 * S / np.sqrt(gm_sun)
+
+
+def propagate(r0, v0, dt):
+    ''' two-body positions after time-steps dt (days) from states r0 (N,3) & v0 (N,3) '''
+    rn      = np.linalg.norm(r0, axis=1)
+    alpha   = 2 / rn - np.einsum('nk,nk->n', v0, v0) / gm_sun
+    vr      = np.einsum('nk,nk->n', r0, v0) / rn
+    f, g    = _lagrange_fg(dt, rn, vr, alpha)
+    return f[:, None] * r0 + g[:, None] * v0
+
+
+def _positions(f1, g1, f3, g3, D, D0, R, L):
+    ''' topocentric distances (M,3), heliocentric positions (M,3,3) & middle velocity (M,3) from f & g '''
+    det     = f1 * g3 - f3 * g1
+    c1, c3  = g3 / det, -g1 / det
+    rho     = np.stack([(-D[:, 0, 0] + D[:, 1, 0] / c1 - D[:, 2, 0] * c3 / c1) / D0,
+                        (-c1 * D[:, 0, 1] + D[:, 1, 1] - c3 * D[:, 2, 1]) / D0,
+                        (-D[:, 0, 2] * c1 / c3 + D[:, 1, 2] / c3 - D[:, 2, 2]) / D0], axis=1)
+    r       = R + rho[:, :, None] * L
+    v2      = (-f3[:, None] * r[:, 0] + f1[:, None] * r[:, 2]) / det[:, None]
+    return rho, r, v2
+
+
+def cartesian_to_elements(r, v, epoch):
+    '''
+    orbital elements (arrays, angles in degrees) of heliocentric states r (N,3) & v (N,3) at epoch (N,) MJD
+    returns dict of 'r', 'v', 'epoch', 'a', 'e', 'i', 'node', 'peri', 'M', 'q', 'tp'
+    '''
+    with np.errstate(all='ignore'):
+        rn      = np.linalg.norm(r, axis=1)
+        h       = np.cross(r, v)
+        hn      = np.linalg.norm(h, axis=1)
+        e_vec   = ((np.einsum('nk,nk->n', v, v) - gm_sun / rn)[:, None] * r - np.einsum('nk,nk->n', r, v)[:, None] * v) / gm_sun
+        e       = np.linalg.norm(e_vec, axis=1)
+        a       = 1 / (2 / rn - np.einsum('nk,nk->n', v, v) / gm_sun)
+        inc     = np.arccos(np.clip(h[:, 2] / hn, -1, 1))
+        node    = np.arctan2(h[:, 0], -h[:, 1])
+
+        # argument of perihelion, measured from the node in the orbital plane
+        n_hat   = np.stack([np.cos(node), np.sin(node), np.zeros_like(node)], axis=1)
+        m_hat   = np.cross(h / hn[:, None], n_hat)
+        peri    = np.arctan2(np.einsum('nk,nk->n', e_vec, m_hat), np.einsum('nk,nk->n', e_vec, n_hat))
+
+        # true anomaly -> mean anomaly & time of perihelion
+        vr      = np.einsum('nk,nk->n', r, v) / rn
+        nu      = np.arctan2(hn * vr / gm_sun, hn**2 / (gm_sun * rn) - 1)
+        bound   = e < 1
+        E       = 2 * np.arctan2(np.sqrt(np.abs(1 - e)) * np.sin(nu / 2), np.sqrt(1 + e) * np.cos(nu / 2))
+        F       = 2 * np.arctanh(np.sqrt(np.abs((e - 1) / (e + 1))) * np.tan(nu / 2))
+        M       = np.where(bound, E - e * np.sin(E), e * np.sinh(F) - F)
+        tp      = epoch - M / np.sqrt(gm_sun / np.abs(a)**3)
+
+    return {'r'     : r,
+            'v'     : v,
+            'epoch' : epoch,
+            'a'     : a,
+            'e'     : e,
+            'i'     : np.degrees(inc),
+            'node'  : np.degrees(node) % 360,
+            'peri'  : np.degrees(peri) % 360,
+            'M'     : np.degrees(M) % 360,
+            'q'     : hn**2 / (gm_sun * (1 + e)),
+            'tp'    : tp}
+
+
+# ----- input & output ---------------------------------
+def _observation_arrays(obslists):
+    '''
+    padded (N, max-obs) arrays of time (MJD TT), ra & dec (deg) from a list of obslists
+     - missing values (padding, or unusable observations) are nan
+    '''
+    shape       = (len(obslists), max([len(obslist) for obslist in obslists], default=0))
+    t, ra, dec  = np.full(shape, np.nan), np.full(shape, np.nan), np.full(shape, np.nan)
+    for n, obslist in enumerate(obslists):
+        for k, obs in enumerate(obslist):
+            try:
+                ra[n, k], dec[n, k] = float(obs['ra']), float(obs['dec'])
+                t[n, k]             = _mjd_utc(obs['obstime'])
+            except (KeyError, TypeError, ValueError):
+                t[n, k] = ra[n, k] = dec[n, k] = np.nan
+    return t + tt_minus_utc, ra, dec
+
+
+def _mjd_utc(obstime):
+    ''' MJD (UTC) from an ISO-8601 time-string, e.g. 2011-08-31T09:45:36Z '''
+    return (np.datetime64(obstime.rstrip('Z'), 'us') - np.datetime64('1858-11-17T00:00:00', 'us')) / np.timedelta64(86400, 's')
+
+
+def _select_three(t, R, L):
+    ''' the first, last & closest-to-the-middle (in time) observations of each tracklet '''
+    rows        = np.arange(len(t))[:, None]
+    first       = np.nanargmin(t, axis=1)
+    last        = np.nanargmax(t, axis=1)
+    middle      = (t[rows[:, 0], first] + t[rows[:, 0], last]) / 2
+    distance    = np.abs(t - middle[:, None])
+    distance[~np.isfinite(distance)] = np.inf
+    distance[rows[:, 0], first] = distance[rows[:, 0], last] = np.inf
+    chosen      = np.stack([first, np.argmin(distance, axis=1), last], axis=1)
+    return t[rows, chosen], R[rows, chosen], L[rows, chosen]
+
+
+def _eq0dict(name, elements):
+    ''' eq0dict (dict of strings, see orbit_state.py) for one candidate '''
+    def section(coordtype, values):
+        return orbit_state.CoordinateState(elements=values, epoch=elements['epoch'],
+                                           extra={'coordtype': coordtype, 'timesystem': 'TDT', 'numparams': '6',
+                                                  'nongrav_model': '0', 'nongrav_params': '0'})
+    sections = {'CAR': section('CAR', np.concatenate([elements['r'], elements['v']])),
+                'COM': section('COM', [elements['q'], elements['e'], elements['i'], elements['node'], elements['peri'], elements['tp']])}
+    if elements['e'] < 1:
+        tan_half_i  = np.tan(np.radians(elements['i']) / 2)
+        long_peri   = np.radians(elements['node'] + elements['peri'])
+        node        = np.radians(elements['node'])
+        sections['KEP'] = section('KEP', [elements['a'], elements['e'], elements['i'], elements['node'], elements['peri'], elements['M']])
+        sections['EQU'] = section('EQU', [elements['a'], elements['e'] * np.sin(long_peri), elements['e'] * np.cos(long_peri),
+                                          tan_half_i * np.sin(node), tan_half_i * np.cos(node),
+                                          (elements['node'] + elements['peri'] + elements['M']) % 360])
+    header  = {'eph': 'analytic', 'format': "'OEF2.0'", 'name': name, 'rectype': "'IOD'", 'refsys': 'ECLM J2000'}
+    empty   = [coordtype for coordtype in orbit_state.coordtypes if coordtype not in sections]
+    return orbit_state.OrbitState(sections=sections, header=header, empty_sections=empty).to_dict()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+'''
+    --------------------------------------------------------------
+    Incremental parsing of large json objects
+
+    Replies from the orbit-fitting service are json objects of the form
+    {designation: result, designation: result, ...}, which can be very
+    large for multi-designation requests.
+
+    iter_object_items parses such an object from an iterable of chunks of
+    bytes (e.g. from an http response or a socket) and yields each
+    (designation, result) pair as soon as it has been received, so only
+    one designation's worth of data needs to be held at any one time.
+    --------------------------------------------------------------
+'''
+
+
+# Import third-party packages
+# --------------------------------------------------------------
+import codecs
+import json
+
+_whitespace = ' \t\n\r'
+_delimiters = _whitespace + ',:}]'
+_decoder    = json.JSONDecoder()
+
+
+class _Buffer():
+    '''
+    Text decoded from a stream of byte-chunks, of which only the
+    not-yet-parsed part is kept
+    '''
+
+    def __init__(self, chunks):
+        self.chunks     = iter(chunks)
+        self.decoder    = codecs.getincrementaldecoder('utf-8')()
+        self.text       = ''
+        self.pos        = 0
+        self.exhausted  = False
+
+    def more(self, min_new=1):
+        '''
+        read at least min_new more characters (if available)
+         - discards the text before self.pos
+         - returns False if the stream is exhausted without reading anything
+        '''
+        self.text, self.pos = self.text[self.pos:], 0
+        pieces, n_new = [self.text], 0
+        while n_new < min_new and not self.exhausted:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                self.exhausted = True
+                piece = self.decoder.decode(b'', final=True)
+            else:
+                piece = self.decoder.decode(chunk)
+            pieces.append(piece)
+            n_new += len(piece)
+        self.text = ''.join(pieces)
+        return n_new > 0
+
+    def next_char(self,):
+        ''' skip whitespace & return the next character (None at the end of the stream) '''
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in _whitespace:
+                self.pos += 1
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self.more():
+                return None
+
+    def expect(self, allowed):
+        ''' consume the next (non-whitespace) character, which must be one of "allowed" '''
+        char = self.next_char()
+        if char is None or char not in allowed:
+            raise ValueError(f'Expected one of {allowed!r} in json stream, found {char!r}')
+        self.pos += 1
+        return char
+
+    def value(self,):
+        '''
+        parse the next complete json value
+         - a value is only accepted once a delimiter follows it, as
+           (e.g.) a number could continue into the next chunk
+        '''
+        self.next_char()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.text, self.pos)
+                if self.exhausted or (end < len(self.text) and self.text[end] in _delimiters):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.exhausted:
+                    raise
+            # Incomplete : read (at least) as much again as we have, so re-parsing stays cheap overall
+            if not self.more(min_new=max(1, len(self.text) - self.pos)):
+                raise ValueError('Unexpected end of json stream')
+
+
+def iter_object_items(chunks):
+    '''
+    Incrementally parse a json object from an iterable of byte-chunks
+
+    inputs
+    -------
+    chunks : iterable of bytes (need not be aligned with the json structure, or with utf-8 characters)
+
+    returns
+    -------
+    generator of (key, value) pairs
+     - raises ValueError (or json.JSONDecodeError) if the stream is not a single json object
+    '''
+    buffer = _Buffer(chunks)
+    buffer.expect('{')
+    if buffer.next_char() == '}':
+        buffer.pos += 1
+    else:
+        while True:
+            if buffer.next_char() != '"':
+                buffer.expect('"')
+            key = buffer.value()
+            buffer.expect(':')
+            yield key, buffer.value()
+            if buffer.expect(',}') == '}':
+                break
+
+    if buffer.next_char() is not None:
+        raise ValueError('Unexpected data after the end of the json object')
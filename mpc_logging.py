@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+'''
+    --------------------------------------------------------------
+    Non-blocking, structured logging for the queue & socket code
+
+    Loggers from get_logger() never do any I/O in the calling thread:
+     - records are put on a (bounded) queue, & are dropped (& counted)
+       rather than block if the queue is full
+     - a single background thread (logging.handlers.QueueListener)
+       formats them as json-lines & writes them to long-lived file
+       handlers, one per log-file, opened once & kept open
+     - NB: messages are %-formatted with their args in the background
+       thread, so args must not be modified after the logging call
+     - high-volume events can be sampled, so that only a fraction of
+       them are written (warnings & errors are always written)
+
+    Nothing is started (or opened) until the first record is logged, &
+    log-files named without a directory are written to log_dir (see
+    configure, or the MPC_LOG_DIR environment variable : by default, the
+    current directory at the time of writing)
+
+    Each line of a log-file is a json object, e.g.
+    {"time": "2021-04-01T12:00:00.123456+00:00", "level": "INFO",
+     "logger": "mpc_sqs.read", "message": "No Jobs", "sample_rate": 0.01}
+     - any "extra" fields passed to the logging call are included
+
+    Expected usage:
+    ----------------
+    mpc_logging.configure('/var/log/mpc')   # (optional)
+    log = mpc_logging.get_logger('sockets_class', sample_rate=0.1)
+    log.info('received', extra={'n_bytes': n})
+    --------------------------------------------------------------
+'''
+
+
+# Import third-party packages
+# --------------------------------------------------------------
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+
+
+# The attributes of every LogRecord : anything else was passed as "extra"
+_standard_attributes = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'log_file'}
+
+# Max number of records waiting to be written
+max_queue_size = 100000
+
+# Directory for log-files named without one (None : the current directory)
+log_dir = os.environ.get('MPC_LOG_DIR') or None
+
+_lock       = threading.Lock()
+_queue      = queue.Queue(maxsize=max_queue_size)
+_listener   = None
+_dispatcher = None
+
+
+class JsonFormatter(logging.Formatter):
+    ''' format a record as a single line of json '''
+
+    def format(self, record):
+        entry = {   'time'      : datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+                    'level'     : record.levelname,
+                    'logger'    : record.name,
+                    'message'   : record.getMessage()}
+        entry.update({k: v for k, v in vars(record).items() if k not in _standard_attributes})
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=repr)
+
+
+class SamplingFilter(logging.Filter):
+    '''
+    Only let through a fraction (sample_rate) of records below WARNING
+     - the rate can be set per-call, e.g. log.info(..., extra={'sample_rate': 0.01})
+    '''
+
+    def __init__(self, sample_rate=1.0):
+        logging.Filter.__init__(self)
+        self.sample_rate = sample_rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        sample_rate = getattr(record, 'sample_rate', self.sample_rate)
+        return sample_rate >= 1 or random.random() < sample_rate
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    '''
+    Puts records on the shared queue, labelled with the file they are to be written to
+     - never blocks : if the queue is full the record is dropped (& counted)
+     - leaves all formatting to the background thread (which is started by the first record)
+    '''
+
+    def __init__(self, log_queue, log_file):
+        logging.handlers.QueueHandler.__init__(self, log_queue)
+        self.log_file   = log_file
+        self.dropped    = 0
+
+    @property
+    def path(self,):
+        ''' the file written to (a log_file without a directory is in log_dir, as it is now) '''
+        return os.path.abspath(os.path.join(log_dir or '', self.log_file))
+
+    def prepare(self, record):
+        record.log_file = self.path
+        return record
+
+    def enqueue(self, record):
+        if _listener is None and self.queue is _queue:
+            _start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _Dispatcher(logging.Handler):
+    '''
+    Runs in the background thread : writes each record to its log-file,
+    keeping one FileHandler open per file
+    '''
+
+    def __init__(self,):
+        logging.Handler.__init__(self)
+        self.formatter      = JsonFormatter()
+        self.file_handlers  = {}
+
+    def emit(self, record):
+        handler = self.file_handlers.get(record.log_file)
+        if handler is None:
+            handler = self.file_handlers[record.log_file] = logging.FileHandler(record.log_file, delay=True)
+            handler.setFormatter(self.formatter)
+        handler.handle(record)
+
+    def close(self,):
+        for handler in self.file_handlers.values():
+            handler.close()
+        logging.Handler.close(self)
+
+
+def _start():
+    ''' start the background writer (once) '''
+    global _listener, _dispatcher
+    with _lock:
+        if _listener is None:
+            _dispatcher = _Dispatcher()
+            _listener   = logging.handlers.QueueListener(_queue, _dispatcher)
+            _listener.start()
+
+
+def get_logger(name, log_file=None, level=logging.INFO, sample_rate=1.0):
+    '''
+    a logger whose records are written (as json-lines) by the background thread
+
+    inputs
+    -------
+    name        : logger name
+    log_file    : file to write to (default : "<name>.log" in log_dir)
+    level       : minimum level to write
+    sample_rate : fraction of the records below WARNING to write
+
+    returns
+    -------
+    logging.Logger (set-up on the first call for each name, the same logger thereafter)
+     - nothing is started or opened until something is logged
+    '''
+    logger = logging.getLogger(name)
+    with _lock:
+        if not any(isinstance(handler, _QueueHandler) for handler in logger.handlers):
+            handler = _QueueHandler(_queue, log_file if log_file is not None else f'{name}.log')
+            handler.addFilter(SamplingFilter(sample_rate))
+            logger.addHandler(handler)
+            logger.setLevel(level)
+            logger.propagate = False
+    return logger
+
+
+def configure(directory=None):
+    ''' write log-files named without a directory to this directory (None : the current directory) '''
+    global log_dir
+    log_dir = directory
+
+
+def flush():
+    ''' wait until everything logged so far has been written '''
+    if _listener is not None:
+        _queue.join()
+
+
+def shutdown():
+    ''' write out anything still queued, & close the log-files (logging again restarts the writer) '''
+    global _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _dispatcher.close()
+            _listener = None
+
+atexit.register(shutdown)
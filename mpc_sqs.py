@@ -13,40 +13,41 @@ https://boto3.amazonaws.com/v1/documentation/api/latest/guide/quickstart.html
 '''
 
 # Third party imports
-import boto3
 from datetime import datetime
 import os
 import logging
 import functools
+import time
+import threading
+import queue
+import json
+from concurrent.futures import ThreadPoolExecutor
 
-# Create SQS client
-sqs = boto3.client('sqs')
+# Import neighboring packages
+import queue_backends
+import mpc_logging
+
+# SQS client : the default backend for all MPCSQS queues
+#  - the boto3 client is only created when first used (see queue_backends)
+sqs = queue_backends.SQSBackend()
 
 
 # -------- Logging & Error-Handling --------------------------------------
+#  - Logs are written (as json-lines) by a background thread, so that
+#    logging never blocks a send/read/delete (see mpc_logging)
+#  - The log-files are "<func_type>_INFO.log" & "<func_type>_ERROR.log"
+#  - Only a sample of the (very frequent) empty reads are logged
+empty_read_sample_rate = 0.01
+
 def _generate_log(func_type, log_type):
     """
-    Create a logger object
+    Get the (long-lived) logger for func_type & log_type
     """
     assert log_type in ['ERROR' , 'INFO']
     loggerName  = func_type + "_" + log_type
-    logFile     = f'{loggerName}.log'
-    
-    # Create a logger and set the level.
-    logger = logging.getLogger(loggerName)
-    logger.setLevel(logging.ERROR if log_type == 'ERROR' else logging.INFO )
-
-    # Create file handler, log format and add the format to file handler
-    file_handler = logging.FileHandler( logFile )
-
-    # See https://docs.python.org/3/library/logging.html#logrecord-attributes
-    # for log format attributes.
-    formatter = logging.Formatter( '%(levelname)s %(asctime)s %(message)s' )
-    file_handler.setFormatter(formatter)
-
-    logger.addHandler(file_handler)
-    return logging.getLogger(loggerName)
-
+    return mpc_logging.get_logger(  f'mpc_sqs.{loggerName}',
+                                    log_file    = f'{loggerName}.log',
+                                    level       = logging.ERROR if log_type == 'ERROR' else logging.INFO)
 
 
 def log_success(func_type, result):
@@ -54,24 +55,21 @@ def log_success(func_type, result):
     assert func_type in ['send','read','delete']
     logger = _generate_log(func_type, 'INFO')
     if   func_type == 'send':
-        msg = 'Sent: %s' % result
+        logger.info('Sent: %s', result)
     elif func_type == 'read':
-        msg = 'Read: %r' % result if result else 'No Jobs'
+        if result:
+            logger.info('Read: %r', result, extra={'n_messages': len(result) if isinstance(result, list) else 1})
+        else:
+            logger.info('No Jobs', extra={'sample_rate': empty_read_sample_rate})
     elif func_type == 'delete':
-        msg = 'Deleted: %r' % result
+        logger.info('Deleted: %r', result)
     else:
         assert False
 
-    logger.info(msg)
-    logger.handlers.clear()
-    del logger
-
 def log_failure(func_type, err):
     assert func_type in ['send','read','delete']
     logger = _generate_log(func_type, 'ERROR')
-    logger.exception(f'\nError in {func_type}\n')
-    logger.handlers.clear()
-    del logger
+    logger.exception(f'Error in {func_type}')
 
 def log_with_err( func_type = None ):
     '''
@@ -118,14 +116,33 @@ class MPCSQS():
     
     This class should *NOT* be used directly ...
      - See child classes below for desired explicit calls
+
+    backend : where the queue lives (default : AWS SQS)
+     - see queue_backends for local (in-memory / sqlite) alternatives
+    claim_check : optional claim_check.ClaimCheck
+     - large message bodies are then offloaded to its blob-store on send,
+       and fetched on demand by resolve_body (see claim_check)
     '''
-    
-    def __init__(self, queue_url):
-        self.queue_url = queue_url
+
+    # Max number of entries in a single batch call, & max size of a message
+    # (or of all the messages in a batch call) in bytes (SQS service limits)
+    max_batch_entries   = 10
+    max_message_bytes   = 256 * 1024
+    # Number of times to retry entries of a batch that failed (not due to their own content)
+    max_batch_retries   = 3
+    batch_retry_delay   = 0.2
+    # Delay before a sent message can be received
+    send_delay_seconds  = 1
+
+    def __init__(self, queue_url, backend=None, claim_check=None):
+        self.queue_url      = queue_url
+        self.backend        = backend if backend is not None else sqs
+        self.claim_check    = claim_check
         
         # Variables used to read from queue
         self.job_dict               = None
         self.receipt_handle         = None
+        self.message_body           = None
 
     # ----- send to queue ---------------------------------
     @log_with_err(func_type = 'send')
@@ -138,11 +155,11 @@ class MPCSQS():
         aws_dict = self.transform_standard_dict_to_aws_dict(job_dict)
         
         # send message
-        response = sqs.send_message(
+        response = self.backend.send_message(
             QueueUrl=self.queue_url,
-            DelaySeconds=1,
+            DelaySeconds=self.send_delay_seconds,
             MessageAttributes= aws_dict,
-            MessageBody=(message_body_string)
+            MessageBody=self._offload(message_body_string)
         )
         
         return response['MessageId']
@@ -165,7 +182,7 @@ class MPCSQS():
 
     def _fetch(self,):
         ''' Fetch a single message from an SQS queue '''
-        return sqs.receive_message(
+        return self.backend.receive_message(
             QueueUrl=self.queue_url,
             AttributeNames=[
                 'SentTimestamp'
@@ -188,6 +205,7 @@ class MPCSQS():
         else:
             message             = queue_response['Messages'][0]
             self.receipt_handle = message['ReceiptHandle']
+            self.message_body   = message.get('Body')
 
             aws_dict = message['MessageAttributes']
             job_dict = self.transform_aws_dict_to_standard_dict(aws_dict)
@@ -201,10 +219,178 @@ class MPCSQS():
             Delete received message from queue
             Decorator logs & catches errors
         '''
-        return sqs.delete_message(
+        request_id = self.backend.delete_message(
             QueueUrl=self.queue_url,
             ReceiptHandle=self.receipt_handle
         )['ResponseMetadata']['RequestId']
+        self._release(self.message_body)
+        return request_id
+
+    # ----- batched versions of send / read / delete -------
+    @log_with_err(func_type = 'send')
+    def send_batch(self, job_dicts, message_body_strings=None):
+        '''
+            Send many messages to SQS queue, packing up to max_batch_entries per call
+            Decorator logs & catches errors
+            
+            returns list of MessageIds (None for any message that could not be sent)
+        '''
+        if message_body_strings is None:
+            message_body_strings = [self._sample_message_body_string() for _ in job_dicts]
+        assert len(message_body_strings) == len(job_dicts)
+
+        entries = [ {   'Id'                : str(n),
+                        'DelaySeconds'      : self.send_delay_seconds,
+                        'MessageAttributes' : self.transform_standard_dict_to_aws_dict(job_dict),
+                        'MessageBody'       : self._offload(message_body_string) }
+                    for n, (job_dict, message_body_string) in enumerate(zip(job_dicts, message_body_strings)) ]
+
+        successful = self._batch_call(self.backend.send_message_batch, entries, 'send')
+        return [successful[entry['Id']]['MessageId'] if entry['Id'] in successful else None for entry in entries]
+
+    @log_with_err(func_type = 'read')
+    def read_batch(self, max_messages=None, wait_time_seconds=0, visibility_timeout=None):
+        '''
+            Read/parse up to max_messages (<= max_batch_entries) jobs in a single call
+            Decorator logs & catches errors
+            
+            wait_time_seconds  : long-poll, i.e. wait up to this long (max 20s) for messages to arrive
+            visibility_timeout : seconds for which the messages are hidden from other readers
+                                 (default: None, i.e. the queue's own visibility timeout)
+            
+            returns list of dicts, one per message, each with keys
+             - 'job_dict'       : standard job-dictionary (as returned by read)
+             - 'receipt_handle' : needed to delete the message
+             - 'message_id'
+             - 'body'
+             - 'receive_count'  : number of times the message has been received
+             - 'received_at'    : local (monotonic) time at which the message was received
+        '''
+        max_messages = self.max_batch_entries if max_messages is None else min(max_messages, self.max_batch_entries)
+        # Only override the queue's visibility timeout if asked to (boto3 rejects None)
+        kwargs = {} if visibility_timeout is None else {'VisibilityTimeout': visibility_timeout}
+        queue_response = self.backend.receive_message(
+            QueueUrl=self.queue_url,
+            AttributeNames=[
+                'SentTimestamp', 'ApproximateReceiveCount'
+            ],
+            MaxNumberOfMessages=max_messages,
+            MessageAttributeNames=[
+                'All'
+            ],
+            WaitTimeSeconds=wait_time_seconds,
+            **kwargs
+        )
+        return [ self._parse_message(message) for message in queue_response.get('Messages', []) ]
+
+    def change_visibility(self, record, visibility_timeout):
+        '''
+            Change how long (from now) a received message stays hidden from other readers
+             - e.g. to extend it while a long job runs, or set to 0 to release it straight away
+        '''
+        self.backend.change_message_visibility(
+            QueueUrl=self.queue_url,
+            ReceiptHandle=record['receipt_handle'],
+            VisibilityTimeout=visibility_timeout
+        )
+
+    def _parse_message(self, message):
+        ''' parse a single fetched message into a record (see read_batch) '''
+        return {'job_dict'          : self.transform_aws_dict_to_standard_dict(message['MessageAttributes']),
+                'receipt_handle'    : message['ReceiptHandle'],
+                'message_id'        : message['MessageId'],
+                'body'              : message.get('Body'),
+                'receive_count'     : int(message.get('Attributes', {}).get('ApproximateReceiveCount', 1)),
+                'received_at'       : time.monotonic()}
+
+    @log_with_err(func_type = 'delete')
+    def delete_batch(self, records):
+        '''
+            Delete many received messages from queue, packing up to max_batch_entries per call
+            Decorator logs & catches errors
+            
+            records : list of records from read_batch (or of receipt-handle strings)
+            returns list of booleans (True if the message was deleted)
+        '''
+        entries = [ {   'Id'            : str(n),
+                        'ReceiptHandle' : record['receipt_handle'] if isinstance(record, dict) else record }
+                    for n, record in enumerate(records) ]
+        successful = self._batch_call(self.backend.delete_message_batch, entries, 'delete')
+        for entry, record in zip(entries, records):
+            if entry['Id'] in successful and isinstance(record, dict):
+                self._release(record.get('body'))
+        return [entry['Id'] in successful for entry in entries]
+
+    # ----- claim-check offload of large message bodies -------
+    def resolve_body(self, record):
+        '''
+            The full body of a received message (a record from read_batch)
+             - fetched from the claim-check blob-store if it was offloaded
+        '''
+        if self.claim_check is None:
+            return record['body']
+        return self.claim_check.resolve(record['body'])
+
+    def _offload(self, message_body_string):
+        if self.claim_check is None:
+            return message_body_string
+        return self.claim_check.offload(message_body_string)
+
+    def _release(self, message_body_string):
+        ''' once a message is deleted, nothing references its offloaded body any more '''
+        if self.claim_check is not None and message_body_string is not None:
+            self.claim_check.release_reference(message_body_string)
+
+    def _batch_call(self, api_call, entries, func_type):
+        '''
+            Make batch api-calls for all of the entries, max_batch_entries at a time
+             - Entries that failed through no fault of their own (i.e. not SenderFault),
+               or whose call failed altogether (e.g. a network error, which is logged
+               under func_type), are retried (on their own) up to max_batch_retries times
+            
+            returns dict of successful results, keyed on entry 'Id'
+        '''
+        successful  = {}
+        remaining   = list(entries)
+        for attempt in range(self.max_batch_retries + 1):
+            if attempt > 0:
+                time.sleep(self.batch_retry_delay * 2 ** (attempt - 1))
+            retry = []
+            for chunk in self._batches(remaining):
+                try:
+                    response = api_call(QueueUrl=self.queue_url, Entries=chunk)
+                except Exception as e:
+                    log_failure(func_type, e)
+                    retry.extend(chunk)
+                    continue
+                for success in response.get('Successful', []):
+                    successful[success['Id']] = success
+                failed_ids = {failure['Id'] for failure in response.get('Failed', []) if not failure.get('SenderFault')}
+                retry.extend(entry for entry in chunk if entry['Id'] in failed_ids)
+            if not retry:
+                break
+            remaining = retry
+        return successful
+
+    def _batches(self, entries):
+        ''' split entries into batches of <= max_batch_entries & <= max_message_bytes in total '''
+        batch, batch_bytes = [], 0
+        for entry in entries:
+            entry_bytes = self._entry_bytes(entry)
+            if batch and (len(batch) == self.max_batch_entries or batch_bytes + entry_bytes > self.max_message_bytes):
+                yield batch
+                batch, batch_bytes = [], 0
+            batch.append(entry)
+            batch_bytes += entry_bytes
+        if batch:
+            yield batch
+
+    @staticmethod
+    def _entry_bytes(entry):
+        ''' size of a message as counted by SQS : body, plus the names, types & values of the attributes '''
+        return len(entry.get('MessageBody', '').encode()) + sum(
+                len(k.encode()) + len(v['DataType'].encode()) + len(v.get('StringValue', '').encode())
+                for k, v in entry.get('MessageAttributes', {}).items())
 
     # ----- sample dictionaries -----------------------------
     def _sample_message_attributes_dict(self,):
@@ -262,8 +448,9 @@ class OrbfitExtensionSQS(MPCSQS):
     >>> if result_dict['successful'] : OES.delete()
     '''
     
-    def __init__(self,):
-        MPCSQS.__init__(self,  'https://sqs.us-east-1.amazonaws.com/071807599513/mpc_orbfit_extension_general')
+    def __init__(self, backend=None, claim_check=None):
+        MPCSQS.__init__(self,  'https://sqs.us-east-1.amazonaws.com/071807599513/mpc_orbfit_extension_general',
+                        backend=backend, claim_check=claim_check)
             
     def _sample_message_attributes_dict(self,):
         '''  '''
@@ -290,35 +477,295 @@ class OrbfitExtensionSQS(MPCSQS):
         '''  '''
         return 'OrbfitExtensionSQS: Sent: ' + self._now_str()
         
-        
 
-def auto_ack_batch_send_to_sqs_queue( obs_to_tracklet_with_dest_dict):
+class PackedTrackletSQS(MPCSQS):
+    '''
+    Messages each carrying many tracklets (see TrackletRouter)
+     - the attributes give the destination & the number of tracklets
+     - the body is json : {"tracklets": [{"trackletID": ..., "desig12": ..., "mpc_local_queue_destination": ...}, ...]}
+    
+    E.g.
+    >>> PTS = PackedTrackletSQS(queue_url)
+    >>> for record in PTS.read_batch(wait_time_seconds=20, visibility_timeout=300):
+    >>>     for tracklet_dict in unpack_tracklets(record):
+    >>>         ...
+    >>>     PTS.delete_batch([record])
+    '''
+
+    def _sample_message_attributes_dict(self,):
+        '''  '''
+        return {
+                    'mpc_local_queue_destination': {
+                        'DataType': 'String',
+                        'StringValue': 'MBAMOPP'
+                    },
+                    'n_tracklets': {
+                        'DataType': 'String',
+                        'StringValue': '1'
+                    }
+                }
+
+    def _sample_message_body_string(self,):
+        '''  '''
+        return json.dumps({'tracklets': []})
+
+def unpack_tracklets(record):
+    ''' the tracklet-dicts packed into a message (a record from PackedTrackletSQS.read_batch) '''
+    return json.loads(record['body'])['tracklets']
+
+
+
+class MPCSQSConsumer():
+    '''
+    Long-polling, prefetching consumer for an MPCSQS queue
+     - Background thread(s) long-poll the queue & keep a local buffer of
+       received messages topped up, so get() rarely has to wait on the network
+     - Messages are hidden from other readers for visibility_timeout seconds,
+       so two workers do not process the same message
+     - Each received message is a record carrying its own receipt-handle
+       (see MPCSQS.read_batch), which is what ack() uses to delete it
+     - Messages that sat in the buffer for so long that their visibility
+       timeout has (nearly) lapsed are dropped rather than processed, as they
+       may already have been received by another reader
+
+    E.g.
+    >>> consumer = MPCSQSConsumer(OrbfitExtensionSQS(), visibility_timeout=600)
+    >>> record = consumer.get(timeout=30)
+    >>> # calculate ( *not* part of the consumer)
+    >>> result_dict = do_orbit_fit(record['job_dict'])
+    >>> if result_dict['successful'] : consumer.ack([record])
+    >>> consumer.stop()
+    '''
+
+    def __init__(self, mpcsqs, wait_time_seconds=20, visibility_timeout=300, prefetch=10, n_fetchers=1,
+                        visibility_margin=5):
+        '''
+        mpcsqs              : MPCSQS instance (e.g. OrbfitExtensionSQS()) to read from
+        wait_time_seconds   : long-polling time for each receive call (max 20)
+        visibility_timeout  : seconds for which received messages are hidden from other readers
+        prefetch            : max number of messages held in the local buffer
+        n_fetchers          : number of threads receiving from the queue
+        visibility_margin   : drop buffered messages with less than this many seconds of visibility left
+        '''
+        self.mpcsqs             = mpcsqs
+        self.wait_time_seconds  = wait_time_seconds
+        self.visibility_timeout = visibility_timeout
+        self.visibility_margin  = visibility_margin
+        self.n_fetchers         = n_fetchers
+        self.buffer             = queue.Queue(maxsize=prefetch)
+        self._stop              = threading.Event()
+        self._threads           = []
+
+    def start(self,):
+        '''
+        start the background fetcher thread(s)
+         - after a stop(), waits for the old fetchers to finish their current
+           (long-)poll first, so no more than n_fetchers ever poll at once
+        '''
+        if self._threads and not self._stop.is_set():
+            return self
+        for thread in self._threads:
+            thread.join()
+        self._stop.clear()
+        self._threads = [threading.Thread(target=self._fetch_loop, daemon=True) for _ in range(self.n_fetchers)]
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self, wait=False):
+        '''
+        stop fetching : any messages still in the buffer become visible again after their timeout
+         - the fetchers finish their current (long-)poll in the background, releasing
+           anything it returns, unless wait=True, in which case we wait for them
+        '''
+        self._stop.set()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def get(self, timeout=None):
+        ''' next received message-record (None if nothing arrives within timeout seconds) '''
+        self.start()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                record = self.buffer.get(timeout=remaining)
+            except queue.Empty:
+                return None
+            if time.monotonic() - record['received_at'] < self.visibility_timeout - self.visibility_margin:
+                return record
+
+    def ack(self, records):
+        ''' delete successfully processed messages (in batches) : returns list of booleans '''
+        return self.mpcsqs.delete_batch(records)
+
+    def nack(self, record):
+        ''' give up on a message : make it visible to other readers straight away '''
+        self.mpcsqs.change_visibility(record, 0)
+
+    def extend(self, record, visibility_timeout=None):
+        ''' keep a message hidden for (another) visibility_timeout seconds from now '''
+        self.mpcsqs.change_visibility(record, visibility_timeout if visibility_timeout is not None else self.visibility_timeout)
+
+    def _fetch_loop(self,):
+        ''' keep the buffer topped up '''
+        while not self._stop.is_set():
+            # Only ask for as many messages as we have room for
+            room = self.buffer.maxsize - self.buffer.qsize()
+            if room <= 0:
+                self._stop.wait(0.05)
+                continue
+
+            records = self.mpcsqs.read_batch(max_messages=room,
+                                             wait_time_seconds=self.wait_time_seconds,
+                                             visibility_timeout=self.visibility_timeout)
+            if records is False:
+                # read_batch failed (& logged the error) : back off before trying again
+                self._stop.wait(1)
+                continue
+            for record in records:
+                if self._stop.is_set():
+                    # Stopped while we were polling : let others have the message straight away
+                    self.nack(record)
+                else:
+                    self.buffer.put(record)
+
+
+class TrackletRouter():
+    '''
+    Send tracklets to the queue for their destination
+     - groups tracklets by mpc_local_queue_destination
+     - packs many tracklets into each message (PackedTrackletSQS format),
+       up to max_message_bytes
+     - sends the messages for all destinations in parallel, in batches
+
+    queue_urls          : dict {destination: queue_url}
+    default_queue_url   : queue for destinations not in queue_urls (default: None, i.e. no such destinations)
+
+    The queues must be ones read by PackedTrackletSQS consumers : packed
+    messages are *not* orbit-extension jobs, so they must never go to the
+    general orbit-extension queue (OrbfitExtensionSQS / sqs_worker would
+    fail to read them)
+
+    E.g.
+    >>> router = TrackletRouter({'MBAMOPP': mba_queue_url, 'NEOCP': neocp_queue_url})
+    >>> status = router.send(tracklet_dicts)    # {trackletID: MessageId, or None if it could not be sent}
+    '''
+
+    default_queue_url   = None
+    default_max_workers = 8
+    # Leave room for the attributes in each message
+    attribute_allowance = 1024
+
+    def __init__(self, queue_urls=None, default_queue_url=None, backend=None, max_message_bytes=None, max_workers=None):
+        self.queue_urls         = queue_urls if queue_urls is not None else {}
+        self.default_queue_url  = default_queue_url if default_queue_url is not None else self.default_queue_url
+        self.backend            = backend
+        self.max_message_bytes  = max_message_bytes if max_message_bytes is not None else MPCSQS.max_message_bytes
+        self.max_workers        = max_workers if max_workers is not None else self.default_max_workers
+        self._queues            = {}
+        assert self.queue_urls or self.default_queue_url is not None, 'packed tracklets need their own queue(s)'
+        assert OrbfitExtensionSQS().queue_url not in list(self.queue_urls.values()) + [self.default_queue_url], \
+            'packed tracklets cannot go to the general orbit-extension queue'
+
+    def send(self, tracklet_dicts):
+        '''
+        tracklet_dicts : list of dicts, each with keys 'trackletID', 'desig12' & 'mpc_local_queue_destination'
+        returns dict {trackletID: MessageId of the message carrying it, or None if it could not be sent}
+        '''
+        # Group by destination
+        by_destination = {}
+        for tracklet_dict in tracklet_dicts:
+            by_destination.setdefault(tracklet_dict['mpc_local_queue_destination'], []).append(tracklet_dict)
+
+        # Pack into messages, & those into batches, which can all be sent in parallel
+        calls = []
+        for destination, tracklets in by_destination.items():
+            PTS = self._queue(destination)
+            messages = self._pack(tracklets)
+            entries = [{'MessageBody': body, 'MessageAttributes': PTS.transform_standard_dict_to_aws_dict(job_dict)}
+                       for job_dict, body, _ in messages]
+            start = 0
+            for batch in PTS._batches(entries):
+                calls.append((PTS, messages[start:start + len(batch)]))
+                start += len(batch)
+
+        status = {tracklet_dict['trackletID']: None for tracklet_dict in tracklet_dicts}
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(calls)))) as executor:
+            for (PTS, messages), message_ids in zip(calls, executor.map(self._send_batch, calls)):
+                for (_, _, trackletIDs), message_id in zip(messages, message_ids):
+                    status.update({trackletID: message_id for trackletID in trackletIDs})
+        return status
+
+    def _queue(self, destination):
+        if destination not in self._queues:
+            queue_url = self.queue_urls.get(destination, self.default_queue_url)
+            assert queue_url is not None, f'no queue for destination {destination!r}'
+            self._queues[destination] = PackedTrackletSQS(queue_url, backend=self.backend)
+        return self._queues[destination]
+
+    def _pack(self, tracklets):
+        '''
+        pack tracklets (of one destination) into as few messages as possible
+        returns list of (job_dict, body, trackletIDs), one per message
+        '''
+        max_body_bytes, messages = self.max_message_bytes - self.attribute_allowance, []
+        pieces, trackletIDs, n_bytes = [], [], 0
+        for tracklet_dict in tracklets:
+            piece = json.dumps(tracklet_dict)
+            # Start a new message if this tracklet (+ separator) would take the current one over the limit
+            if pieces and n_bytes + len(piece.encode()) + 2 > max_body_bytes:
+                messages.append(self._message(tracklets[0], pieces, trackletIDs))
+                pieces, trackletIDs, n_bytes = [], [], 0
+            pieces.append(piece)
+            trackletIDs.append(tracklet_dict['trackletID'])
+            n_bytes += len(piece.encode()) + 2
+        if pieces:
+            messages.append(self._message(tracklets[0], pieces, trackletIDs))
+        return messages
+
+    @staticmethod
+    def _message(tracklet_dict, pieces, trackletIDs):
+        job_dict = {'mpc_local_queue_destination'   : tracklet_dict['mpc_local_queue_destination'],
+                    'n_tracklets'                   : str(len(pieces))}
+        return job_dict, '{"tracklets": [' + ', '.join(pieces) + ']}', trackletIDs
+
+    @staticmethod
+    def _send_batch(call):
+        PTS, messages = call
+        message_ids = PTS.send_batch([job_dict for job_dict, _, _ in messages], [body for _, body, _ in messages])
+        return message_ids if message_ids is not False else [None] * len(messages)
+
+
+def auto_ack_batch_send_to_sqs_queue( obs_to_tracklet_with_dest_dict, router=None):
     """
     This takes a hacked-together dictionary from "separatesubmission.py" (in autoack)
     The dict looks like
         key = obs80_bit
         val = ( mpc_local_queue_destination , trackletID , desig12 )
-    This is *NOT* intended to be the final version of this function:
-     - I am just hacking together something to do an initial send to an AWS SQS queue
-     - Eventually we will want to send to different sqs queus depending on destination_directory + desig12
+    router : optional TrackletRouter
+     - if given, the tracklets are packed into messages & sent to the (packed) queue for their destination
+     - if not, each tracklet is sent as its own message to the general orbit-extension queue
+    Returns dict {trackletID: MessageId, or None for any tracklet that could not be sent}
     """
-    # Instantiate OrbfitExtensionSQS
-    OES = OrbfitExtensionSQS()
-    
+
     # Loop through the "batch dictionary" from autoack
+    tracklet_dict = {}
     for obs80_bit, _ in obs_to_tracklet_with_dest_dict.items():
         # Extract the data from the tuple in the dict-value field
         mpc_local_queue_destination , trackletID , desig12 = _
         
         # Group by trackletID
-        if trackletID not in tracklet_dict.items():
+        if trackletID not in tracklet_dict:
             tracklet_dict[trackletID] = {   'mpc_local_queue_destination'   : [mpc_local_queue_destination],
                                             'desig12'                       : [desig12]}
         else:
             tracklet_dict[trackletID]['mpc_local_queue_destination'].append(mpc_local_queue_destination)
             tracklet_dict[trackletID]['desig12'].append(desig12)
         
-    # make dict suitable for sending to aws queue
+    # make dicts suitable for sending to aws queue
+    standard_dicts = []
     for trackletID, _ in tracklet_dict.items():
     
         # Check that the destination & designation are unique
@@ -326,11 +773,16 @@ def auto_ack_batch_send_to_sqs_queue( obs_to_tracklet_with_dest_dict):
         assert len(set( _['desig12'] )) == 1
         
         # make simple dictionary
-        standard_dict = {   'trackletID'                    : trackletID ,
-                            'desig12'                       : _['desig12'][0],
-                            'mpc_local_queue_destination'   : _['mpc_local_queue_destination'][0]
-                        }
+        standard_dicts.append({ 'trackletID'                    : trackletID ,
+                                'desig12'                       : _['desig12'][0],
+                                'mpc_local_queue_destination'   : _['mpc_local_queue_destination'][0]
+                                })
         
-        # send to queue
-        print('Sending...\n',sample_dict)
-        OES.send( sample_dict , OES._sample_message_body_string() )
+    # send to queue(s) (in batches)
+    _generate_log('send', 'INFO').info('Sending %d tracklets...', len(standard_dicts))
+    if router is not None:
+        return router.send( standard_dicts )
+    message_ids = OrbfitExtensionSQS().send_batch( standard_dicts )
+    if message_ids is False:
+        message_ids = [None] * len(standard_dicts)
+    return {d['trackletID']: message_id for d, message_id in zip(standard_dicts, message_ids)}
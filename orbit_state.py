@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+
+'''
+    --------------------------------------------------------------
+    Typed, array-backed orbit-states
+
+    The orbits passed between the services (the "eq0dict" / "eq1dict"
+    of each designation) are dicts of strings, e.g.
+    {'EQU': {'coordtype': 'EQU', 'element0': '2.7399005433209478E+00', ...,
+             'cov00': '8.931775449980358E-15', ..., 'rms': ['9.45081E-08', ...]},
+     'KEP': {}, 'CAR': {}, 'COM': {}, 'COT': {},
+     'eph': 'JPLDE431', 'name': '2015HQ183', ...}
+    which have to be re-parsed by anything that wants the numbers.
+
+     - CoordinateState : one coordinate-section (e.g. 'EQU'), parsed once
+                         into float64 arrays, with the 6x6 symmetric
+                         covariance & normal matrices stored as packed
+                         (21-element) upper-triangles
+     - OrbitState      : a whole eq0dict / eq1dict : the (non-empty)
+                         coordinate-sections & the other (header) fields
+
+    Conversion to & from the dict format is lossless in value : every
+    number written by to_dict() parses back to the identical float64
+    (although e.g. '2.7399005433209478E+00' is written as '2.7399005433209478'),
+    & every non-numeric field is passed through as-is.
+
+    Each CoordinateState pickles (i.e. goes through the socket codec)
+    as one contiguous float64 buffer, rather than as a dict of strings.
+
+    Expected usage:
+    ----------------
+    state = orbit_state.OrbitState.from_dict(data[desig]['eq0dict'])
+    state['EQU'].elements, state['EQU'].covariance_matrix()
+    data[desig]['eq0dict'] = state.to_dict()
+    --------------------------------------------------------------
+'''
+
+
+# Import third-party packages
+# --------------------------------------------------------------
+import numpy as np
+
+
+# The coordinate-sections of an eq0dict / eq1dict
+coordtypes = ('CAR', 'COM', 'COT', 'EQU', 'KEP')
+
+# Packed upper-triangle <-> matrix indices : covNN is element [row[NN], col[NN]] (row-major)
+n_elements      = 6
+n_packed        = n_elements * (n_elements + 1) // 2
+_rows, _cols    = np.triu_indices(n_elements)
+
+
+class CoordinateState():
+    '''
+    One coordinate-section of an orbit (e.g. eq0dict['EQU'])
+
+    elements    : float64[6]  from element0-5
+    epoch       : float       from epoch
+    covariance  : float64[21] from cov00-20 (packed upper-triangle)
+    normal      : float64[21] from nor00-20 (packed upper-triangle)
+    rms, eigval, wea : float64[6]
+    extra       : dict of the other (non-numeric, or unrecognised) fields, e.g. coordtype, h, g
+
+    Each of the numeric fields is None if it was absent from the dict
+    '''
+
+    __slots__ = ('elements', 'epoch', 'covariance', 'normal', 'rms', 'eigval', 'wea', 'extra')
+
+    # name : (dict-keys, length) of each array field
+    array_fields = {'elements'      : ([f'element{i}' for i in range(n_elements)], n_elements),
+                    'covariance'    : ([f'cov{i:02d}' for i in range(n_packed)], n_packed),
+                    'normal'        : ([f'nor{i:02d}' for i in range(n_packed)], n_packed),
+                    'rms'           : ('rms', n_elements),
+                    'eigval'        : ('eigval', n_elements),
+                    'wea'           : ('wea', n_elements)}
+
+    def __init__(self, elements=None, epoch=None, covariance=None, normal=None,
+                       rms=None, eigval=None, wea=None, extra=None):
+        self.elements   = _array(elements, n_elements)
+        self.epoch      = float(epoch) if epoch is not None else None
+        self.covariance = _array(covariance, n_packed)
+        self.normal     = _array(normal, n_packed)
+        self.rms        = _array(rms, n_elements)
+        self.eigval     = _array(eigval, n_elements)
+        self.wea        = _array(wea, n_elements)
+        self.extra      = dict(extra) if extra is not None else {}
+
+    # ----- dict conversion ---------------------------------
+    @classmethod
+    def from_dict(cls, section):
+        ''' parse a coordinate-section dict (of strings) '''
+        extra   = dict(section)
+        arrays  = {}
+        for name, (keys, _) in cls.array_fields.items():
+            if isinstance(keys, str):
+                if keys in extra:
+                    arrays[name] = extra.pop(keys)
+            elif all(key in extra for key in keys):
+                arrays[name] = [extra.pop(key) for key in keys]
+        epoch = extra.pop('epoch') if 'epoch' in extra else None
+        return cls(epoch=epoch, extra=extra, **arrays)
+
+    def to_dict(self,):
+        ''' the coordinate-section as a dict of strings (keys sorted, as in testdict.json) '''
+        section = dict(self.extra)
+        for name, (keys, _) in self.array_fields.items():
+            values = getattr(self, name)
+            if values is None:
+                continue
+            strings = [repr(v) for v in values.tolist()]
+            if isinstance(keys, str):
+                section[keys] = strings
+            else:
+                section.update(zip(keys, strings))
+        if self.epoch is not None:
+            section['epoch'] = repr(self.epoch)
+        return dict(sorted(section.items()))
+
+    # ----- matrices ---------------------------------
+    def covariance_matrix(self,):
+        ''' the full (symmetric) 6x6 covariance matrix '''
+        return _unpack(self.covariance)
+
+    def normal_matrix(self,):
+        ''' the full (symmetric) 6x6 normal matrix '''
+        return _unpack(self.normal)
+
+    def sigmas(self,):
+        ''' 1-sigma uncertainty of each element (sqrt of the covariance diagonal) '''
+        return None if self.covariance is None else np.sqrt(self.covariance[_rows == _cols])
+
+    # ----- pickling ---------------------------------
+    def __reduce__(self):
+        ''' pickle as one float64 buffer (+ which fields are present) & the extra dict '''
+        present = tuple(name for name in self.array_fields if getattr(self, name) is not None)
+        buffer  = np.concatenate([getattr(self, name) for name in present]) if present else np.empty(0)
+        return (_restore_coordinate_state, (buffer.tobytes(), present, self.epoch, self.extra))
+
+    def __eq__(self, other):
+        if not isinstance(other, CoordinateState):
+            return NotImplemented
+        return self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return f'CoordinateState({self.extra.get("coordtype", "?")}, epoch={self.epoch}, elements={self.elements})'
+
+
+class OrbitState():
+    '''
+    A whole orbit dict (eq0dict / eq1dict)
+
+    sections : dict of coordtype : CoordinateState (only for the non-empty sections)
+    header   : dict of the other fields (e.g. eph, format, name, rectype, refsys), as-is
+    '''
+
+    __slots__ = ('sections', 'header', 'empty_sections')
+
+    def __init__(self, sections=None, header=None, empty_sections=()):
+        self.sections       = dict(sections) if sections is not None else {}
+        self.header         = dict(header) if header is not None else {}
+        self.empty_sections = tuple(empty_sections)
+
+    def __getitem__(self, coordtype):
+        return self.sections[coordtype]
+
+    def __contains__(self, coordtype):
+        return coordtype in self.sections
+
+    @classmethod
+    def from_dict(cls, eqdict):
+        ''' parse an eq0dict / eq1dict '''
+        sections, header, empty = {}, {}, []
+        for k, v in eqdict.items():
+            if k in coordtypes and isinstance(v, dict):
+                if v:
+                    sections[k] = CoordinateState.from_dict(v)
+                else:
+                    empty.append(k)
+            else:
+                header[k] = v
+        return cls(sections=sections, header=header, empty_sections=empty)
+
+    def to_dict(self,):
+        ''' the orbit as an eq0dict / eq1dict of strings '''
+        eqdict = dict(self.header)
+        eqdict.update({k: {} for k in self.empty_sections})
+        eqdict.update({k: v.to_dict() for k, v in self.sections.items()})
+        return dict(sorted(eqdict.items()))
+
+    def __eq__(self, other):
+        if not isinstance(other, OrbitState):
+            return NotImplemented
+        return self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return f'OrbitState({self.header.get("name", "?")}, sections={sorted(self.sections)})'
+
+
+# ----- the {desig: {'eq0dict': ...}} dicts passed between services ---------------------------------
+def parse_orbits(data, keys=('eq0dict', 'eq1dict')):
+    '''
+    replace (in-place) the orbit dicts of each designation in data with OrbitStates
+    returns data
+    '''
+    for v in data.values():
+        for k in keys:
+            if isinstance(v.get(k), dict):
+                v[k] = OrbitState.from_dict(v[k])
+    return data
+
+
+def format_orbits(data, keys=('eq0dict', 'eq1dict')):
+    '''
+    replace (in-place) the OrbitStates of each designation in data with dicts (e.g. to send as json)
+    returns data
+    '''
+    for v in data.values():
+        for k in keys:
+            if isinstance(v.get(k), OrbitState):
+                v[k] = v[k].to_dict()
+    return data
+
+
+# ----- helpers ---------------------------------
+def _array(values, length):
+    ''' float64 array (of the expected length) from a sequence of strings / numbers, or None '''
+    if values is None:
+        return None
+    array = np.asarray(values, dtype=np.float64)
+    assert array.shape == (length,), f'expected {length} values, got shape {array.shape}'
+    return array
+
+
+def _unpack(packed):
+    ''' symmetric matrix from its packed (row-major) upper-triangle '''
+    if packed is None:
+        return None
+    matrix = np.empty((n_elements, n_elements))
+    matrix[_rows, _cols] = packed
+    matrix[_cols, _rows] = packed
+    return matrix
+
+
+def _restore_coordinate_state(buffer, present, epoch, extra):
+    ''' inverse of CoordinateState.__reduce__ '''
+    state   = CoordinateState(epoch=epoch, extra=extra)
+    values  = np.frombuffer(buffer, dtype=np.float64).copy()
+    start   = 0
+    for name in present:
+        length = CoordinateState.array_fields[name][1]
+        setattr(state, name, values[start:start + length])
+        start += length
+    return state
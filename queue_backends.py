@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+
+'''
+    --------------------------------------------------------------
+    Queue backends for mpc_sqs.MPCSQS
+
+    MPCSQS talks to its queue through a "backend" : an object with the
+    same methods (& request/response shapes) as a boto3 SQS client
+     - send_message / send_message_batch
+     - receive_message
+     - delete_message / delete_message_batch
+     - change_message_visibility
+
+    (i)   SQSBackend    : AWS SQS, via a boto3 client that is only created
+                          (& boto3 only imported) when first used
+    (ii)  MemoryBackend : in-process queues, e.g. for tests & single-process runs
+    (iii) SQLiteBackend : durable queues in a sqlite (WAL) file, shared by all
+                          the processes on a machine, e.g. for on-prem runs
+
+    The local backends follow the SQS semantics that MPCSQS relies on:
+    delivery delays, visibility timeouts, receipt-handles (only the most
+    recent one is valid), receive-counts & long-polling.
+
+    Expected usage:
+    ----------------
+    OES = mpc_sqs.OrbfitExtensionSQS(backend=queue_backends.SQLiteBackend('/tmp/queues.sqlite'))
+    --------------------------------------------------------------
+'''
+
+
+# Import third-party packages
+# --------------------------------------------------------------
+import collections
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+
+class Backend():
+    '''
+    Common parts of the local backends : boto3-shaped request/response handling
+
+    Child classes implement
+     - _send(queue_url, messages)             : store [(message_id, body, attributes, visible_at)]
+     - _receive(queue_url, n, visibility)     : claim up to n visible messages : [message dicts]
+     - _delete(queue_url, receipt_handles)    : list of booleans
+     - _change_visibility(queue_url, receipt_handle, visible_at) : boolean
+     - _wait(timeout)                         : wait for (possible) new messages
+    '''
+
+    default_visibility_timeout = 30
+
+    # ----- send ---------------------------------
+    def send_message(self, QueueUrl, MessageBody, MessageAttributes=None, DelaySeconds=0, **kwargs):
+        response = self.send_message_batch(QueueUrl, [{'Id'                : '0',
+                                                       'MessageBody'        : MessageBody,
+                                                       'MessageAttributes'  : MessageAttributes or {},
+                                                       'DelaySeconds'       : DelaySeconds}])
+        return dict(response['Successful'][0], ResponseMetadata=self._metadata())
+
+    def send_message_batch(self, QueueUrl, Entries):
+        now         = time.time()
+        messages    = [(uuid.uuid4().hex, entry['MessageBody'], entry.get('MessageAttributes') or {},
+                        now + entry.get('DelaySeconds', 0)) for entry in Entries]
+        self._send(QueueUrl, messages)
+        return {'Successful'        : [{'Id'                : entry['Id'],
+                                        'MessageId'         : message[0],
+                                        'MD5OfMessageBody'  : hashlib.md5(entry['MessageBody'].encode()).hexdigest()}
+                                       for entry, message in zip(Entries, messages)],
+                'Failed'            : [],
+                'ResponseMetadata'  : self._metadata()}
+
+    # ----- receive ---------------------------------
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, VisibilityTimeout=None, WaitTimeSeconds=0, **kwargs):
+        ''' long-polls for up to WaitTimeSeconds if no messages are visible '''
+        visibility  = VisibilityTimeout if VisibilityTimeout is not None else self.default_visibility_timeout
+        deadline    = time.monotonic() + WaitTimeSeconds
+        while True:
+            messages = self._receive(QueueUrl, MaxNumberOfMessages, visibility)
+            remaining = deadline - time.monotonic()
+            if messages or remaining <= 0:
+                break
+            self._wait(remaining)
+
+        response = {'ResponseMetadata': self._metadata()}
+        if messages:
+            response['Messages'] = [{   'MessageId'         : m['message_id'],
+                                        'ReceiptHandle'     : m['receipt_handle'],
+                                        'Body'              : m['body'],
+                                        'MessageAttributes' : m['attributes'],
+                                        'Attributes'        : {'SentTimestamp'          : str(int(m['sent'] * 1000)),
+                                                               'ApproximateReceiveCount': str(m['receive_count'])}}
+                                    for m in messages]
+        return response
+
+    # ----- delete ---------------------------------
+    def delete_message(self, QueueUrl, ReceiptHandle):
+        if not self._delete(QueueUrl, [ReceiptHandle])[0]:
+            raise ValueError(f'ReceiptHandleIsInvalid: {ReceiptHandle}')
+        return {'ResponseMetadata': self._metadata()}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        deleted = self._delete(QueueUrl, [entry['ReceiptHandle'] for entry in Entries])
+        return {'Successful'        : [{'Id': entry['Id']} for entry, ok in zip(Entries, deleted) if ok],
+                'Failed'            : [{'Id': entry['Id'], 'SenderFault': True, 'Code': 'ReceiptHandleIsInvalid'}
+                                       for entry, ok in zip(Entries, deleted) if not ok],
+                'ResponseMetadata'  : self._metadata()}
+
+    # ----- visibility ---------------------------------
+    def change_message_visibility(self, QueueUrl, ReceiptHandle, VisibilityTimeout):
+        if not self._change_visibility(QueueUrl, ReceiptHandle, time.time() + VisibilityTimeout):
+            raise ValueError(f'ReceiptHandleIsInvalid: {ReceiptHandle}')
+        return {'ResponseMetadata': self._metadata()}
+
+    @staticmethod
+    def _metadata():
+        return {'RequestId': uuid.uuid4().hex, 'HTTPStatusCode': 200}
+
+
+class MemoryBackend(Backend):
+    '''
+    In-process queues
+     - messages that are ready to be received are kept in a FIFO, the others
+       (delayed or in-flight) in a heap ordered by the time they become visible
+    '''
+
+    def __init__(self,):
+        self._queues    = collections.defaultdict(lambda: {'messages': {}, 'ready': collections.deque(), 'later': []})
+        self._cond      = threading.Condition()
+        self._counter   = itertools.count()
+
+    def _send(self, queue_url, messages):
+        with self._cond:
+            q = self._queues[queue_url]
+            for message_id, body, attributes, visible_at in messages:
+                q['messages'][message_id] = {'message_id'       : message_id,
+                                             'body'             : body,
+                                             'attributes'       : attributes,
+                                             'sent'             : time.time(),
+                                             'visible_at'       : visible_at,
+                                             'receive_count'    : 0,
+                                             'receipt_handle'   : None}
+                heapq.heappush(q['later'], (visible_at, next(self._counter), message_id))
+            self._cond.notify_all()
+
+    def _receive(self, queue_url, n, visibility):
+        now = time.time()
+        with self._cond:
+            q = self._queues[queue_url]
+
+            # Move messages that have become visible onto the FIFO
+            while q['later'] and q['later'][0][0] <= now:
+                visible_at, _, message_id = heapq.heappop(q['later'])
+                m = q['messages'].get(message_id)
+                if m is not None and m['visible_at'] == visible_at:
+                    q['ready'].append(message_id)
+
+            # Claim from the FIFO, skipping anything deleted/re-hidden since it was queued
+            received = []
+            while q['ready'] and len(received) < n:
+                m = q['messages'].get(q['ready'].popleft())
+                if m is None or m['visible_at'] > now:
+                    continue
+                m['visible_at']        = now + visibility
+                m['receive_count']    += 1
+                m['receipt_handle']    = f"{m['message_id']}:{m['receive_count']}"
+                heapq.heappush(q['later'], (m['visible_at'], next(self._counter), m['message_id']))
+                received.append(dict(m))
+        return received
+
+    def _delete(self, queue_url, receipt_handles):
+        with self._cond:
+            messages, deleted = self._queues[queue_url]['messages'], []
+            for receipt_handle in receipt_handles:
+                m = messages.get(receipt_handle.split(':')[0])
+                ok = m is not None and m['receipt_handle'] == receipt_handle
+                if ok:
+                    del messages[m['message_id']]
+                deleted.append(ok)
+        return deleted
+
+    def _change_visibility(self, queue_url, receipt_handle, visible_at):
+        with self._cond:
+            q = self._queues[queue_url]
+            m = q['messages'].get(receipt_handle.split(':')[0])
+            if m is None or m['receipt_handle'] != receipt_handle:
+                return False
+            m['visible_at'] = visible_at
+            heapq.heappush(q['later'], (visible_at, next(self._counter), m['message_id']))
+            self._cond.notify_all()
+        return True
+
+    def _wait(self, timeout):
+        # Woken by sends, but also wake up in time for delayed/in-flight messages becoming visible
+        with self._cond:
+            self._cond.wait(min(timeout, 0.05))
+
+
+class SQLiteBackend(Backend):
+    '''
+    Durable queues in a sqlite file (in WAL mode)
+     - can be shared by several processes : each claim of messages is a
+       single atomic UPDATE ... RETURNING statement
+     - batches are written in a single transaction, with synchronous=NORMAL,
+       which is what gets us to tens of thousands of messages per second
+       (a power-cut may lose the last few transactions, but never corrupts the file)
+    '''
+
+    default_path = os.path.join(os.path.expanduser('~'), '.mpc_queues.sqlite')
+
+    # Polling interval when long-polling (other processes cannot notify us)
+    poll_interval = 0.01
+
+    def __init__(self, path=None):
+        self.path   = path if path is not None else self.default_path
+        self._lock  = threading.Lock()
+        self._db    = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS messages (
+                                seq             INTEGER PRIMARY KEY,
+                                queue_url       TEXT,
+                                message_id      TEXT UNIQUE,
+                                body            TEXT,
+                                attributes      TEXT,
+                                sent            REAL,
+                                visible_at      REAL,
+                                receive_count   INTEGER,
+                                receipt_handle  TEXT)''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS messages_visible ON messages (queue_url, visible_at)')
+        self._db.commit()
+
+    def _send(self, queue_url, messages):
+        now = time.time()
+        with self._lock:
+            self._db.executemany('INSERT INTO messages VALUES (NULL,?,?,?,?,?,?,0,NULL)',
+                                 [(queue_url, message_id, body, json.dumps(attributes), now, visible_at)
+                                  for message_id, body, attributes, visible_at in messages])
+            self._db.commit()
+
+    def _receive(self, queue_url, n, visibility):
+        now = time.time()
+        with self._lock:
+            rows = self._db.execute('''UPDATE messages
+                                       SET visible_at=?, receive_count=receive_count+1,
+                                           receipt_handle=message_id || ':' || (receive_count+1)
+                                       WHERE seq IN (SELECT seq FROM messages
+                                                     WHERE queue_url=? AND visible_at<=?
+                                                     ORDER BY visible_at LIMIT ?)
+                                       RETURNING message_id, body, attributes, sent, receive_count, receipt_handle''',
+                                    (now + visibility, queue_url, now, n)).fetchall()
+            self._db.commit()
+        return [{   'message_id'        : row[0],
+                    'body'              : row[1],
+                    'attributes'        : json.loads(row[2]),
+                    'sent'              : row[3],
+                    'receive_count'     : row[4],
+                    'receipt_handle'    : row[5]} for row in rows]
+
+    def _delete(self, queue_url, receipt_handles):
+        with self._lock:
+            deleted = [self._db.execute('DELETE FROM messages WHERE message_id=? AND receipt_handle=?',
+                                        (receipt_handle.split(':')[0], receipt_handle)).rowcount == 1
+                       for receipt_handle in receipt_handles]
+            self._db.commit()
+        return deleted
+
+    def _change_visibility(self, queue_url, receipt_handle, visible_at):
+        with self._lock:
+            changed = self._db.execute('UPDATE messages SET visible_at=? WHERE message_id=? AND receipt_handle=?',
+                                       (visible_at, receipt_handle.split(':')[0], receipt_handle)).rowcount == 1
+            self._db.commit()
+        return changed
+
+    def _wait(self, timeout):
+        time.sleep(min(timeout, self.poll_interval))
+
+    def close(self,):
+        self._db.close()
+
+
+class SQSBackend():
+    '''
+    AWS SQS : calls are passed straight on to a boto3 client,
+    which is only created (& boto3 only imported) on first use
+    '''
+
+    def __init__(self, **client_kwargs):
+        self.client_kwargs  = client_kwargs
+        self._client        = None
+        self._lock          = threading.Lock()
+
+    @property
+    def client(self,):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    import boto3
+                    self._client = boto3.client('sqs', **self.client_kwargs)
+        return self._client
+
+    def __getattr__(self, name):
+        # e.g. send_message_batch, receive_message, ...
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.client, name)
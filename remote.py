@@ -24,25 +24,54 @@
 
 # Import third-party packages
 # --------------------------------------------------------------
+#  - NB: requests is only imported when the first http session is created
+#    (see _get_session), to keep start-up fast (see bench_startup.py)
 import sys, os
-import pytest
 import threading
-import socket
-from datetime import datetime
 import time
-import pickle
-import numpy as np
-import struct
-import subprocess
 import json
-import zlib
-import requests
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 
 # Import neighboring packages
 # --------------------------------------------------------------
 import sockets_class as sc
-import sample_data
+import remote_cache
+import compression
+import request_policies
+import json_stream
+import tracing
+
+# Spans of each request (see tracing)
+tracer = tracing.get_tracer('remote')
+
+# Shared http session
+# --------------------------------------------------------------
+# A single keep-alive session is shared by all Remote instances, so that
+# repeated calls (even from new instances) re-use open connections
+_session        = None
+_session_lock   = threading.Lock()
+_session_pool_size = 32
+
+def _get_session():
+    ''' Get (creating if necessary) the shared keep-alive session '''
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                import requests
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=_session_pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _session = session
+    return _session
+
+# Likewise, a single retry-budget is shared by all Remote instances (that are
+# not given their own), so that together they cannot multiply the load on a
+# struggling backend with retries & hedges
+_retry_budget   = request_policies.RetryBudget()
+
 
 # Interface for a remote-machine to request an orbit-fit
 # --------------------------------------------------------------
@@ -56,10 +85,80 @@ class Remote():
     ----------------
     R = remote.Remote().request_orbit_extension_json(supplied_json)
 
+    For large batches (a dict of many designations):
+    R = remote.Remote().request_orbit_extension_many(supplied_dict)
+
+    To re-use results for unchanged inputs (see remote_cache.py):
+    R = remote.Remote(cache=True).request_orbit_extension_many(supplied_dict)
+
+    For long-running jobs (needs the gateway, see remote_jobs.py):
+    job_id = remote.Remote().submit_orbit_extension_json(supplied_json)['job_id']
+    R = remote.Remote().wait_for_job(job_id)
+
+    To control tail-latency when a backend stalls (see request_policies.py):
+    R = remote.Remote(backup_base_urls=[...], retry=True, hedge=True)
+     - only requests that are safe to repeat (see default_idempotent_scripts) are retried or hedged
+
+    To adapt the concurrency of the *_many methods to the server's load (see request_policies.py):
+    R = remote.Remote(limiter=True)
+    R.limiter.limit
+
     '''
 
-    def __init__(self, host=None, port=None):
-        pass
+    default_base_url            = "http://131.142.195.56/cgi-bin/cgipy"
+    default_max_workers         = 4
+    default_chunk_designations  = 50
+    default_chunk_bytes         = 4 * 2**20
+    # Seconds to wait for the result-version (if no timeout is given) : it is only
+    # used to revalidate cached results, so it is not worth waiting long for
+    default_version_timeout     = 10
+    # Scripts whose requests are safe to send more than once : only these are retried or hedged
+    #  - the compute endpoints just return the fit of their input, so a duplicate only costs compute
+    #  - NB: not remote_submit : a submitted job would be run (& reported) twice
+    #  - (the version & job-status endpoints are plain GETs, made without the policies)
+    default_idempotent_scripts  = ('remote_test', 'remote_orbfit', 'remote_iod', 'remote_comet')
+
+    def __init__(self, host=None, port=None, base_url=None, max_workers=None, cache=None, request_encoding=None,
+                        backup_base_urls=None, retry=None, hedge=None, retry_budget=None, timeout=None, limiter=None,
+                        idempotent_scripts=None):
+        '''
+        base_url    : where the remote_*.cgi scripts (or the gateway) can be found
+        max_workers : max number of concurrent requests made by the *_many methods
+        cache       : remote_cache.ResultCache (or True for the default one) used by the *_many methods
+        request_encoding : compress request bodies ("deflate" or "gzip": see compression.py)
+         - NB: only the gateway understands compressed requests, the cgi-scripts do not
+         - (compressed responses are always accepted & decompressed automatically)
+        backup_base_urls : other backends offering the same service, used for retries & hedges
+        retry       : request_policies.RetryPolicy (or True for the default one)
+        hedge       : request_policies.HedgePolicy (or True for the default one)
+        retry_budget: request_policies.RetryBudget shared by retries & hedges (default: one shared by all instances)
+        idempotent_scripts : the scripts (without ".cgi") whose requests may be retried / hedged
+        timeout     : seconds to wait for a reply before giving up on an attempt
+        limiter     : request_policies.AdaptiveLimiter (or True for one starting at max_workers) that
+                      adapts the number of concurrent requests made by the *_many methods (instead of max_workers)
+        '''
+        assert compression.is_supported(request_encoding), f'unsupported encoding {request_encoding}'
+        self.request_encoding = request_encoding
+        self.backup_base_urls = list(backup_base_urls) if backup_base_urls else []
+        self.retry          = request_policies.RetryPolicy() if retry is True else retry
+        self.hedge          = request_policies.HedgePolicy() if hedge is True else hedge
+        self.retry_budget   = retry_budget if retry_budget is not None else _retry_budget
+        self.idempotent_scripts = tuple(idempotent_scripts) if idempotent_scripts is not None else self.default_idempotent_scripts
+        self.timeout        = timeout
+        self.base_url       = base_url if base_url is not None else self.default_base_url
+        self.max_workers    = max_workers if max_workers is not None else self.default_max_workers
+        self.limiter        = request_policies.AdaptiveLimiter(initial_limit=self.max_workers,
+                                                               max_limit=max(self.max_workers, 64)) if limiter is True else limiter
+        self.session        = _get_session()
+        self.cache          = remote_cache.ResultCache() if cache is True else cache
+
+        # Last result-version reported by the server (see _result_version)
+        self._version       = None
+        self._version_etag  = None
+
+    def _url(self, script):
+        ''' full url for a given remote_*.cgi script '''
+        return self.base_url.rstrip('/') + '/' + script
         
     # ------- REMOTE TEST : ORBIT EXTENSION ---------------------------------
     def request_test_json(  self, input_json_string , VERBOSE = False):
@@ -76,7 +175,7 @@ class Remote():
         
         '''
         # Request orbit-fit via API
-        url             = "http://131.142.195.56/cgi-bin/cgipy/remote_test.cgi"
+        url             = self._url("remote_test.cgi")
         METHOD_OBJECT   = sc.Testing()
         result_dict     = self._request(input_json_string , url, METHOD_OBJECT )
         return result_dict
@@ -99,11 +198,129 @@ class Remote():
         '''
                 
         # Request orbit-fit via API
-        url             = "http://131.142.195.56/cgi-bin/cgipy/remote_orbfit.cgi"
+        url             = self._url("remote_orbfit.cgi")
         METHOD_OBJECT   = sc.Orbfit()
         result_dict     = self._request(input_json_string , url, METHOD_OBJECT )
         return result_dict
         
+    def iter_orbit_extension(self, input_json_string, VERBOSE = False):
+        '''
+        As request_orbit_extension_json, but the reply is parsed incrementally
+        as it is received, so that results can be used (e.g. written out)
+        before the whole reply has arrived
+
+        inputs
+        -------
+        json_data : json
+         - data package to contain all necessary data to specify orbit-fitting.
+
+        returns
+        -------
+        generator of (designation, result) pairs
+         - As for the other methods, errors are reported as an ('exception', message) pair
+        '''
+        url             = self._url("remote_orbfit.cgi")
+        METHOD_OBJECT   = sc.Orbfit()
+        return self._iter_request(input_json_string, url, METHOD_OBJECT)
+
+    def request_orbit_extension_many(self, input_dict, max_workers=None, max_designations=None, max_bytes=None):
+        '''
+        Request orbit extensions/refits for a large dict of designations
+         - The input is split into chunks, which are sent concurrently
+        
+        inputs
+        -------
+        input_dict : dict
+         - data package with designations as keys (same format as the json for request_orbit_extension_json)
+        max_workers : int
+         - max number of requests in flight at once
+        max_designations, max_bytes : int
+         - max number of designations / json-bytes in a single request
+
+        returns
+        -------
+        dict : {'results': merged-dict-of-results-from-all-chunks,
+                'errors' : list of {'designations': [...], 'exception': ...} for any chunk that failed}
+        '''
+        url             = self._url("remote_orbfit.cgi")
+        METHOD_OBJECT   = sc.Orbfit()
+        return self._request_many(input_dict, url, METHOD_OBJECT,
+                                    request_type='orbfit',
+                                    max_workers=max_workers,
+                                    max_designations=max_designations,
+                                    max_bytes=max_bytes)
+
+    def request_orbit_extension_many_async(self, input_dict, **kwargs):
+        '''
+        As request_orbit_extension_many, but returns immediately
+        
+        returns
+        -------
+        concurrent.futures.Future : .result() gives the dict returned by request_orbit_extension_many
+        '''
+        executor = ThreadPoolExecutor(max_workers=1)
+        future = executor.submit(self.request_orbit_extension_many, input_dict, **kwargs)
+        executor.shutdown(wait=False)
+        return future
+
+
+    # ------- ASYNCHRONOUS JOBS -----------------------------------------
+    def submit_orbit_extension_json(self, input_json_string, VERBOSE = False):
+        '''
+        Submit an orbit extension/refit job to be run in the background
+        (needs the gateway: the cgi-scripts do not support jobs)
+
+        inputs
+        -------
+        json_data : json
+         - data package to contain all necessary data to specify orbit-fitting.
+
+        returns
+        -------
+        result_dict: dict
+         - {'job_id': ...} to be passed to poll_job / wait_for_job
+        '''
+        url             = self._url("remote_submit/remote_orbfit.cgi")
+        METHOD_OBJECT   = sc.Orbfit()
+        return self._request(input_json_string , url, METHOD_OBJECT )
+
+    def poll_job(self, job_id, wait=0):
+        '''
+        Get the status & (partial) results of a job
+
+        inputs
+        -------
+        job_id : str
+        wait : float
+         - long-poll : the server waits up to this many seconds for the job to finish before replying
+
+        returns
+        -------
+        result_dict: dict
+         - {'job_id', 'status' ('queued', 'running', 'done' or 'failed'), 'n_total', 'n_done', 'results'}
+        '''
+        try:
+            r = self.session.get(self._url(f"remote_job/{job_id}"), params={'wait': wait},
+                                 timeout=None if self.timeout is None else self.timeout + wait)
+            result_dict = json.loads(r.content.decode())
+        except Exception as e:
+            result_dict = {'exception': f'{e}', 'file':__file__, 'function':'poll_job'}
+        return result_dict
+
+    def wait_for_job(self, job_id, timeout=None, poll_wait=30):
+        '''
+        Long-poll until the job has finished (or timeout seconds have passed)
+         - returns the final result of poll_job
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = poll_wait if deadline is None else max(0, min(poll_wait, deadline - time.monotonic()))
+            result_dict = self.poll_job(job_id, wait=wait)
+            if result_dict.get('status') not in ('queued', 'running'):
+                return result_dict
+            if deadline is not None and time.monotonic() >= deadline:
+                return result_dict
+
 
 
     # ------- ORBIT FITTING (2) : INITIAL ORBIT DETERMINATION  --------------------
@@ -123,7 +340,7 @@ class Remote():
         '''
                 
         # Request orbit-fit via API
-        url             = "http://131.142.195.56/cgi-bin/cgipy/remote_iod.cgi"
+        url             = self._url("remote_iod.cgi")
         METHOD_OBJECT   = sc.IOD()
         result_dict     = self._request(input_json_string , url, METHOD_OBJECT )
         return result_dict
@@ -145,7 +362,7 @@ class Remote():
         '''
                 
         # Request orbit-fit via API
-        url             = "http://131.142.195.56/cgi-bin/cgipy/remote_comet.cgi"
+        url             = self._url("remote_comet.cgi")
         METHOD_OBJECT   = sc.Comet()
         result_dict     = self._request(input_json_string , url, METHOD_OBJECT )
         return result_dict
@@ -163,25 +380,286 @@ class Remote():
         Common method used to send data packet to the requested url,
         and then turn the received reply into a dictionary
         '''
+        with tracer.span('Remote._request', attributes={'url': url}) as span:
+            try:
+                # If desired, do checks on the input format
+                if CHECKS:
+                    METHOD_OBJECT._check_json_from_client(input_json_string)
+
+                # Send request to the above URL (compressing the data if requested)
+                r = self._put(url, input_json_string)
+            
+                # Decode the reply
+                with tracer.span('decode', attributes={'response_bytes': len(r.content)}):
+                    decoded_content = r.content.decode()
+
+                    # Turn the reply into a dictionary
+                    result_dict = json.loads(decoded_content)
+
+                # If desired, check the returned data is as expected
+                if CHECKS:
+                    METHOD_OBJECT._check_data_format_from_server(result_dict)
+
+            except Exception as e:
+                span.set_attribute('exception', f'{e}')
+                result_dict = {'exception': f'{e}', 'file':__file__, 'function':'_request'}
+
+        return result_dict
+
+    def _iter_request( self,
+                        input_json_string , # json-serialized input dictionary
+                        url,                # url to which the data will be sent
+                        METHOD_OBJECT,      # an object that contains "_check..." methods
+                        chunk_size = 1 << 16,
+                        CHECKS = False ):   # indicate whether format/content checking should be done
+        '''
+        Common method used to send data packet to the requested url,
+        and then incrementally parse the reply, yielding (key, value) pairs
+        '''
         try:
             # If desired, do checks on the input format
             if CHECKS:
                 METHOD_OBJECT._check_json_from_client(input_json_string)
 
-            # Send request to the above URL
-            r = requests.put(url, data=input_json_string )
-            
-            # Decode the reply
-            decoded_content = r._content.decode()
+            # Send request, but do not read the reply yet
+            r = self._put(url, input_json_string, stream=True)
+            try:
+                # Parse the reply as it arrives (iter_content decompresses if necessary)
+                for key, value in json_stream.iter_object_items(r.iter_content(chunk_size=chunk_size)):
+                    yield key, value
+            finally:
+                r.close()
 
-            # Turn the reply into a dictionary
-            result_dict = json.loads(decoded_content)
+        except Exception as e:
+            yield 'exception', f'{e}'
 
-            # If desired, check the returned data is as expected
-            if CHECKS:
-                METHOD_OBJECT._check_data_format_from_server(result_dict)
+    def _put(self, url, input_json_string, stream=False):
+        '''
+        http-put the json-string to the url, compressing it if requested
+         - applies any retry / hedging policies
+         - stream : do not read the body of the reply yet (see requests' stream argument)
+        '''
+        with tracer.span('Remote._put', kind='client', attributes={'url': url}) as span:
+            data, headers = input_json_string.encode(), tracing.inject({})
+            if self.request_encoding not in (None, '', 'identity') and len(data) >= compression.min_compress_bytes:
+                data = compression.compress(data, self.request_encoding)
+                headers['Content-Encoding'] = self.request_encoding
+            span.set_attribute('request_bytes', len(data))
+            r = self._put_with_policies(url, data, headers, stream)
+            span.set_attribute('http.status_code', r.status_code)
+            return r
 
-        except Exception as e:
-            result_dict = {'exception': f'{e}', 'file':__file__, 'function':'_request'}
+    def _put_with_policies(self, url, data, headers, stream=False):
+        ''' http-put the (encoded) data, applying any retry / hedging policies (to idempotent requests) '''
+        if (self.retry is None and self.hedge is None) or not self._is_idempotent(url):
+            return self.session.put(url, data=data, headers=headers, timeout=self.timeout, stream=stream)
+        import requests     # (already imported by the session)
+
+        # Each request earns a fraction of a retry/hedge
+        self.retry_budget.deposit()
+        urls = self._alternative_urls(url)
+        max_attempts = self.retry.max_attempts if self.retry is not None else 1
+        attempt = 0
+        while True:
+            # Rotate through the backends on successive attempts
+            urls_this_attempt = urls[attempt % len(urls):] + urls[:attempt % len(urls)]
+            try:
+                if self.hedge is not None:
+                    r = self._hedged_put(urls_this_attempt, data, headers, stream)
+                else:
+                    r = self._timed_put(urls_this_attempt[0], data, headers, stream)
+                if self.retry is None or r.status_code not in self.retry.retryable_status_codes:
+                    return r
+                failure = None
+            except (requests.ConnectionError, requests.Timeout) as e:
+                failure = e
+
+            # Retry (if allowed) after backing off
+            attempt += 1
+            if attempt >= max_attempts or not self.retry_budget.withdraw():
+                if failure is not None:
+                    raise failure
+                return r
+            if failure is None:
+                r.close()
+            time.sleep(self.retry.backoff(attempt))
+
+    def _is_idempotent(self, url):
+        ''' whether the request is to one of the idempotent_scripts (& so can be retried / hedged) '''
+        script = url.rstrip('/').rsplit('/', 1)[-1]
+        if url.startswith(self.base_url.rstrip('/') + '/'):
+            script = url[len(self.base_url.rstrip('/')) + 1:].split('/', 1)[0]
+        return script.removesuffix('.cgi') in self.idempotent_scripts
+
+    def _alternative_urls(self, url):
+        ''' the url, followed by the equivalent urls on any backup backends '''
+        urls = [url]
+        if url.startswith(self.base_url.rstrip('/') + '/'):
+            script = url[len(self.base_url.rstrip('/')) + 1:]
+            urls += [base.rstrip('/') + '/' + script for base in self.backup_base_urls]
+        return urls
+
+    def _timed_put(self, url, data, headers, stream=False):
+        ''' http-put, recording the latency of successful requests (used to set the hedging threshold) '''
+        start = time.monotonic()
+        r = self.session.put(url, data=data, headers=headers, timeout=self.timeout, stream=stream)
+        if self.hedge is not None:
+            self.hedge.latencies.record(time.monotonic() - start)
+        return r
 
+    def _hedged_put(self, urls, data, headers, stream=False):
+        '''
+        http-put to urls[0] : if no reply within the hedging threshold (and the
+        retry-budget allows it), send a duplicate to the next url (or the same
+        url if there is only one) & use whichever reply arrives first
+         - NB: the losing request cannot be cancelled: its reply is closed (when it
+           arrives) & discarded, so that its connection goes back to the pool
+        '''
+        executor = ThreadPoolExecutor(max_workers=2)
+        try:
+            primary = executor.submit(self._timed_put, urls[0], data, headers, stream)
+            done, _ = wait([primary], timeout=self.hedge.delay())
+            if done or not self.retry_budget.withdraw():
+                return primary.result()
+
+            hedge   = executor.submit(self._timed_put, urls[1 % len(urls)], data, headers, stream)
+            pending = {primary, hedge}
+            while True:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is None:
+                        (hedge if future is primary else primary).add_done_callback(self._close_reply)
+                        return future.result()
+                if not pending:
+                    # both failed : raise the exception
+                    return done.pop().result()
+        finally:
+            executor.shutdown(wait=False)
+
+    @staticmethod
+    def _close_reply(future):
+        ''' close the (unwanted) reply of a finished request, if there is one '''
+        if future.exception() is None:
+            future.result().close()
+
+    def _request_many( self,
+                        input_dict,             # dictionary with designations as keys
+                        url,                    # url to which the data will be sent
+                        METHOD_OBJECT,          # an object that contains "_check..." methods
+                        request_type = None,    # used to key the cache (no caching if None)
+                        max_workers = None,     # max number of concurrent requests
+                        max_designations = None,# max designations per request
+                        max_bytes = None ):     # (approx) max json-bytes per request
+        '''
+        Common method used to split a large dictionary into chunks, send
+        them concurrently, and merge the results back together
+
+        If we have a cache, designations with cached results are not sent
+        '''
+        kwargs = {'max_workers':max_workers, 'max_designations':max_designations, 'max_bytes':max_bytes}
+        if self.cache is None or request_type is None:
+            return self._send_many(input_dict, url, METHOD_OBJECT, **kwargs)
+
+        # Look up each designation in the cache
+        keys            = {desig: self.cache.key(request_type, desig, value) for desig, value in input_dict.items()}
+        fresh, stale    = self.cache.get_many(keys.values())
+
+        # Stale entries can be used if the server is still producing the same version of results
+        version = self._result_version() if len(fresh) < len(keys) else None
+        revalidated = [key for key, (_, v) in stale.items() if v is not None and v == version]
+        self.cache.refresh(revalidated)
+        fresh.update({key: stale[key][0] for key in revalidated})
+
+        # Send whatever is left & store the new results
+        cached      = {desig: fresh[key] for desig, key in keys.items() if key in fresh}
+        to_send     = {desig: value for desig, value in input_dict.items() if desig not in cached}
+        reply       = self._send_many(to_send, url, METHOD_OBJECT, **kwargs) if to_send else {'results':{}, 'errors':[]}
+        self.cache.put_many({keys[desig]: reply['results'][desig] for desig in to_send if desig in reply['results']}, version)
+
+        reply['results'].update(cached)
+        return reply
+
+    def _send_many( self,
+                    input_dict,
+                    url,
+                    METHOD_OBJECT,
+                    max_workers = None,
+                    max_designations = None,
+                    max_bytes = None ):
+        '''
+        chunk, send & merge : see _request_many
+         - with a limiter, it (rather than max_workers) decides how many chunks are in flight
+        '''
+        chunks      = self._chunk_json(input_dict, max_designations, max_bytes)
+        if self.limiter is None:
+            max_workers = max_workers if max_workers is not None else self.max_workers
+            send        = self._request
+        else:
+            max_workers = max(1, min(len(chunks), self.limiter.max_limit))
+            send        = self._limited_request
+
+        results, errors = {}, []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [ (desigs, executor.submit(send, chunk_json, url, METHOD_OBJECT))
+                        for desigs, chunk_json in chunks ]
+            for desigs, future in futures:
+                result_dict = future.result()
+                if 'exception' in result_dict:
+                    errors.append({'designations': desigs, **result_dict})
+                else:
+                    results.update(result_dict)
+
+        return {'results': results, 'errors': errors}
+
+    def _limited_request(self, input_json_string, url, METHOD_OBJECT):
+        ''' _request, once the limiter has a free slot : a failed request counts as a rejection '''
+        with self.limiter.slot(key=url) as slot:
+            result_dict = self._request(input_json_string, url, METHOD_OBJECT)
+            slot.dropped = 'exception' in result_dict
         return result_dict
+
+    def _result_version(self,):
+        '''
+        Ask the server (gateway) which version of results it is currently producing
+         - Conditional request: if the version is unchanged the server replies "304 Not Modified"
+         - Returns None if the server cannot tell us (e.g. the cgi-scripts have no such endpoint),
+           or does not reply in time, in which case the stale results are fetched afresh
+        '''
+        headers = {'If-None-Match': self._version_etag} if self._version_etag else {}
+        try:
+            r = self.session.get(self._url("remote_version"), headers=headers,
+                                 timeout=self.timeout if self.timeout is not None else self.default_version_timeout)
+            if r.status_code == 200:
+                self._version       = r.json()['result_version']
+                self._version_etag  = r.headers.get('ETag')
+            elif r.status_code != 304:
+                self._version, self._version_etag = None, None
+        except Exception as e:
+            self._version, self._version_etag = None, None
+        return self._version
+
+    def _chunk_json(self, input_dict, max_designations=None, max_bytes=None):
+        '''
+        Split a dictionary (with designations as keys) into json-strings of a sensible size
+         - Each designation is json-encoded only once
+
+        returns
+        -------
+        list of (list-of-designations, json-string) tuples
+        '''
+        max_designations    = max_designations if max_designations is not None else self.default_chunk_designations
+        max_bytes           = max_bytes if max_bytes is not None else self.default_chunk_bytes
+
+        # NB: n_bytes counts the enclosing braces & the separators between parts
+        chunks, desigs, parts, n_bytes = [], [], [], 2
+        for desig, value in input_dict.items():
+            part = json.dumps(desig) + ': ' + json.dumps(value)
+            if desigs and (len(desigs) >= max_designations or n_bytes + 2 + len(part) > max_bytes):
+                chunks.append( (desigs, '{' + ', '.join(parts) + '}') )
+                desigs, parts, n_bytes = [], [], 2
+            desigs.append(desig)
+            parts.append(part)
+            n_bytes += len(part) + (2 if len(parts) > 1 else 0)
+        if desigs:
+            chunks.append( (desigs, '{' + ', '.join(parts) + '}') )
+        return chunks
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+'''
+    --------------------------------------------------------------
+    Client-side persistent cache of results returned via remote.Remote
+
+    Remote consumers often re-request orbit-extensions for inputs that have
+    not changed since the last time they asked. The results are a function
+    of (request-type, input-data, version-of-the-orbit-pipeline), so they
+    can be cached locally, keyed on a canonical hash of the first two, and
+    labelled with the last.
+
+    Entries are
+     - "fresh" for ttl seconds: used without touching the network
+     - "stale" after that: used only if the server confirms that the
+       result-version is unchanged (see Remote._result_version)
+     - evicted after max_age seconds, or when the cache exceeds max_bytes
+       (least-recently-used first)
+
+    Expected usage:
+    ----------------
+    R = remote.Remote(cache=remote_cache.ResultCache())
+    R.request_orbit_extension_many(supplied_dict)
+    --------------------------------------------------------------
+'''
+
+
+# Import third-party packages
+# --------------------------------------------------------------
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class ResultCache():
+    '''
+    sqlite-backed cache of per-designation results
+    '''
+
+    default_path        = os.path.join(os.path.expanduser('~'), '.mpc_remote_cache.sqlite')
+    default_ttl         = 24 * 3600
+    default_max_age     = 7 * 24 * 3600
+    default_max_bytes   = 512 * 2**20
+
+    def __init__(self, path=None, ttl=None, max_age=None, max_bytes=None):
+        '''
+        path        : sqlite file to use (":memory:" for a non-persistent cache)
+        ttl         : seconds for which an entry is used without revalidation
+        max_age     : seconds after which an entry is evicted
+        max_bytes   : max total size of the cached results
+        '''
+        self.path       = path if path is not None else self.default_path
+        self.ttl        = ttl if ttl is not None else self.default_ttl
+        self.max_age    = max_age if max_age is not None else self.default_max_age
+        self.max_bytes  = max_bytes if max_bytes is not None else self.default_max_bytes
+
+        # A single connection, shared between threads (& guarded by a lock)
+        self._lock  = threading.Lock()
+        self._db    = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS results (
+                                key     TEXT PRIMARY KEY,
+                                value   TEXT,
+                                version TEXT,
+                                stored  REAL,
+                                used    REAL,
+                                size    INTEGER)''')
+        self._db.commit()
+
+    @staticmethod
+    def key(request_type, desig, input_value):
+        ''' canonical hash of the request-type & the input for a single designation '''
+        canonical = json.dumps([request_type, desig, input_value], sort_keys=True, separators=(',',':'))
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def get_many(self, keys):
+        '''
+        look up cached results
+        returns
+        -------
+        fresh : dict {key: result} of entries that can be used as-is
+        stale : dict {key: (result, version)} of entries that need revalidating
+        '''
+        now, fresh, stale = time.time(), {}, {}
+        with self._lock:
+            for key in keys:
+                row = self._db.execute('SELECT value, version, stored FROM results WHERE key=?', (key,)).fetchone()
+                if row is None or now - row[2] > self.max_age:
+                    continue
+                if now - row[2] <= self.ttl:
+                    fresh[key] = json.loads(row[0])
+                else:
+                    stale[key] = (json.loads(row[0]), row[1])
+            self._db.executemany('UPDATE results SET used=? WHERE key=?',
+                                 [(now, key) for key in list(fresh) + list(stale)])
+            self._db.commit()
+        return fresh, stale
+
+    def put_many(self, results, version=None):
+        ''' store results : dict {key: result} (all computed with the given result-version) '''
+        now = time.time()
+        rows = []
+        for key, result in results.items():
+            value = json.dumps(result)
+            rows.append( (key, value, version, now, now, len(value)) )
+        with self._lock:
+            self._db.executemany('INSERT OR REPLACE INTO results VALUES (?,?,?,?,?,?)', rows)
+            self._db.commit()
+        self.evict()
+
+    def refresh(self, keys):
+        ''' mark entries as fresh again (i.e. after they have been revalidated) '''
+        now = time.time()
+        with self._lock:
+            self._db.executemany('UPDATE results SET stored=?, used=? WHERE key=?',
+                                 [(now, now, key) for key in keys])
+            self._db.commit()
+
+    def evict(self,):
+        ''' remove entries older than max_age, then least-recently-used entries until under max_bytes '''
+        with self._lock:
+            self._db.execute('DELETE FROM results WHERE stored < ?', (time.time() - self.max_age,))
+            total = self._db.execute('SELECT COALESCE(SUM(size),0) FROM results').fetchone()[0]
+            if total > self.max_bytes:
+                excess = total - self.max_bytes
+                doomed, freed = [], 0
+                for key, size in self._db.execute('SELECT key, size FROM results ORDER BY used'):
+                    if freed >= excess:
+                        break
+                    doomed.append((key,))
+                    freed += size
+                self._db.executemany('DELETE FROM results WHERE key=?', doomed)
+            self._db.commit()
+
+    def __len__(self,):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+    def close(self,):
+        with self._lock:
+            self._db.close()
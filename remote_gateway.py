@@ -0,0 +1,507 @@
+# -*- coding: utf-8 -*-
+
+'''
+    --------------------------------------------------------------
+    Persistent gateway to replace the per-request remote_*.cgi scripts
+
+    Every remote_*.cgi hit starts a new python interpreter, imports
+    remote_general & sockets_class, and opens a new TCP connection to the
+    compute server before it does any work.
+
+    This module provides a long-running WSGI application that exposes the
+    same endpoints (remote_test, remote_orbfit, remote_iod, ...) with the
+    same JSON contract as remote_general.process_cgi_string, but which
+    keeps a pool of open connections to the compute server and services
+    concurrent requests on separate threads.
+
+    Pass-through mode (passthrough=True) avoids re-encoding the data:
+    the raw json bytes are forwarded to the server (with the request type in
+    the frame header) after only a light structural check, and the server's
+    json-encoded reply bytes are streamed straight back to the http caller.
+    This requires the compute server to be running a version of
+    sockets_class that understands framed json messages.
+
+    Micro-batching (batch_window=...) collects concurrent small orbfit requests
+    for a short time-window (or up to a maximum number of designations) and
+    sends them to the server as a single multi-designation request, splitting
+    the reply back out to the individual callers. (Not used in pass-through
+    mode, as it needs the requests to be decoded.)
+
+    The "remote_version" endpoint reports the version of the results being
+    produced (see result_version), and supports conditional requests
+    (If-None-Match), so that clients can cheaply revalidate cached results
+    (see remote_cache.py)
+
+    Adaptive concurrency (limiter=True, see request_policies.AdaptiveLimiter):
+    the number of requests in flight to the compute server adapts to its
+    latency & rejections (up to max_connections), & the "remote_metrics"
+    endpoint reports the current limit
+
+    Asynchronous jobs (job_store=..., see remote_jobs.py):
+     - PUT .../remote_submit/remote_orbfit (etc) returns {'job_id': ...} immediately
+     - GET .../remote_job/<job_id>?wait=<seconds> returns the job status & (partial) results
+
+    Request & response bodies may be compressed (see compression.py):
+    requests with a Content-Encoding header are decompressed as they are
+    read, and responses are compressed if the caller sends Accept-Encoding
+
+    Expected usage:
+    ----------------
+    (i)  stand-alone (see deploy_gateway.py)
+    $ python3 deploy_gateway.py
+    (ii) under any WSGI container (mod_wsgi, gunicorn, ...)
+    using the module-level "application" object
+
+    The endpoints can be called either with or without the ".cgi" suffix, so
+    remote.Remote can be pointed at the gateway without any other change
+    E.g. http://<gateway>/remote_test  or  http://<gateway>/remote_test.cgi
+    --------------------------------------------------------------
+'''
+
+
+# Import third-party packages
+# --------------------------------------------------------------
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+import urllib.parse
+from concurrent.futures import Future, ThreadPoolExecutor
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+
+# Import neighboring packages
+# --------------------------------------------------------------
+import sockets_class as sc
+import remote_general as rg
+import compression
+import remote_jobs
+import tracing
+
+# Spans of the gateway's handling of each request (see tracing)
+tracer = tracing.get_tracer('remote_gateway')
+
+
+# WSGI application
+# --------------------------------------------------------------
+class Gateway():
+    '''
+    WSGI application routing remote requests through to the socket-server(s)
+
+    A single instance is shared by all requests, so the pool of
+    connections to the compute server persists between requests
+    '''
+
+    # Version of the results being produced : to be changed whenever the
+    # orbit-fitting code on the compute server changes
+    default_result_version = os.environ.get('MPC_RESULT_VERSION', '1')
+
+    # Longest time a caller can long-poll for a job
+    max_job_wait = 60
+
+    # Largest (decompressed) request body accepted
+    default_max_request_bytes = 64 * 1024 * 1024
+
+    def __init__(self, host=None, port=None, max_connections=None, passthrough=False,
+                        batch_window=None, max_batch_size=None, result_version=None,
+                        job_store=None, result_ttl=None, limiter=None, max_request_bytes=None):
+        '''
+        specify the host & port of the compute server on initialization
+        passthrough     : forward the raw json bytes rather than decoding & re-encoding them
+        batch_window    : if set, micro-batch orbfit requests arriving within this many seconds
+        max_batch_size  : max number of designations in a micro-batch (see MicroBatcher)
+        result_version  : version of results reported by the remote_version endpoint
+        job_store       : path of the sqlite file used for asynchronous jobs (None : no jobs)
+        result_ttl      : seconds for which the results of finished jobs are kept
+        limiter         : adapt the number of requests in flight (see sockets_class.ClientPool)
+        max_request_bytes : larger (decompressed) request bodies are rejected with "413 Payload Too Large"
+        '''
+        self.pool = sc.ClientPool(host=host, port=port, max_connections=max_connections, limiter=limiter)
+        self.passthrough = passthrough
+        self.result_version = result_version if result_version is not None else self.default_result_version
+        self.max_request_bytes = max_request_bytes if max_request_bytes is not None else self.default_max_request_bytes
+
+        # The batcher looks like a client, so can be handed straight to process_cgi_string
+        self.client = self.pool if batch_window is None else \
+            MicroBatcher(self.pool, window=batch_window, max_batch_size=max_batch_size)
+
+        # Asynchronous jobs : any left unfinished by a previous gateway are resumed
+        self.jobs = None
+        if job_store is not None:
+            self.jobs = remote_jobs.JobRunner(self.client, remote_jobs.JobStore(job_store), result_ttl=result_ttl)
+            self.jobs.resume()
+
+    def __call__(self, environ, start_response):
+        ''' WSGI entry point : continues the caller's trace (from the traceparent header), if any '''
+        with tracer.span('Gateway', kind='server', parent=environ.get('HTTP_TRACEPARENT'),
+                         attributes={'http.method': environ.get('REQUEST_METHOD', ''),
+                                     'http.path': environ.get('PATH_INFO', '')}):
+            return self._route(environ, start_response)
+
+    def _route(self, environ, start_response):
+        ''' call the appropriate endpoint '''
+
+        # Which endpoint was called?
+        path = environ.get('PATH_INFO', '').rstrip('/').split('/')
+        if path[-1] == 'remote_version':
+            return self.version(environ, start_response)
+        if path[-1] == 'remote_metrics':
+            return self._respond(environ, start_response, '200 OK', self.metrics())
+        if len(path) > 1 and path[-2] == 'remote_job':
+            return self.job_status(environ, start_response, path[-1])
+        calling_file = self._calling_file(environ)
+        if calling_file is None:
+            result_dict = { 'exception':f"unknown endpoint {environ.get('PATH_INFO','')}", 'file':__file__}
+            return self._respond(environ, start_response, '404 Not Found', result_dict)
+
+        # Read (& if necessary decompress) the request
+        try:
+            input_bytes = self._read_body(environ)
+        except OverflowError as e :
+            result_dict = { 'exception':f'{e}' , 'file':__file__, 'calling_file':calling_file}
+            return self._respond(environ, start_response, '413 Payload Too Large', result_dict)
+        except Exception as e :
+            result_dict = { 'exception':f'{e}' , 'file':__file__, 'calling_file':calling_file}
+            return self._respond(environ, start_response, '400 Bad Request', result_dict)
+
+        # Route the supplied data through to the socket-server
+        if len(path) > 1 and path[-2] == 'remote_submit':
+            return self.job_submit(environ, start_response, input_bytes, calling_file)
+        if self.passthrough and input_bytes:
+            return self.process_passthrough(environ, start_response, input_bytes, calling_file)
+        result_dict = self.process(input_bytes, calling_file)
+        return self._respond(environ, start_response, '200 OK', result_dict)
+
+    def process(self, input_bytes, calling_file):
+        '''
+        Equivalent of what the remote_*.cgi scripts do with their stdin
+         - Returns a result-dictionary in the same format as the cgi scripts
+        '''
+        # Set up a default result-dictionary that will be used when no meaningful input is supplied
+        result_dict = {'No Usable Input': True , 'file': calling_file }
+        try:
+            if input_bytes:
+                result_dict = rg.process_cgi_string(input_bytes.decode(), calling_file, client=self.client)
+        except Exception as e :
+            result_dict = {   'exception':f'{e}' , 'file': __file__ }
+        return result_dict
+
+    def process_passthrough(self, environ, start_response, input_bytes, calling_file):
+        '''
+        Forward the raw json bytes to the socket-server & stream the reply bytes back
+         - Errors are reported in a dictionary, in the same way as for process()
+        '''
+        try:
+            rg.check_json_bytes(input_bytes)
+            request_type = rg.allowed_calling_scripts[calling_file]
+            reply = self.pool.connect_raw(request_type, input_bytes)
+        except Exception as e :
+            result_dict = { 'exception':f'{e}' , 'file':__file__, 'calling_file':calling_file}
+            return self._respond(environ, start_response, '200 OK', result_dict)
+
+        # The reply is an iterable that reads from the socket as the WSGI server writes to the caller
+        # - If compressing, we compress on the fly (so do not know the final length)
+        encoding = self._response_encoding(environ, reply.length)
+        if encoding is None:
+            start_response('200 OK', [('Content-Type', 'text/plain'),
+                                      ('Content-Length', str(reply.length))])
+            return reply
+        start_response('200 OK', [('Content-Type', 'text/plain'),
+                                  ('Content-Encoding', encoding),
+                                  ('Vary', 'Accept-Encoding')])
+        return compression.CompressingIterable(reply, encoding)
+
+    def job_submit(self, environ, start_response, input_bytes, calling_file):
+        ''' start an asynchronous job : replies with the job_id '''
+        try:
+            assert self.jobs is not None, 'asynchronous jobs are not enabled on this gateway'
+            request_type = rg.allowed_calling_scripts[calling_file]
+            result_dict = {'job_id': self.jobs.submit(request_type, json.loads(input_bytes))}
+            status = '202 Accepted'
+        except Exception as e :
+            result_dict = { 'exception':f'{e}' , 'file':__file__, 'calling_file':calling_file}
+            status = '200 OK'
+        return self._respond(environ, start_response, status, result_dict)
+
+    def job_status(self, environ, start_response, job_id):
+        ''' status & (partial) results of a job, optionally long-polling with ?wait=<seconds> '''
+        try:
+            assert self.jobs is not None, 'asynchronous jobs are not enabled on this gateway'
+            query = urllib.parse.parse_qs(environ.get('QUERY_STRING', ''))
+            wait = min(self.max_job_wait, float(query.get('wait', ['0'])[0]))
+            result_dict = self.jobs.status(job_id, wait=wait)
+            if result_dict is None:
+                result_dict = {'exception': f'no such job {job_id}', 'file':__file__}
+                return self._respond(environ, start_response, '404 Not Found', result_dict)
+        except Exception as e :
+            result_dict = { 'exception':f'{e}' , 'file':__file__}
+        return self._respond(environ, start_response, '200 OK', result_dict)
+
+    def version(self, environ, start_response):
+        ''' report the result-version : "304 Not Modified" if the caller already has it '''
+        etag = '"%s"' % self.result_version
+        if_none_match = [tag.strip() for tag in environ.get('HTTP_IF_NONE_MATCH', '').split(',')]
+        if etag in if_none_match or '*' in if_none_match:
+            start_response('304 Not Modified', [('ETag', etag)])
+            return [b'']
+        body = json.dumps({'result_version': self.result_version}).encode()
+        start_response('200 OK', [('Content-Type', 'text/plain'),
+                                  ('Content-Length', str(len(body))),
+                                  ('ETag', etag)])
+        return [body]
+
+    def metrics(self,):
+        ''' the current state of the connections to the compute server '''
+        limiter = self.pool.limiter
+        return {'max_connections'   : self.pool.max_connections,
+                'concurrency'       : limiter.metrics() if limiter is not None else None}
+
+    @staticmethod
+    def _calling_file(environ):
+        '''
+        Map the requested path onto one of the allowed calling scripts
+        E.g. "/remote_test" -> "remote_test.cgi"
+        '''
+        endpoint = os.path.basename(environ.get('PATH_INFO', '').rstrip('/'))
+        if not endpoint.endswith('.cgi'):
+            endpoint += '.cgi'
+        return endpoint if endpoint in rg.allowed_calling_scripts else None
+
+    # Size of the pieces in which a request body is read
+    read_chunk_size = 1 << 16
+
+    def _read_body(self, environ):
+        '''
+        read the body of the request (as bytes)
+         - a compressed body is decompressed chunk-by-chunk as it is read, so only
+           the decompressed body is ever held in memory in full
+         - raises OverflowError if the (decompressed) body is larger than max_request_bytes :
+           we never inflate more than one byte past the limit, so a small, highly
+           compressed body cannot exhaust the memory
+        '''
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        encoding = environ.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+        assert compression.is_supported(encoding), f'unsupported Content-Encoding {encoding}'
+        if length <= 0:
+            return b''
+        too_large = f'request body larger than {self.max_request_bytes} bytes'
+        if encoding in ('', 'identity'):
+            if length > self.max_request_bytes:
+                raise OverflowError(too_large)
+            return environ['wsgi.input'].read(length)
+
+        decompressor, body = compression.decompressor(encoding), bytearray()
+        while length > 0:
+            chunk = environ['wsgi.input'].read(min(self.read_chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            # Anything beyond max_length is left in unconsumed_tail (NB: max_length is always >= 1, as 0 means no limit)
+            while chunk:
+                body += decompressor.decompress(chunk, self.max_request_bytes + 1 - len(body))
+                if len(body) > self.max_request_bytes:
+                    raise OverflowError(too_large)
+                chunk = decompressor.unconsumed_tail
+        body += decompressor.flush(self.max_request_bytes + 1 - len(body))
+        if len(body) > self.max_request_bytes:
+            raise OverflowError(too_large)
+        return body
+
+    @staticmethod
+    def _response_encoding(environ, length):
+        ''' how (if at all) should a response of the given length be compressed? '''
+        if length < compression.min_compress_bytes:
+            return None
+        return compression.choose_encoding(environ.get('HTTP_ACCEPT_ENCODING'))
+
+    def _respond(self, environ, start_response, status, result_dict):
+        ''' json-encode (& maybe compress) the result & return it to the caller '''
+        body = json.dumps(result_dict).encode()
+        headers = [('Content-Type', 'text/plain')]
+        encoding = self._response_encoding(environ, len(body))
+        if encoding is not None:
+            body = compression.compress(body, encoding)
+            headers += [('Content-Encoding', encoding), ('Vary', 'Accept-Encoding')]
+        start_response(status, headers + [('Content-Length', str(len(body)))])
+        return [body]
+
+
+# Micro-batching
+# --------------------------------------------------------------
+class MicroBatcher():
+    '''
+    Collects concurrent requests of a given type into multi-designation batches
+
+    Has the same connect(request_dict) interface as sockets_class.Client, so
+    it can be used wherever a client is expected:
+     - requests of the batched type(s) wait for up to "window" seconds for
+       other requests to join them (or until the batch holds "max_batch_size"
+       designations) and are then sent to the server together
+     - requests of any other type are passed straight through to the client
+
+    The reply to a batch is split back out by designation. Any keys in the
+    reply that are not one of the input designations are returned to every
+    caller in the batch.
+
+    If the server fails a batch (no reply, or an 'exception' in the reply),
+    its requests are re-sent one at a time, so that a malformed request only
+    fails its own caller.
+    '''
+
+    default_window          = 0.005
+    default_max_batch_size  = 32
+
+    def __init__(self, client, window=None, max_batch_size=None, request_types=('orbfit',)):
+        self.client         = client
+        self.window         = window if window is not None else self.default_window
+        self.max_batch_size = max_batch_size if max_batch_size is not None else self.default_max_batch_size
+        self.request_types  = request_types
+
+        # Requests waiting to be batched : (request_type, input_dict, future)
+        self._pending   = queue.Queue()
+        self._thread    = None
+        self._lock      = threading.Lock()
+
+        # Batches are sent on separate threads, so that several can be in flight at once
+        max_workers     = getattr(client, 'max_connections', 1)
+        self._executor  = ThreadPoolExecutor(max_workers=max_workers)
+
+    def connect(self, request_dict, VERBOSE = False ):
+        ''' send the request (as part of a batch if possible) & wait for the reply '''
+        request_type, input_dict = self._unwrap(request_dict)
+        if request_type not in self.request_types:
+            return self.client.connect(request_dict)
+
+        future = Future()
+        self._start()
+        self._pending.put((request_type, input_dict, future))
+        return future.result()
+
+    @staticmethod
+    def _unwrap(request_dict):
+        ''' request_dict is expected to look like {request_type: input_dict} '''
+        if isinstance(request_dict, dict) and len(request_dict) == 1:
+            request_type, input_dict = next(iter(request_dict.items()))
+            if isinstance(input_dict, dict):
+                return request_type, input_dict
+        return None, None
+
+    def _start(self,):
+        ''' start the collecting thread (once) '''
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._collect, daemon=True)
+                    self._thread.start()
+
+    def _collect(self,):
+        ''' loop forever : gather requests into batches & hand them off to be sent '''
+        while True:
+            batch = [self._pending.get()]
+            size = len(batch[0][1])
+            deadline = time.monotonic() + self.window
+            while size < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+                size += len(batch[-1][1])
+
+            for sub_batch in self._split(batch):
+                self._executor.submit(self._dispatch, sub_batch)
+
+    @staticmethod
+    def _split(batch):
+        '''
+        split a batch into sub-batches that can each be sent as one request:
+        all requests in a sub-batch are of the same type & have no designations in common
+        '''
+        sub_batches = []
+        for item in batch:
+            request_type, input_dict, _ = item
+            for sub in sub_batches:
+                if sub['request_type'] == request_type and sub['desigs'].isdisjoint(input_dict):
+                    break
+            else:
+                sub = {'request_type':request_type, 'desigs':set(), 'items':[]}
+                sub_batches.append(sub)
+            sub['desigs'].update(input_dict)
+            sub['items'].append(item)
+        return [sub['items'] for sub in sub_batches]
+
+    def _dispatch(self, items):
+        ''' send one (sub-)batch to the server & split the reply back to the callers '''
+        try:
+            request_type = items[0][0]
+            combined = {}
+            for _, input_dict, _ in items:
+                combined.update(input_dict)
+
+            try:
+                reply_dict = self.client.connect({request_type: combined})
+            except Exception:
+                if len(items) == 1:
+                    raise
+                return self._dispatch_individually(items)
+            if 'exception' in reply_dict and 'exception' not in combined and len(items) > 1:
+                return self._dispatch_individually(items)
+
+            # Anything not keyed by an input designation is returned to everyone
+            shared = {k:v for k,v in reply_dict.items() if k not in combined}
+            for _, input_dict, future in items:
+                result_dict = {k:reply_dict[k] for k in input_dict if k in reply_dict}
+                result_dict.update(shared)
+                future.set_result(result_dict)
+
+        except Exception as e:
+            for _, _, future in items:
+                if not future.done():
+                    future.set_exception(e)
+
+    def _dispatch_individually(self, items):
+        ''' a batch failed : send each of its requests on its own, so only the bad one(s) fail '''
+        for request_type, input_dict, future in items:
+            try:
+                future.set_result(self.client.connect({request_type: input_dict}))
+            except Exception as e:
+                future.set_exception(e)
+
+
+# Stand-alone server
+# --------------------------------------------------------------
+class ThreadingWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    ''' WSGIServer that handles each request on its own thread '''
+    daemon_threads = True
+
+
+class QuietWSGIRequestHandler(WSGIRequestHandler):
+    ''' Do not write a line to stderr for every request '''
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host='', port=8080, server_host=None, server_port=None, **kwargs):
+    '''
+    Run the gateway as a stand-alone (threaded) http server
+    host, port                  : where the gateway listens for http requests
+    server_host, server_port    : where the compute socket-server is listening
+    kwargs                      : passed on to Gateway (max_connections, passthrough, ...)
+    '''
+    app = Gateway(host=server_host, port=server_port, **kwargs)
+    httpd = make_server(host, port, app,
+                        server_class=ThreadingWSGIServer,
+                        handler_class=QuietWSGIRequestHandler)
+    print(f'\nGateway is listening on port {port}...')
+    httpd.serve_forever()
+
+
+# Module-level application for WSGI containers
+# NB: Connections are only opened when the first request arrives
+application = Gateway()
@@ -23,6 +23,10 @@ import os
 # Local imports
 # -------------------
 import sockets_class as sc
+import tracing
+
+# Spans of the routing stage (see tracing)
+tracer = tracing.get_tracer('remote_general')
 
 # Dict to map allowed calling script to ...
 allowed_calling_scripts = {
@@ -31,8 +35,24 @@ allowed_calling_scripts = {
     'remote_orbfit.cgi'  : 'orbfit' ,
 }
 
-def process_cgi_string(input_str, calling_file):
-    
+def process_cgi_string(input_str, calling_file, client=None):
+    '''
+    Route the json-string supplied to a remote_*.cgi script (or to the
+    equivalent endpoint of the gateway in remote_gateway.py) through
+    to the appropriate socket-server
+
+    client : optional sockets_class.Client (or ClientPool) to use
+     - if not supplied, a new Client (i.e. a new connection) is used
+
+    Continues the caller's trace : the gateway's current span, or (in a
+    cgi-script) the traceparent http-header, passed on in the environment
+    '''
+    parent = None if tracing.current_span() is not None else os.environ.get('HTTP_TRACEPARENT')
+    with tracer.span('process_cgi_string', kind='server', parent=parent,
+                     attributes={'calling_file': os.path.split(calling_file)[1], 'request_bytes': len(input_str)}):
+        return _process_cgi_string(input_str, calling_file, client=client)
+
+def _process_cgi_string(input_str, calling_file, client=None):
     try:
         # Get the filename from the filepath ...
         calling_file = os.path.split(calling_file)[1]
@@ -47,8 +67,8 @@ def process_cgi_string(input_str, calling_file):
         request_type = allowed_calling_scripts[calling_file]
         request_dict = {request_type:input_dict}
         
-        # instantiate
-        C = sc.Client()
+        # instantiate (unless we have been handed a client to use)
+        C = client if client is not None else sc.Client()
 
         # Call client-connect func with the content from the input dict
         result_dict = C.connect(request_dict)
@@ -57,3 +77,26 @@ def process_cgi_string(input_str, calling_file):
         result_dict = { 'exception':f'{e}' , 'file':__file__, 'calling_file':calling_file}
 
     return result_dict
+
+
+# Whitespace allowed around a json document
+_json_whitespace = b' \t\n\r'
+
+def check_json_bytes(input_bytes):
+    '''
+    Light structural check of json-encoded bytes *without* parsing them
+     - Used by the pass-through path of the gateway (remote_gateway.py),
+       where the full parse is left to the socket-server
+     - Checks that the bytes look like a single json object, {...}
+    '''
+    assert input_bytes, 'No input'
+
+    first = 0
+    while first < len(input_bytes) and input_bytes[first] in _json_whitespace:
+        first += 1
+    last = len(input_bytes) - 1
+    while last > first and input_bytes[last] in _json_whitespace:
+        last -= 1
+
+    assert input_bytes[first:first+1] == b'{' and input_bytes[last:last+1] == b'}', \
+        'input is not a json object'
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+'''
+    --------------------------------------------------------------
+    Asynchronous job-submission for long-running requests
+
+    Long IOD or bulk orbit-extension jobs can take longer than a caller
+    is prepared to (or able to) wait on a single connection. Instead,
+    the caller can submit the job, get a job-ID back immediately, and
+    fetch the result later by polling (or long-polling).
+
+    Jobs are checkpointed designation-by-designation in a sqlite file:
+     - partial results are available while a multi-designation job runs
+     - if the gateway is restarted, unfinished jobs resume from their
+       checkpoint rather than starting over
+     - finished jobs are kept for result_ttl seconds
+
+    Used by the gateway (remote_gateway.py) to provide the endpoints
+     - PUT  .../remote_submit/remote_orbfit  (etc)   -> {'job_id': ...}
+     - GET  .../remote_job/<job_id>?wait=<seconds>   -> job status & results
+    --------------------------------------------------------------
+'''
+
+
+# Import third-party packages
+# --------------------------------------------------------------
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+class JobStore():
+    '''
+    sqlite-backed store of jobs & their per-designation inputs/results
+    '''
+
+    default_path = os.path.join(os.path.expanduser('~'), '.mpc_remote_jobs.sqlite')
+
+    def __init__(self, path=None):
+        self.path   = path if path is not None else self.default_path
+        self._lock  = threading.Lock()
+        self._db    = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                                job_id          TEXT PRIMARY KEY,
+                                request_type    TEXT,
+                                status          TEXT,
+                                error           TEXT,
+                                created         REAL,
+                                expires         REAL)''')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS items (
+                                job_id          TEXT,
+                                seq             INTEGER,
+                                desig           TEXT,
+                                input           TEXT,
+                                result          TEXT,
+                                PRIMARY KEY (job_id, desig))''')
+        self._db.commit()
+
+    def create(self, request_type, input_dict):
+        ''' store a new job : returns the job_id '''
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._db.execute('INSERT INTO jobs VALUES (?,?,?,?,?,?)',
+                             (job_id, request_type, 'queued', None, time.time(), None))
+            self._db.executemany('INSERT INTO items VALUES (?,?,?,?,?)',
+                                 [(job_id, n, desig, json.dumps(value), None)
+                                  for n, (desig, value) in enumerate(input_dict.items())])
+            self._db.commit()
+        return job_id
+
+    def pending(self, job_id):
+        ''' inputs for designations that do not yet have results : dict {desig: input} '''
+        with self._lock:
+            rows = self._db.execute('SELECT desig, input FROM items WHERE job_id=? AND result IS NULL ORDER BY seq',
+                                    (job_id,)).fetchall()
+        return {desig: json.loads(value) for desig, value in rows}
+
+    def save_results(self, job_id, results):
+        ''' checkpoint : dict {desig: result} '''
+        with self._lock:
+            self._db.executemany('UPDATE items SET result=? WHERE job_id=? AND desig=?',
+                                 [(json.dumps(result), job_id, desig) for desig, result in results.items()])
+            self._db.commit()
+
+    def set_status(self, job_id, status, error=None, expires=None):
+        with self._lock:
+            self._db.execute('UPDATE jobs SET status=?, error=?, expires=? WHERE job_id=?',
+                             (status, error, expires, job_id))
+            self._db.commit()
+
+    def get(self, job_id):
+        ''' status & (partial) results of a job : None if there is no such job '''
+        with self._lock:
+            job = self._db.execute('SELECT request_type, status, error FROM jobs WHERE job_id=?', (job_id,)).fetchone()
+            if job is None:
+                return None
+            rows = self._db.execute('SELECT desig, result FROM items WHERE job_id=? ORDER BY seq', (job_id,)).fetchall()
+        results = {desig: json.loads(result) for desig, result in rows if result is not None}
+        status_dict = { 'job_id'        : job_id,
+                        'request_type'  : job[0],
+                        'status'        : job[1],
+                        'n_total'       : len(rows),
+                        'n_done'        : len(results),
+                        'results'       : results}
+        if job[2] is not None:
+            status_dict['error'] = job[2]
+        return status_dict
+
+    def unfinished(self,):
+        ''' (job_id, request_type) of all jobs that were queued or running '''
+        with self._lock:
+            return self._db.execute("SELECT job_id, request_type FROM jobs WHERE status IN ('queued','running') ORDER BY created").fetchall()
+
+    def purge(self,):
+        ''' delete jobs whose results have expired '''
+        with self._lock:
+            expired = [row[0] for row in self._db.execute('SELECT job_id FROM jobs WHERE expires < ?', (time.time(),))]
+            self._db.executemany('DELETE FROM items WHERE job_id=?', [(job_id,) for job_id in expired])
+            self._db.executemany('DELETE FROM jobs WHERE job_id=?', [(job_id,) for job_id in expired])
+            self._db.commit()
+        return len(expired)
+
+
+class JobRunner():
+    '''
+    Runs submitted jobs in the background, a chunk of designations at a time,
+    using a client with the sockets_class.Client connect(request_dict) interface
+    '''
+
+    default_max_workers         = 2
+    default_chunk_designations  = 10
+    default_result_ttl          = 24 * 3600
+
+    def __init__(self, client, store, max_workers=None, chunk_designations=None, result_ttl=None):
+        self.client             = client
+        self.store              = store
+        self.chunk_designations = chunk_designations if chunk_designations is not None else self.default_chunk_designations
+        self.result_ttl         = result_ttl if result_ttl is not None else self.default_result_ttl
+        self._executor          = ThreadPoolExecutor(max_workers=max_workers if max_workers is not None else self.default_max_workers)
+
+        # Notified whenever any job makes progress (used for long-polling)
+        self._progress = threading.Condition()
+
+    def submit(self, request_type, input_dict):
+        ''' store the job & start it in the background : returns the job_id '''
+        assert isinstance(input_dict, dict) and input_dict, 'a job needs a non-empty dictionary of designations'
+        self.store.purge()
+        job_id = self.store.create(request_type, input_dict)
+        self._executor.submit(self._run, job_id, request_type)
+        return job_id
+
+    def resume(self,):
+        ''' restart any jobs that were unfinished (e.g. when the gateway was stopped) '''
+        unfinished = self.store.unfinished()
+        for job_id, request_type in unfinished:
+            self._executor.submit(self._run, job_id, request_type)
+        return len(unfinished)
+
+    def status(self, job_id, wait=0):
+        '''
+        status & (partial) results of a job
+         - wait : long-poll, i.e. wait up to this many seconds for the job to finish
+        '''
+        deadline = time.monotonic() + wait
+        with self._progress:
+            while True:
+                status_dict = self.store.get(job_id)
+                remaining = deadline - time.monotonic()
+                if status_dict is None or status_dict['status'] in ('done', 'failed') or remaining <= 0:
+                    return status_dict
+                self._progress.wait(remaining)
+
+    def _run(self, job_id, request_type):
+        ''' work through the designations without results, checkpointing after each chunk '''
+        try:
+            self.store.set_status(job_id, 'running')
+            pending = list(self.store.pending(job_id).items())
+            for i in range(0, len(pending), self.chunk_designations):
+                chunk = dict(pending[i:i + self.chunk_designations])
+                reply_dict = self.client.connect({request_type: chunk})
+                assert isinstance(reply_dict, dict), f'unexpected reply {reply_dict!r}'
+
+                # Designations missing from the reply get whatever else was returned (e.g. an exception)
+                shared = {k:v for k,v in reply_dict.items() if k not in chunk} or {'exception':'no result returned'}
+                self.store.save_results(job_id, {desig: reply_dict.get(desig, shared) for desig in chunk})
+                self._notify()
+
+            self.store.set_status(job_id, 'done', expires=time.time() + self.result_ttl)
+        except Exception as e:
+            self.store.set_status(job_id, 'failed', error=f'{e}', expires=time.time() + self.result_ttl)
+        self._notify()
+
+    def _notify(self,):
+        with self._progress:
+            self._progress.notify_all()
@@ -19,7 +19,6 @@ result_dict = {'No Usable Input': True , 'file': __file__ }
 
 try:
   import sys
-  import cgi
   import json
   import remote_general as rg
 
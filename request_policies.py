@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+
+'''
+    --------------------------------------------------------------
+    Policies controlling how remote.Remote sends its requests
+    when backends are slow or failing
+
+    (i)  RetryPolicy  : exponential back-off (with "full jitter") between
+                        attempts, up to a maximum number of attempts
+    (ii) HedgePolicy  : if no reply has arrived within a latency-percentile
+                        threshold, send a duplicate request (to another
+                        backend if there is one) and use whichever reply
+                        arrives first
+    (iii) RetryBudget : retries & hedges are only allowed while they are a
+                        small fraction of all requests, so that neither can
+                        amplify an overload
+    (iv) AdaptiveLimiter : the number of requests in flight adapts (AIMD) to
+                        the observed latency & rejections, settling at the
+                        highest concurrency that keeps latency flat (used by
+                        Remote's *_many methods & sockets_class.ClientPool)
+
+    Expected usage:
+    ----------------
+    R = remote.Remote(  backup_base_urls = [...],
+                        retry = request_policies.RetryPolicy(),
+                        hedge = request_policies.HedgePolicy(),
+                        limiter = request_policies.AdaptiveLimiter())
+    --------------------------------------------------------------
+'''
+
+
+# Import third-party packages
+# --------------------------------------------------------------
+import collections
+import random
+import threading
+import time
+
+
+class LatencyTracker():
+    '''
+    Keeps a moving window of observed latencies (seconds)
+    '''
+
+    def __init__(self, window=1000, min_samples=20):
+        self.min_samples    = min_samples
+        self._latencies     = collections.deque(maxlen=window)
+        self._lock          = threading.Lock()
+
+    def record(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def percentile(self, p):
+        ''' the p-th percentile of the recent latencies (None if we have too few samples) '''
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            ordered = sorted(self._latencies)
+        index = min(len(ordered) - 1, int(round(p / 100. * (len(ordered) - 1))))
+        return ordered[index]
+
+
+class RetryBudget():
+    '''
+    Token bucket limiting retries (& hedges) to a fraction of requests
+     - every request deposits "ratio" tokens (up to "max_tokens")
+     - every retry/hedge withdraws one token, & is only allowed if one is available
+    '''
+
+    def __init__(self, ratio=0.1, max_tokens=10.0, initial_tokens=None):
+        self.ratio      = ratio
+        self.max_tokens = max_tokens
+        self._tokens    = initial_tokens if initial_tokens is not None else max_tokens
+        self._lock      = threading.Lock()
+
+    def deposit(self,):
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def withdraw(self,):
+        ''' returns True if a retry/hedge is allowed '''
+        with self._lock:
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+
+class RetryPolicy():
+    '''
+    When & how often to retry a failed request
+     - retryable_status_codes : http replies that are treated like a connection failure
+    '''
+
+    retryable_status_codes = (429, 502, 503, 504)
+
+    def __init__(self, max_attempts=3, base_delay=0.1, max_delay=5.0):
+        self.max_attempts   = max_attempts
+        self.base_delay     = base_delay
+        self.max_delay      = max_delay
+
+    def backoff(self, attempt):
+        ''' seconds to wait before the given (1-based) retry : "full jitter" exponential back-off '''
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+class HedgePolicy():
+    '''
+    When to send a duplicate ("hedged") request
+     - after the "percentile"-th percentile of recent latencies,
+       bounded to [min_delay, max_delay]
+     - until enough latencies have been seen, after default_delay
+    '''
+
+    def __init__(self, percentile=95, default_delay=10.0, min_delay=0.05, max_delay=60.0):
+        self.percentile     = percentile
+        self.default_delay  = default_delay
+        self.min_delay      = min_delay
+        self.max_delay      = max_delay
+        self.latencies      = LatencyTracker()
+
+    def delay(self,):
+        ''' seconds to wait for a reply before hedging '''
+        threshold = self.latencies.percentile(self.percentile)
+        if threshold is None:
+            return self.default_delay
+        return max(self.min_delay, min(self.max_delay, threshold))
+
+
+class AdaptiveLimiter():
+    '''
+    Adaptive limit on the number of requests in flight
+    ("additive-increase / multiplicative-decrease", driven by latency & rejections)
+
+     - acquire() blocks while "limit" requests are already in flight
+     - each request that completes with a normal latency adds 1/limit to the
+       limit (i.e. +1 per limit's-worth of requests), provided the limit is
+       actually being used
+     - when a request is rejected / fails, the limit is multiplied by "backoff"
+     - when the (smoothed) latency rises above "tolerance" x the baseline (the
+       lowest latency recently seen), requests are queueing : the limit is
+       scaled by baseline / latency, which drains the queue (& so keeps the
+       baseline up to date)
+     - only requests that started after the last decrease can cause another,
+       so one overload does not collapse the limit
+
+    Latencies are compared with the baseline of their own "key" (e.g. the
+    request type), so a mix of fast & slow requests is not mistaken for overload
+
+    Expected usage:
+    ----------------
+    with limiter.slot(key='orbfit') as slot:
+        reply = send(...)
+        slot.dropped = 'exception' in reply     # (an exception in the block also counts as dropped)
+    '''
+
+    def __init__(self, initial_limit=4, min_limit=1, max_limit=64, backoff=0.75, tolerance=1.5,
+                       smoothing=0.2, window=500):
+        assert 1 <= min_limit <= initial_limit <= max_limit, 'need 1 <= min_limit <= initial_limit <= max_limit'
+        assert 0 < backoff < 1 and tolerance > 1 and 0 < smoothing <= 1
+        self.min_limit      = min_limit
+        self.max_limit      = max_limit
+        self.backoff        = backoff
+        self.tolerance      = tolerance
+        self.smoothing      = smoothing
+        self.window         = window
+
+        self._limit         = float(initial_limit)
+        self._in_flight     = 0
+        self._ratio         = 1.0   # smoothed latency / baseline
+        self._baselines     = {}    # key : [lowest latency of the current & previous windows, n in current window]
+        self._last_decrease = time.monotonic()
+        self.n_decreases    = 0
+        self.n_dropped      = 0
+        self._condition     = threading.Condition()
+
+    @property
+    def limit(self,):
+        ''' the current concurrency limit '''
+        return int(self._limit)
+
+    @property
+    def in_flight(self,):
+        return self._in_flight
+
+    def metrics(self,):
+        ''' the current state of the limiter (e.g. for monitoring) '''
+        with self._condition:
+            return {'limit'         : int(self._limit),
+                    'in_flight'     : self._in_flight,
+                    'latency_ratio' : self._ratio,
+                    'n_decreases'   : self.n_decreases,
+                    'n_dropped'     : self.n_dropped}
+
+    def acquire(self, timeout=None):
+        ''' wait for a free slot : returns False if none became free within timeout '''
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._in_flight < int(self._limit), timeout=timeout):
+                return False
+            self._in_flight += 1
+            return True
+
+    def release(self, latency, dropped=False, key=None):
+        '''
+        free a slot, & adapt the limit to how the request went
+
+        latency : seconds the request took
+        dropped : True if the request was rejected / failed
+        key     : requests with the same key are expected to take similar times
+        '''
+        with self._condition:
+            in_use = self._in_flight
+            self._in_flight -= 1
+            if dropped:
+                self.n_dropped += 1
+                self._decrease(latency, self.backoff)
+            else:
+                baseline = self._baseline(key, latency)
+                ratio = latency / baseline if baseline > 0 else 1.0
+                self._ratio += self.smoothing * (ratio - self._ratio)
+                if self._ratio > self.tolerance:
+                    self._decrease(latency, 1.0 / self._ratio)
+                elif 2 * in_use >= self._limit:
+                    self._limit = min(self.max_limit, self._limit + 1.0 / self._limit)
+            self._condition.notify_all()
+
+    def slot(self, key=None):
+        ''' context-manager : acquire a slot, & release it (timed) at the end of the block '''
+        return _LimiterSlot(self, key)
+
+    def _baseline(self, key, latency):
+        ''' the lowest latency among the last window (to 2 x window) requests with this key '''
+        lowest = self._baselines.setdefault(key, [latency, latency, 0])
+        if lowest[2] >= self.window:
+            lowest[:] = [latency, lowest[0], 0]
+        lowest[0] = min(lowest[0], latency)
+        lowest[2] += 1
+        return min(lowest[0], lowest[1])
+
+    def _decrease(self, latency, factor):
+        ''' multiplicative decrease, unless the request started before the last decrease '''
+        now = time.monotonic()
+        if now - latency < self._last_decrease:
+            return
+        self._limit         = max(self.min_limit, self._limit * factor)
+        self._ratio         = 1.0
+        self._last_decrease = now
+        self.n_decreases   += 1
+
+
+class _LimiterSlot():
+    ''' a slot of an AdaptiveLimiter, held for the duration of a with-block '''
+
+    def __init__(self, limiter, key):
+        self.limiter    = limiter
+        self.key        = key
+        self.dropped    = False
+
+    def __enter__(self):
+        self.limiter.acquire()
+        self._start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.limiter.release(time.monotonic() - self._start, dropped=self.dropped or exc_type is not None, key=self.key)
+        return False
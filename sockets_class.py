@@ -29,19 +29,32 @@
 # Import third-party packages
 # --------------------------------------------------------------
 import sys, os
+import collections
 import threading
 import socket
-from datetime import datetime
 import time
 import pickle
-import numpy as np
 import struct
-import subprocess
 import json
+import queue
+import hashlib
+import itertools
+import math
+import random
 
 # Import local module
 # --------------------------------------------------------------
-import sample_data
+import mpc_logging
+import tracing
+import request_policies
+
+# Logging from the servers' hot path goes via a background writer (see mpc_logging)
+#  - only a sample of the per-connection events are written
+log                     = mpc_logging.get_logger('sockets_class')
+hot_path_sample_rate    = 0.01
+
+# Spans of the client & server stages of each request (see tracing)
+tracer                  = tracing.get_tracer('sockets_class')
 
 # Socket-Server-Related Object Definitions
 # - This section has GENERIC / PARENT classes
@@ -77,13 +90,18 @@ class Shared():
             data.extend(packet)
         return data
 
-    def _send(self, s, data):
+    def _send(self, s, data, header=None):
         ''' send data ...
-        https://github.com/mdebbar/jsonsocket/blob/master/jsonsocket.py '''
+        https://github.com/mdebbar/jsonsocket/blob/master/jsonsocket.py
+         - if a header is given (e.g. a trace-context), the pickled data is sent in a frame with that header
+         - as it is if the data is large enough to be offloaded to the claim-check store (see _send_frame) '''
         try:
             serialized = pickle.dumps(data)
         except Exception as e:
-            raise error('You can only send pickleable data')
+            raise ValueError('You can only send pickleable data')
+
+        if header or (self.claim_check is not None and len(serialized) >= self.claim_check.threshold):
+            return self._send_frame(s, dict(header or {}, codec='pickle'), serialized)
             
         # send the length of the serialized data first
         s.send(struct.pack('>I', len(serialized)))
@@ -92,27 +110,137 @@ class Shared():
         s.sendall(serialized)
 
     def _recv(self, s):
-    
-        # read the length of the data, letter by letter until we reach EOL
-        raw_msglen = s.recv(4)
+        ''' receive a message & deserialize it (whichever codec it was sent with) '''
+        frame = self._recv_frame(s)
+        if frame is None:
+            return None
+        return self._decode_frame(*frame)
+
+    # ------- FRAMES WITH A HEADER -----------------------------------
+    # A message sent by _send is just [length][pickled-data]
+    # A message sent by _send_frame is [length][FRAME_MAGIC][header-length][json-header][payload]
+    # - The header is a small json dict, e.g. {"codec":"json", "request_type":"orbfit"}
+    # - The payload is raw bytes (e.g. already-json-encoded data) that we never re-encode
+    # - Pickled data always starts with b'\x80', so the two can never be confused
+    # - If claim_check is set (a claim_check.ClaimCheck, whose blob-store both ends can
+    #   see), large payloads are offloaded to it, & the header carries the reference
+    # - A streamed upload (see Client.connect_stream) is a {"stream":"start"} frame (acknowledged
+    #   by a {"stream":"ready"} frame), then a {"stream":"chunk"} frame per chunk of designations,
+    #   then a {"stream":"end"} frame, after which the server replies with a {"stream":"result"}
+    #   frame per chunk, & then a {"stream":"end"} frame (the client merges the results)
+    FRAME_MAGIC = b'MPCF'
+    claim_check = None
+
+    def _send_frame(self, s, header, payload):
+        ''' send a header-dict & a bytes-like payload '''
+        if self.claim_check is not None and len(payload) >= self.claim_check.threshold:
+            header, payload = dict(header, claim_check=self.claim_check.put(payload)), b''
+        header_bytes = json.dumps(header).encode()
+        prefix = self.FRAME_MAGIC + struct.pack('>H', len(header_bytes)) + header_bytes
+        s.sendall(struct.pack('>I', len(prefix) + len(payload)) + prefix)
+        s.sendall(payload)
+
+    def _recv_frame(self, s):
+        '''
+        receive a complete message
+        returns (header, payload) or None if the connection was closed
+         - messages sent with _send are returned with header = {'codec':'pickle'}
+        '''
+        # read the length of the data
+        raw_msglen = self.recvall(s, 4)
         if not raw_msglen:
             return None
         msglen = struct.unpack('>I', raw_msglen)[0]
 
         # use a memoryview to receive the data chunk by chunk efficiently
-        view = memoryview(bytearray(msglen))
+        buffer = bytearray(msglen)
+        view = memoryview(buffer)
         next_offset = 0
         while msglen - next_offset > 0:
             recv_size = s.recv_into(view[next_offset:], msglen - next_offset)
+            if not recv_size:
+                # peer hung up part-way through the message
+                return None
             next_offset += recv_size
-        
-        # deserialize from str to dict
+        view.release()
+
+        # split off the header (if there is one)
+        if not buffer.startswith(self.FRAME_MAGIC):
+            return {'codec':'pickle'}, buffer
+        n = len(self.FRAME_MAGIC)
+        header_len = struct.unpack('>H', buffer[n:n+2])[0]
+        header = json.loads(buffer[n+2:n+2+header_len])
+        del buffer[:n+2+header_len]
+        if 'claim_check' in header:
+            buffer = bytearray(self._claimed(header))
+        return header, buffer
+
+    def _claimed(self, header):
+        ''' fetch (& release) the payload of a frame that was offloaded to the claim-check store '''
+        key = header.pop('claim_check')
+        if self.claim_check is None:
+            raise ValueError('Received a claim-check reference, but no claim_check is set')
+        data = self.claim_check.fetch(key)
+        self.claim_check.release(key)
+        return data
+
+    def _recv_frame_header(self, s):
+        '''
+        receive only the start of a message, leaving the payload in the socket
+        returns (header, number-of-payload-bytes-still-to-read, payload-bytes-already-read)
+        or None if the connection was closed
+        '''
+        raw_msglen = self.recvall(s, 4)
+        if not raw_msglen:
+            return None
+        msglen = struct.unpack('>I', raw_msglen)[0]
+
+        n = len(self.FRAME_MAGIC)
+        start = self.recvall(s, min(n, msglen))
+        if start is None:
+            return None
+        if start != self.FRAME_MAGIC:
+            return {'codec':'pickle'}, msglen - len(start), bytes(start)
+
+        raw_header_len = self.recvall(s, 2)
+        header_len = struct.unpack('>H', raw_header_len)[0]
+        header = json.loads(self.recvall(s, header_len))
+        return header, msglen - n - 2 - header_len, b''
+
+    @staticmethod
+    def _decode_frame(header, payload):
+        '''
+        deserialize the payload of a received frame
+         - if the header specifies a request_type, the data is wrapped as {request_type: data},
+           i.e. in the same way as remote_general.process_cgi_string does for pickled requests
+        '''
         try:
-            deserialized = pickle.loads( view.tobytes() )
+            if header.get('codec', 'pickle') == 'json':
+                deserialized = json.loads(payload)
+            else:
+                deserialized = pickle.loads(payload)
         except Exception as e:
-            raise error('Data could not be unpickled')
+            raise ValueError('Data could not be deserialized')
+        if 'request_type' in header:
+            deserialized = {header['request_type']: deserialized}
         return deserialized
 
+    def _reply(self, s, request_header, data):
+        ''' send data back, using the same codec as the request was sent with '''
+        if request_header.get('codec', 'pickle') == 'json':
+            self._send_frame(s, {'codec':'json'}, json.dumps(data).encode())
+        else:
+            self._send(s, data)
+
+    @staticmethod
+    def _merge_results(merged, result):
+        ''' merge (in-place) the result of evaluating one chunk of a streamed upload into those so far '''
+        for k, v in result.items():
+            if isinstance(v, dict) and isinstance(merged.get(k), dict):
+                Shared._merge_results(merged[k], v)
+            else:
+                merged[k] = v
+
 
 # Socket-Server-Related Object Definition
 # - This section has classes SPECIFIC to CLIENT CONNECTIONS
@@ -134,7 +262,8 @@ class Client(Shared):
         NB : Assumes input_data is pickleable
         '''
         # Create a socket objects
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s, \
+             tracer.span('Client.connect', kind='client', attributes=self._span_attributes()):
 
             # How long to wait before timeout?
             s.settimeout(self.default_timeout)
@@ -142,16 +271,348 @@ class Client(Shared):
             # Connect to the server
             s.connect((self.server_host, self.server_port))
             
-            # Send data to the server
+            # Send data to the server (with the trace-context, if any)
             #self.send_msg(s, input_data)
-            self._send(s, input_data)
-            print('Client connect input_data = ', input_data)
+            self._send(s, input_data, header=tracing.inject({}))
+            log.debug('Client connect input_data = %r', input_data)
             # Read the reply from the server
             reply_dict = self._recv(s)
-            print('Client connect reply_dict = ', reply_dict)
+            log.debug('Client connect reply_dict = %r', reply_dict)
+
+        return reply_dict
+
+    def connect_raw(self, request_type, payload, VERBOSE = False ):
+        '''
+        pass-through client : sends already-json-encoded bytes to the server
+        (with the request_type in the frame header) and returns a RawReply:
+        an iterable over the server's json-encoded reply bytes, read from
+        the socket as they are iterated over
+
+        NB : The caller must exhaust or close() the returned RawReply
+        '''
+        with tracer.span('Client.connect_raw', kind='client', attributes=self._span_attributes(request_bytes=len(payload))):
+            header = tracing.inject({'codec':'json', 'request_type':request_type})
+            s, is_fresh = self._acquire()
+            while not self._send_request(s, is_fresh, self._send_frame, header, payload):
+                s, is_fresh = self._acquire()
+            try:
+                reply_header = self._recv_frame_header(s)
+                if reply_header is None:
+                    raise ConnectionError('Server closed the connection')
+            except BaseException:
+                self._release(s, healthy=False)
+                raise
+            return RawReply(self, s, *reply_header)
+
+    # Max designations per frame of a streamed upload
+    default_stream_designations = 100
+
+    def connect_stream(self, input_items, request_type=None, max_designations=None, VERBOSE = False ):
+        '''
+        chunked upload of a (very large) batch of designations
+         - the designations are sent as a sequence of frames of (at most) max_designations each,
+           so neither the client nor the server ever holds the whole serialized batch
+         - the server checks & starts evaluating each chunk as soon as it arrives,
+           & once the upload is complete, sends back the result of each chunk in a
+           frame of its own, which are merged here
+         - NB: the results of the whole batch are held (by the server until they are
+           sent, & here as they are merged), so unlike the upload they are not bounded
+           by the chunk size
+
+        input_items  : dict of designation : data, or an iterable of (designation, data)
+                       pairs (e.g. a generator reading them from a file)
+        request_type : if given, each chunk is evaluated as {request_type: chunk}
+        '''
+        max_designations = max_designations if max_designations is not None else self.default_stream_designations
+        items = iter(input_items.items() if isinstance(input_items, dict) else input_items)
+
+        with tracer.span('Client.connect_stream', kind='client', attributes=self._span_attributes()) as span:
+            start = tracing.inject({'codec':'pickle', 'stream':'start'})
+            if request_type is not None:
+                start['request_type'] = request_type
+            s = self._start_stream(start)
+            healthy, n_chunks = False, 0
+            try:
+                while True:
+                    chunk = dict(itertools.islice(items, max_designations))
+                    if not chunk:
+                        break
+                    self._send_frame(s, {'codec':'pickle', 'stream':'chunk'}, pickle.dumps(chunk))
+                    n_chunks += 1
+                self._send_frame(s, {'stream':'end'}, b'')
+                reply_dict = self._recv_stream_results(s)
+                healthy = True
+            finally:
+                span.set_attribute('n_chunks', n_chunks)
+                self._release(s, healthy=healthy)
+        return reply_dict
+
+    def _recv_stream_results(self, s):
+        ''' receive the results of a streamed upload, a chunk at a time, merging them '''
+        merged = {}
+        while True:
+            frame = self._recv_frame(s)
+            if frame is None:
+                raise ConnectionError('Server closed the connection')
+            if frame[0].get('stream') == 'end':
+                return merged
+            self._merge_results(merged, self._decode_frame(*frame))
+
+    def _start_stream(self, header):
+        '''
+        send the start-frame of a streamed upload : returns the socket, once the server has acknowledged it
+         - (so a pooled socket that has gone stale is replaced before any of the input is used up)
+        '''
+        s, is_fresh = self._acquire()
+        while not self._send_request(s, is_fresh, self._send_frame, header, b''):
+            s, is_fresh = self._acquire()
+        try:
+            ack = self._recv_frame(s)
+            if ack is None:
+                raise ConnectionError('Server closed the connection')
+            if ack[0].get('stream') != 'ready':
+                raise ConnectionError('Server does not accept streamed uploads')
+        except BaseException:
+            self._release(s, healthy=False)
+            raise
+        return s
+
+    def _span_attributes(self, **attributes):
+        ''' attributes recorded on the client spans '''
+        return dict(attributes, **{'server.address': self.server_host, 'server.port': self.server_port})
+
+    # ------- connection handling ---------------------------------
+    # - a plain Client uses a new connection for every request
+    # - see ClientPool for re-use of connections
+    def _new_socket(self,):
+        ''' open a new connection to the server '''
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.settimeout(self.default_timeout)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        s.connect((self.server_host, self.server_port))
+        return s
+
+    def _acquire(self,):
+        ''' get a socket to use for one request : returns (socket, is_fresh) '''
+        return self._new_socket(), True
+
+    def _release(self, s, healthy=True):
+        ''' finished with the socket from _acquire '''
+        s.close()
+
+    # Errors showing that the server had closed a (re-used) connection before our request arrived
+    #  - NB: not socket.timeout : the server may have received the request, & still be working on it
+    stale_errors = (BrokenPipeError, ConnectionResetError, ConnectionAbortedError)
+
+    def _send_request(self, s, is_fresh, send, *args):
+        '''
+        send a request (send(s, *args)) on a socket from _acquire, & wait for the reply to start
+        returns True once the first byte of the reply has arrived (it is left in the socket)
+
+        returns False if a re-used socket turns out to have been closed by the server while it was
+        idle (a reset when sending, or EOF / a reset before any of the reply) : the socket is released,
+        & the request can safely be sent again on another
+         - on a fresh socket that is an error, as is any other failure (e.g. a timeout, after which
+           the server may still be working on the request) : the socket is released & it is raised
+        '''
+        try:
+            send(s, *args)
+            if s.recv(1, socket.MSG_PEEK):
+                return True
+            failure = ConnectionError('Server closed the connection')
+        except self.stale_errors as e:
+            failure = e
+        except BaseException:
+            self._release(s, healthy=False)
+            raise
+        self._release(s, healthy=False)
+        if is_fresh:
+            raise failure
+        return False
+
+
+class RawReply():
+    '''
+    Iterable over the json-encoded bytes of a reply from the server
+     - The bytes are read from the socket in chunks as we iterate, so
+       they can be streamed straight on (e.g. to an http caller) without
+       ever being decoded or held in memory all at once
+     - length : total number of bytes that will be yielded
+    '''
+
+    chunk_size = 1 << 16
+
+    def __init__(self, client, s, header, remaining, already_read):
+        self.client         = client
+        self.sock           = s
+        self.header         = header
+        self._remaining     = remaining
+        self._already_read  = already_read
+        self._released      = False
+        # The ClientPool limiter-slot held by the request (if any), freed on close
+        self.slot           = None
+
+        # An offloaded reply is fetched from the claim-check store
+        if 'claim_check' in header:
+            self._already_read  = already_read + self.client._claimed(header)
+
+        # A pickled reply (e.g. from a server that ignored the requested codec)
+        # has to be decoded & re-encoded as json
+        if header.get('codec', 'pickle') != 'json':
+            pickled = already_read + self.client.recvall(s, remaining)
+            self._already_read  = json.dumps(pickle.loads(pickled)).encode()
+            self._remaining     = 0
+            self.close()
+        self.length = len(self._already_read) + self._remaining
+
+    def __iter__(self,):
+        try:
+            if self._already_read:
+                yield self._already_read
+            while self._remaining > 0:
+                chunk = self.sock.recv(min(self.chunk_size, self._remaining))
+                if not chunk:
+                    raise ConnectionError('Server closed the connection')
+                self._remaining -= len(chunk)
+                yield chunk
+        finally:
+            self.close()
+
+    def read(self,):
+        ''' convenience function to get all of the bytes at once '''
+        return b''.join(self)
+
+    def close(self,):
+        ''' hand back the socket (& limiter-slot): the socket can only be re-used if the whole reply was read '''
+        if not self._released:
+            self._released = True
+            self.client._release(self.sock, healthy = self._remaining == 0)
+        if self.slot is not None:
+            slot, self.slot = self.slot, None
+            slot.dropped = self._remaining != 0
+            slot.__exit__(None, None, None)
+
+
+class ClientPool(Client):
+    '''
+    Client that keeps persistent connections to the server open
+    and re-uses them across calls
+
+    Intended for long-running callers (e.g. the gateway in remote_gateway.py)
+    that make many requests: the server's _listenToClient loop already
+    services multiple messages per connection, so we only pay the
+    TCP connection set-up once per pooled socket.
+
+    Safe to call connect() from multiple threads: at most max_connections
+    requests will be in flight at any one time
+
+    With a limiter (request_policies.AdaptiveLimiter, or True for one bounded
+    by max_connections), the number of connect(), connect_raw() & connect_stream()
+    requests in flight adapts to the server's latency & rejections
+    (see limiter.limit / limiter.metrics())
+     - a connect_raw() request holds its slot until its RawReply is exhausted or closed
+    '''
+
+    default_max_connections = 8
+
+    def __init__(self, host=None, port=None, max_connections=None, limiter=None):
+        Client.__init__(self, host=host, port=port)
+        self.max_connections = max_connections if max_connections is not None else self.default_max_connections
+        self.limiter = request_policies.AdaptiveLimiter(initial_limit=min(4, self.max_connections),
+                                                        max_limit=self.max_connections) if limiter is True else limiter
+
+        # Idle sockets, and a semaphore to bound the number in use
+        self._idle      = queue.LifoQueue()
+        self._slots     = threading.BoundedSemaphore(self.max_connections)
+
+    def _acquire(self,):
+        ''' get an idle socket (or a new one if none are idle) : returns (socket, is_fresh) '''
+        self._slots.acquire()
+        try:
+            return self._idle.get_nowait(), False
+        except queue.Empty:
+            pass
+        try:
+            return self._new_socket(), True
+        except:
+            self._slots.release()
+            raise
+
+    def _release(self, s, healthy=True):
+        ''' return a healthy socket to the pool (close a broken one) '''
+        if healthy:
+            self._idle.put(s)
+        else:
+            s.close()
+        self._slots.release()
+
+    def connect(self, input_data, VERBOSE = False ):
+        '''
+        pass the data through to the server on a pooled connection & collect the reply
+        NB : Assumes input_data is pickleable
+
+        A pooled socket may have been closed by the server since it was last used,
+        so if a re-used socket fails before any of the reply arrives we retry on
+        another (see _send_request) : never after a timeout, or part-way through a reply
+        '''
+        with tracer.span('ClientPool.connect', kind='client', attributes=self._span_attributes()) as span:
+            if self.limiter is None:
+                return self._connect(input_data, span)
+
+            # Requests of different types take very different times, so the limiter compares like with like
+            key = next(iter(input_data)) if isinstance(input_data, dict) and len(input_data) == 1 else None
+            with self.limiter.slot(key=key):
+                span.set_attribute('concurrency_limit', self.limiter.limit)
+                return self._connect(input_data, span)
+
+    def connect_raw(self, request_type, payload, VERBOSE = False ):
+        ''' as Client.connect_raw, on a pooled connection (& holding a limiter-slot until the RawReply is closed) '''
+        if self.limiter is None:
+            return Client.connect_raw(self, request_type, payload, VERBOSE=VERBOSE)
+
+        slot = self.limiter.slot(key=request_type).__enter__()
+        try:
+            reply = Client.connect_raw(self, request_type, payload, VERBOSE=VERBOSE)
+        except BaseException:
+            slot.__exit__(*sys.exc_info())
+            raise
+        reply.slot = slot
+        if reply._released:
+            # The whole reply has already been read (e.g. it was pickled)
+            reply.close()
+        return reply
+
+    def connect_stream(self, input_items, request_type=None, max_designations=None, VERBOSE = False ):
+        ''' as Client.connect_stream, on a pooled connection (& holding a limiter-slot for the whole upload) '''
+        if self.limiter is None:
+            return Client.connect_stream(self, input_items, request_type=request_type, max_designations=max_designations, VERBOSE=VERBOSE)
+        with self.limiter.slot(key=request_type):
+            return Client.connect_stream(self, input_items, request_type=request_type, max_designations=max_designations, VERBOSE=VERBOSE)
 
+    def _connect(self, input_data, span):
+        ''' send & receive on a pooled connection (retrying if a re-used one was stale) '''
+        s, is_fresh = self._acquire()
+        while not self._send_request(s, is_fresh, self._send, input_data, tracing.inject({})):
+            span.set_attribute('retried', True)
+            s, is_fresh = self._acquire()
+        try:
+            reply_dict = self._recv(s)
+            if reply_dict is None:
+                raise ConnectionError('Server closed the connection')
+        except BaseException:
+            self._release(s, healthy=False)
+            raise
+        self._release(s)
         return reply_dict
 
+    def close(self,):
+        ''' close all idle connections '''
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
 
 # Socket-Server-Related Object Definition
 # - This section has classes SPECIFIC to establishing SERVERS
@@ -165,8 +626,17 @@ class Server(Shared):
      - (e.g. orbit-fitting, checking/attribution, ...)
      
     Should also function as a stand-alone test server
+
+    If capture is set (a traffic_capture.CaptureWriter), (a sample of) the
+    frames received are written to a capture-file, to be replayed later
+    (streamed uploads are not captured)
     '''
 
+    capture = None
+
+    # Max number of chunks of a streamed upload waiting to be evaluated (see _listenToStream)
+    stream_queue_chunks = 2
+
     def __init__(self, host=None, port=None):
         
         self.host = host if host is not None else self.default_server_host
@@ -244,26 +714,216 @@ class Server(Shared):
         '''
         while True:
             try:
-                received   = self._recv(client)
-                if received:
-                    print('Something was received in _listenToClient...')
+                frame      = self._recv_frame(client)
+                if not frame:
+                    log.info('Client disconnected', extra={'address': address, 'sample_rate': hot_path_sample_rate})
+                    raise ConnectionError('Client disconnected')
+                if frame[0].get('stream') == 'start':
+                    self._listenToStream(client, frame[0])
+                    continue
+                if self.capture is not None:
+                    self.capture.write(*frame)
+
+                # Each stage is a span, continuing the client's trace (if it sent one)
+                with tracer.span(f'{type(self).__name__}._listenToClient', kind='server', parent=frame[0].get('traceparent'),
+                                 attributes={'request_bytes': len(frame[1]), 'codec': frame[0].get('codec', 'pickle')}):
+                    with tracer.span('decode'):
+                        received   = self._decode_frame(*frame)
+                    if not received:
+                        raise ValueError('Empty request')
+                    log.info('Something was received in _listenToClient...',
+                             extra={'address': address, 'sample_rate': hot_path_sample_rate})
 
                     # Check data format (expecting json_str)
-                    self._check_data_format_from_client(received)
+                    with tracer.span('check'):
+                        self._check_data_format_from_client(received)
 
                     # Do orbit fit
-                    returned_dict = self._function_to_be_evaluated(received)
+                    with tracer.span('evaluate'):
+                        returned_dict = self._function_to_be_evaluated(received)
 
-                    # Send the results back to the client
-                    self._send(client,returned_dict)
+                    # Send the results back to the client (in the format they sent the request)
+                    with tracer.span('reply'):
+                        self._reply(client, frame[0], returned_dict)
                     
-                else:
-                    print('Client disconnected')
-                    raise
             except:
                 client.close()
                 return False
 
+    def _listenToStream(self, client, start_header):
+        '''
+        receive a streamed (chunked) upload (see Client.connect_stream)
+         - each chunk is decoded & checked as soon as it arrives, & queued to be
+           evaluated by a separate thread, so evaluation overlaps with receiving
+         - at most stream_queue_chunks chunks wait in the queue : if evaluation falls
+           behind, we stop reading & TCP flow-control holds the client back, so the
+           memory used by the upload is bounded by the chunk size (rather than the batch size)
+         - once the end-frame arrives, the result of each chunk is sent back in a frame
+           of its own (& freed once sent), so no single frame holds all of the results
+         - NB: the results themselves are held until then, so they are *not* bounded by
+           the chunk size (see Client.connect_stream)
+        Any failure raises (so the connection is closed), as for a single request
+        '''
+        with tracer.span(f'{type(self).__name__}._listenToStream', kind='server',
+                         parent=start_header.get('traceparent')) as span:
+            self._send_frame(client, {'stream':'ready'}, b'')
+
+            pending     = queue.Queue(maxsize=self.stream_queue_chunks)
+            state       = {'results': collections.deque(), 'error': None}
+            evaluator   = threading.Thread(target=self._evaluate_stream, args=(pending, state, span.traceparent), daemon=True)
+            evaluator.start()
+            n_chunks    = 0
+            try:
+                while True:
+                    header, payload = self._recv_frame(client) or ({'stream':'disconnected'}, None)
+                    if header.get('stream') == 'end':
+                        break
+                    if header.get('stream') != 'chunk':
+                        raise ConnectionError(f'Streamed upload interrupted ({header.get("stream")})')
+                    with tracer.span('chunk', attributes={'request_bytes': len(payload)}):
+                        if 'request_type' in start_header:
+                            header['request_type'] = start_header['request_type']
+                        received = self._decode_frame(header, payload)
+                        del payload
+                        self._check_data_format_from_client(received)
+                    if state['error'] is not None:
+                        break
+                    pending.put(received)
+                    n_chunks += 1
+            finally:
+                pending.put(None)
+                evaluator.join()
+            span.set_attribute('n_chunks', n_chunks)
+            if state['error'] is not None:
+                raise state['error']
+
+            with tracer.span('reply'):
+                results, codec = state['results'], start_header.get('codec', 'pickle')
+                while results:
+                    result = results.popleft()
+                    payload = json.dumps(result).encode() if codec == 'json' else pickle.dumps(result)
+                    self._send_frame(client, {'codec':codec, 'stream':'result'}, payload)
+                self._send_frame(client, {'stream':'end'}, b'')
+
+    def _evaluate_stream(self, pending, state, traceparent):
+        ''' evaluate the queued chunks of a streamed upload (until None is queued), keeping the results '''
+        while True:
+            received = pending.get()
+            if received is None:
+                return
+            if state['error'] is not None:
+                continue    # after a failure, just drain the queue
+            try:
+                with tracer.span('evaluate', parent=traceparent):
+                    state['results'].append(self._function_to_be_evaluated(received))
+            except Exception as e:
+                state['error'] = e
+
+
+
+class SyntheticServer(Server):
+    '''
+    Test server with a configurable, synthetic workload : for load-testing
+    (e.g. the gateway, client-pools & schedulers) with realistic service
+    times, without needing the real orbit pipeline
+
+    cpu_seconds                 : CPU time used per request
+    cpu_seconds_per_observation : extra CPU time per observation in the request's obslists
+    latency_distribution        : 'constant', 'uniform', 'exponential' or 'lognormal' :
+                                  the distribution of an extra (non-CPU) wait per request
+    latency_mean                : mean of that wait (seconds)
+    latency_sigma               : for 'lognormal', the sigma of log(wait)
+    response_bytes              : (approximate) size of the (json-encoded) reply
+    failure_rate                : fraction of requests that fail
+    failure_mode                : 'exception' (reply with an exception-dict) or
+                                  'disconnect' (close the connection without replying)
+    seed                        : random seed (for repeatable latencies / failures)
+    '''
+
+    default_cpu_seconds                 = 0.0
+    default_cpu_seconds_per_observation = 0.0
+    default_latency_distribution        = 'constant'
+    default_latency_mean                = 0.0
+    default_latency_sigma               = 0.5
+    default_response_bytes              = 0
+    default_failure_rate                = 0.0
+    default_failure_mode                = 'exception'
+
+    latency_distributions   = ('constant', 'uniform', 'exponential', 'lognormal')
+    failure_modes           = ('exception', 'disconnect')
+
+    def __init__(self, host=None, port=None, cpu_seconds=None, cpu_seconds_per_observation=None,
+                       latency_distribution=None, latency_mean=None, latency_sigma=None,
+                       response_bytes=None, failure_rate=None, failure_mode=None, seed=None):
+        self.cpu_seconds                 = cpu_seconds if cpu_seconds is not None else self.default_cpu_seconds
+        self.cpu_seconds_per_observation = cpu_seconds_per_observation if cpu_seconds_per_observation is not None else self.default_cpu_seconds_per_observation
+        self.latency_distribution        = latency_distribution if latency_distribution is not None else self.default_latency_distribution
+        self.latency_mean                = latency_mean if latency_mean is not None else self.default_latency_mean
+        self.latency_sigma               = latency_sigma if latency_sigma is not None else self.default_latency_sigma
+        self.response_bytes              = response_bytes if response_bytes is not None else self.default_response_bytes
+        self.failure_rate                = failure_rate if failure_rate is not None else self.default_failure_rate
+        self.failure_mode                = failure_mode if failure_mode is not None else self.default_failure_mode
+        assert self.latency_distribution in self.latency_distributions, f'latency_distribution must be one of {self.latency_distributions}'
+        assert self.failure_mode in self.failure_modes, f'failure_mode must be one of {self.failure_modes}'
+        Server.__init__(self, host=host, port=port)
+
+        self._random    = random.Random(seed)
+        self._lock      = threading.Lock()
+
+    def _function_to_be_evaluated(self, data_dict):
+        ''' use CPU, wait, then reply with (response_bytes of) padding, or fail '''
+        with self._lock:
+            latency = self._latency()
+            failed  = self._random.random() < self.failure_rate
+
+        n_observations  = self._count_observations(data_dict)
+        cpu_seconds     = self.cpu_seconds + self.cpu_seconds_per_observation * n_observations
+        self._use_cpu(cpu_seconds)
+        time.sleep(latency)
+
+        if failed:
+            if self.failure_mode == 'disconnect':
+                raise ConnectionAbortedError('Synthetic failure')
+            return {'exception': 'Synthetic failure', 'file': __file__}
+        return {'synthetic' : { 'n_observations'    : n_observations,
+                                'cpu_seconds'       : cpu_seconds,
+                                'latency_seconds'   : latency},
+                'padding'   : 'x' * self.response_bytes}
+
+    def _latency(self,):
+        ''' a random wait from the latency distribution '''
+        if self.latency_mean <= 0 or self.latency_distribution == 'constant':
+            return max(0.0, self.latency_mean)
+        if self.latency_distribution == 'uniform':
+            return self._random.uniform(0, 2 * self.latency_mean)
+        if self.latency_distribution == 'exponential':
+            return self._random.expovariate(1 / self.latency_mean)
+        # lognormal, parameterised so that its mean is latency_mean
+        mu = math.log(self.latency_mean) - self.latency_sigma**2 / 2
+        return self._random.lognormvariate(mu, self.latency_sigma)
+
+    @staticmethod
+    def _use_cpu(seconds):
+        '''
+        keep a CPU busy for (this thread's) CPU-time "seconds"
+         - hashing releases the GIL, so concurrent requests use separate CPUs, as real work would
+        '''
+        block   = bytes(1 << 16)
+        end     = time.thread_time() + seconds
+        while time.thread_time() < end:
+            hashlib.sha256(block).digest()
+
+    @staticmethod
+    def _count_observations(data):
+        ''' number of observations in the obslists of a (possibly wrapped) {desig: {'obslist': [...]}} request '''
+        n = 0
+        for v in data.values():
+            if isinstance(v, dict):
+                if isinstance(v.get('obslist'), (list, tuple)):
+                    n += len(v['obslist'])
+                else:
+                    n += SyntheticServer._count_observations(v)
+        return n
 
 
 # Socket-Server-Related Object Definitions
@@ -352,6 +1012,108 @@ class OrbfitExtensionServer(Server):
         return returned_dict
 
 
+class OrbfitIODServer(Server):
+    '''
+    Class to do INITIAL ORBIT DETERMINATION
+
+    Accepts batches of tracklets, {trkid: {'obslist': [obs, ...]}, ...}
+    (optionally wrapped as {'iod': {...}}, as sent by remote_general),
+    & returns candidate orbits for each (see iod.GaussIOD.fit)
+    '''
+
+    request_type = 'iod'
+
+    def __init__(self, host=None, port=None):
+        '''...
+        '''
+        # Get access to relevant class methods
+        Server.__init__(self, host=host, port=port)
+
+        # Do imports (numpy-heavy, so only for this server)
+        import iod
+        self.engine = iod.GaussIOD()
+
+    @classmethod
+    def _unwrap(cls, data):
+        ''' the tracklets, whether or not they are wrapped as {request_type: tracklets} '''
+        if len(data) == 1 and isinstance(data.get(cls.request_type), dict):
+            return data[cls.request_type]
+        return data
+
+    @staticmethod
+    def _check_data_format_from_client( data ):
+
+        # check overall structure of data is a dict as required:
+        # Outer dict, with tracklet-ids as keys, and dicts as values
+        assert isinstance(data, dict)
+        for k, v in OrbfitIODServer._unwrap(data).items():
+            assert isinstance(v, dict), f"{k} : expected a dict"
+
+            # Each inner dict has an obslist of (at least three) observations
+            assert 'obslist' in v, f"{k} : keys = {v.keys()}"
+            assert isinstance( v["obslist"], (list,tuple)), f"{k} : obslist is not a list"
+            assert len(v["obslist"]) >= 3, f"{k} : IOD needs at least three observations"
+            for item in v["obslist"]:
+                assert isinstance(item, dict)
+                for key in ['obstime', 'ra', 'dec']:
+                    assert key in item, f"{k} : observation without {key}"
+
+    @staticmethod
+    def _check_data_format_from_server(data):
+        '''
+        We expect ...
+        data = {"trk1":
+            {
+                "eq0dict"    : best_candidate_orbit_dict,
+                "candidates" : [{"eq0dict": ..., "rms_arcsec": ...}, ...],
+            }
+        }
+        '''
+        assert isinstance(data, dict)
+        for k, v in data.items():
+            assert isinstance(v, dict)
+            assert isinstance(v.get('eq0dict'), dict), f"{k} : no eq0dict"
+            assert isinstance(v.get('candidates'), list), f"{k} : no candidates"
+
+    def _function_to_be_evaluated(self, data_dict):
+
+        # Do IOD on all of the tracklets at once
+        return self.engine.fit(self._unwrap(data_dict))
+
+
+
+# Request-Type Object Definitions
+# - Light-weight classes holding the format-checking functions for each
+#   type of request, so that clients (e.g. remote.Remote) can check data
+#   without having to instantiate (i.e. bind) a server
+# -------------------------------------------------------------
+class Testing():
+    ''' Checks for "test" requests '''
+    _check_data_format_from_client = staticmethod(Server._check_data_format_from_client)
+    _check_data_format_from_server = staticmethod(Server._check_data_format_from_server)
+
+    def _check_json_from_client(self, json_string ):
+        # Convert json-str to dict & then validate
+        self._check_data_format_from_client( json.loads(json_string) )
+
+    def _check_json_from_server(self, json_string ):
+        # Convert json-str to dict & then validate
+        self._check_data_format_from_server( json.loads(json_string) )
+
+class Orbfit(Testing):
+    ''' Checks for "orbfit" (orbit-extension) requests '''
+    _check_data_format_from_client = staticmethod(OrbfitExtensionServer._check_data_format_from_client)
+    _check_data_format_from_server = staticmethod(OrbfitExtensionServer._check_data_format_from_server)
+
+class IOD(Testing):
+    ''' Checks for "iod" (initial orbit determination) requests '''
+    _check_data_format_from_client = staticmethod(OrbfitIODServer._check_data_format_from_client)
+    _check_data_format_from_server = staticmethod(OrbfitIODServer._check_data_format_from_server)
+
+class Comet(Testing):
+    ''' Checks for "comet" requests : no specific checks yet '''
+
+
 
 
 
@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+
+'''
+    --------------------------------------------------------------
+    Worker daemon running orbit-extensions from an MPCSQS queue
+
+    Runs the loop sketched in the OrbfitExtensionSQS docstring
+    (read -> do_orbit_fit -> delete) continuously & concurrently:
+     - N fetcher threads long-poll the queue (mpc_sqs.MPCSQSConsumer)
+     - jobs are dispatched to a process-pool running update_existing_orbits
+     - while a fit runs, the visibility of its message is extended
+       ("heartbeats"), so no other worker picks it up
+     - messages of successful fits are deleted in batches
+     - messages of failed fits are released for another attempt, until
+       they have been received max_receives times, after which they are
+       treated as poison & sent to a dead-letter path (a file or a queue)
+
+    Redundant fits are avoided:
+     - a message for a trackletID that was already seen within the last
+       dedupe_window seconds (e.g. from a replayed batch) is deleted unfitted
+     - messages for the same designation (desig12) that arrive within
+       coalesce_window seconds of each other, or while a fit for that
+       designation is running, are coalesced into a single fit, after
+       which all of their messages are deleted
+
+    The message body carries the json input for update_existing_orbits,
+    i.e. {designation: {'obslist': ..., 'rwodict': ..., 'eq0dict': ...}}
+
+    Usage:
+    $ python3 sqs_worker.py [MAX_WORKERS]
+     - run on an internal computation machine, e.g. "marsden" or "docker"s
+
+    Expected usage (python):
+    ----------------
+    W = sqs_worker.SQSWorker(mpc_sqs.OrbfitExtensionSQS(), max_workers=8)
+    W.run()
+    --------------------------------------------------------------
+'''
+
+
+# Import third-party packages
+# --------------------------------------------------------------
+import sys, os
+import collections
+import json
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+# Import neighboring packages
+# --------------------------------------------------------------
+import mpc_sqs
+import mpc_logging
+
+log = mpc_logging.get_logger('sqs_worker')
+
+
+def run_orbit_extension(input_dict):
+    ''' default fit-function : MPan's orbit-extension (only available on the compute machines) '''
+    sys.path.append("/sa/orbit_pipeline")
+    import update_existing_orbits
+    return update_existing_orbits.update_existing_orbits(input_dict, proc_subdir='update_orbit')
+
+
+def merge_inputs(input_dicts):
+    '''
+    default merge-function : combine the fit-inputs of several messages into one
+     - for each designation, the observations are the union of all of the obslists
+       (in the order received), the rwodicts are merged (later messages win), & the
+       eq0dict (the orbit to be extended) is taken from the latest message
+    '''
+    merged = {}
+    for input_dict in input_dicts:
+        for desig, v in input_dict.items():
+            if desig not in merged:
+                merged[desig] = {'obslist': [], 'rwodict': {}, 'eq0dict': {}, '_seen': set()}
+            m = merged[desig]
+            for obs in v.get('obslist', []):
+                key = json.dumps(obs, sort_keys=True)
+                if key not in m['_seen']:
+                    m['_seen'].add(key)
+                    m['obslist'].append(obs)
+            m['rwodict'].update(v.get('rwodict', {}))
+            m['eq0dict'] = v.get('eq0dict', m['eq0dict'])
+            m.update({k: w for k, w in v.items() if k not in m})
+    for m in merged.values():
+        del m['_seen']
+    return merged
+
+
+class SQSWorker():
+    '''
+    Consume orbit-extension jobs from a queue & run them in a process-pool
+
+    mpcsqs          : MPCSQS instance (e.g. OrbfitExtensionSQS()) to read from
+    fit_function    : picklable function taking the input-dict from a message body,
+                      returning a result-dict (a result containing 'exception' is a failure)
+    merge_function  : function combining the input-dicts of coalesced messages (default merge_inputs)
+    dedupe_window   : seconds for which a trackletID is remembered (0 : no deduplication)
+    coalesce_window : seconds to wait for more messages for the same designation before fitting
+    dead_letter     : where poison messages go
+                      - a file path (json-lines) : default_dead_letter_path if None
+                      - or an MPCSQS instance (with send_batch) for a dead-letter queue
+    result_handler  : optional function(records, result_dict), called for each successful fit
+    executor        : optional executor to run fits in (default a ProcessPoolExecutor)
+    '''
+
+    default_max_workers         = os.cpu_count() or 1
+    default_n_fetchers          = 2
+    default_visibility_timeout  = 300
+    default_max_receives        = 5
+    default_ack_interval        = 1.0
+    default_dedupe_window       = 3600
+    default_coalesce_window     = 1.0
+    default_dead_letter_path    = 'mpc_sqs_dead_letter.jsonl'
+    # Max number of messages held (waiting to be coalesced, or being fitted) per worker
+    max_held_per_worker         = 10
+
+    def __init__(self,  mpcsqs, fit_function=None, merge_function=None, max_workers=None, n_fetchers=None,
+                        visibility_timeout=None, heartbeat_interval=None, max_receives=None,
+                        dedupe_window=None, coalesce_window=None,
+                        dead_letter=None, result_handler=None, executor=None):
+        self.fit_function       = fit_function if fit_function is not None else run_orbit_extension
+        self.merge_function     = merge_function if merge_function is not None else merge_inputs
+        self.max_workers        = max_workers if max_workers is not None else self.default_max_workers
+        self.visibility_timeout = visibility_timeout if visibility_timeout is not None else self.default_visibility_timeout
+        self.heartbeat_interval = heartbeat_interval if heartbeat_interval is not None else self.visibility_timeout / 3.
+        self.max_receives       = max_receives if max_receives is not None else self.default_max_receives
+        self.dedupe_window      = dedupe_window if dedupe_window is not None else self.default_dedupe_window
+        self.coalesce_window    = coalesce_window if coalesce_window is not None else self.default_coalesce_window
+        self.dead_letter        = dead_letter if dead_letter is not None else self.default_dead_letter_path
+        self.result_handler     = result_handler
+        self.executor           = executor if executor is not None else ProcessPoolExecutor(max_workers=self.max_workers)
+        self.consumer           = mpc_sqs.MPCSQSConsumer(mpcsqs,
+                                                         visibility_timeout=self.visibility_timeout,
+                                                         prefetch=self.max_workers,
+                                                         n_fetchers=n_fetchers if n_fetchers is not None else self.default_n_fetchers)
+
+        # State shared between the main loop, the completion callbacks & the heartbeat thread
+        self.stats          = {'n_succeeded': 0, 'n_retried': 0, 'n_dead_lettered': 0, 'n_duplicates': 0, 'n_fits': 0}
+        self._lock          = threading.Lock()
+        self._slots         = threading.BoundedSemaphore(self.max_workers)
+        self._in_flight     = {}                        # message_id -> record : all held messages (pending or running)
+        self._pending       = collections.OrderedDict() # group-key -> {'records': [...], 'inputs': [...], 'since': time}
+        self._running       = set()                     # group-keys with a fit running
+        self._seen          = collections.OrderedDict() # trackletID -> time first seen
+        self._to_delete     = []                        # records to be deleted in the next batch
+        self._last_beat     = 0.
+        self._stop          = threading.Event()
+
+    # ----- main loop ---------------------------------
+    def run(self, max_jobs=None, idle_timeout=None):
+        '''
+        consume & process jobs until stop() is called
+         - max_jobs     : stop after this many messages have been received
+         - idle_timeout : stop once the queue has been empty (& nothing is running) for this many seconds
+        returns the stats dict
+        '''
+        self._stop.clear()
+        heartbeat = threading.Thread(target=self._heartbeat_loop, daemon=True)
+        heartbeat.start()
+        n_jobs, idle_since = 0, time.monotonic()
+        try:
+            while not self._stop.is_set() and (max_jobs is None or n_jobs < max_jobs):
+                self._dispatch_ready()
+
+                # Do not hold (much) more than we can run
+                with self._lock:
+                    n_held, busy = len(self._in_flight), bool(self._in_flight)
+                if n_held >= self.max_held_per_worker * self.max_workers:
+                    time.sleep(0.01)
+                    continue
+
+                record = self.consumer.get(timeout=0.05)
+                if record is None:
+                    if busy:
+                        idle_since = time.monotonic()
+                    elif idle_timeout is not None and time.monotonic() - idle_since > idle_timeout:
+                        break
+                    continue
+
+                n_jobs, idle_since = n_jobs + 1, time.monotonic()
+                self._receive(record)
+
+            # Fit whatever is still waiting to be coalesced
+            while True:
+                with self._lock:
+                    if not self._pending:
+                        break
+                self._dispatch_ready(force=True)
+                time.sleep(0.01)
+        finally:
+            # Let running fits finish, then clean up
+            for _ in range(self.max_workers):
+                self._slots.acquire()
+            for _ in range(self.max_workers):
+                self._slots.release()
+            self._stop.set()
+            heartbeat.join()
+            self.consumer.stop()
+            self._flush()
+        return self.stats
+
+    def stop(self,):
+        ''' stop taking new jobs : run() returns once the held jobs have been fitted '''
+        self._stop.set()
+
+    # ----- per-message handling ---------------------------------
+    def _receive(self, record):
+        ''' check a newly received message, & add it to the group for its designation '''
+        if record['receive_count'] > self.max_receives:
+            return self._finish(record, dead_letter_reason=f"received {record['receive_count']} times")
+        try:
+            input_dict = json.loads(self._body(record))
+            assert isinstance(input_dict, dict) and input_dict, 'message body must be a non-empty json object'
+        except Exception as e:
+            return self._finish(record, dead_letter_reason=f'unreadable message body: {e}')
+
+        job_dict    = record.get('job_dict') or {}
+        trackletID  = job_dict.get('trackletID')
+        with self._lock:
+            # Duplicate tracklet : nothing to fit
+            if trackletID is not None and self.dedupe_window > 0:
+                now = time.monotonic()
+                while self._seen and next(iter(self._seen.values())) < now - self.dedupe_window:
+                    self._seen.popitem(last=False)
+                if trackletID in self._seen:
+                    self.stats['n_duplicates'] += 1
+                    self._to_delete.append(record)
+                    return
+                self._seen[trackletID] = now
+
+            # Coalesce with any other messages for the same designation
+            key = job_dict.get('desig12') or record['message_id']
+            if key not in self._pending:
+                self._pending[key] = {'records': [], 'inputs': [], 'since': time.monotonic()}
+            self._pending[key]['records'].append(record)
+            self._pending[key]['inputs'].append(input_dict)
+            self._in_flight[record['message_id']] = record
+
+    def _dispatch_ready(self, force=False):
+        ''' submit a fit for each group that has waited coalesce_window (& whose designation is not being fitted) '''
+        while True:
+            with self._lock:
+                now, ready = time.monotonic(), None
+                for key, group in self._pending.items():
+                    if key not in self._running and (force or now - group['since'] >= self.coalesce_window):
+                        ready = key
+                        break
+                if ready is None or not self._slots.acquire(blocking=False):
+                    return
+                group = self._pending.pop(ready)
+                self._running.add(ready)
+                self.stats['n_fits'] += 1
+
+            input_dict = self.merge_function(group['inputs']) if len(group['inputs']) > 1 else group['inputs'][0]
+            future = self.executor.submit(self.fit_function, input_dict)
+            future.add_done_callback(lambda future, key=ready, records=group['records']: self._completed(key, records, future))
+
+    def _completed(self, key, records, future):
+        ''' called (in a pool-management thread) when a fit has finished '''
+        try:
+            result_dict = future.result()
+            assert isinstance(result_dict, dict), f'unexpected result {result_dict!r}'
+            if 'exception' in result_dict:
+                raise RuntimeError(result_dict['exception'])
+        except Exception as e:
+            with self._lock:
+                for record in records:
+                    self._seen.pop((record.get('job_dict') or {}).get('trackletID'), None)
+            for record in records:
+                if record['receive_count'] >= self.max_receives:
+                    self._finish(record, dead_letter_reason=f'fit failed: {e}')
+                else:
+                    # Make the message visible again, so that it is retried (here or elsewhere)
+                    self._safely(self.consumer.nack, record)
+                    self._finish(record, retry=True)
+        else:
+            if self.result_handler is not None:
+                self._safely(self.result_handler, records, result_dict)
+            for record in records:
+                self._finish(record)
+        finally:
+            with self._lock:
+                self._running.discard(key)
+            self._slots.release()
+
+    def _finish(self, record, retry=False, dead_letter_reason=None):
+        ''' book-keeping once we are done with a message '''
+        if dead_letter_reason is not None:
+            self._safely(self._send_to_dead_letter, record, dead_letter_reason)
+        with self._lock:
+            self._in_flight.pop(record['message_id'], None)
+            if retry:
+                self.stats['n_retried'] += 1
+            else:
+                self.stats['n_dead_lettered' if dead_letter_reason is not None else 'n_succeeded'] += 1
+                self._to_delete.append(record)
+            flush = len(self._to_delete) >= mpc_sqs.MPCSQS.max_batch_entries
+        if flush:
+            self._flush()
+
+    def _send_to_dead_letter(self, record, reason):
+        ''' poison messages are kept (with the reason) so they can be inspected, rather than retried forever '''
+        if isinstance(self.dead_letter, str):
+            try:
+                body = self._body(record)
+            except Exception:
+                # e.g. the claim-checked body has gone : keep the reference
+                body = record['body']
+            line = json.dumps({ 'time'          : time.time(),
+                                'reason'        : reason,
+                                'message_id'    : record['message_id'],
+                                'receive_count' : record['receive_count'],
+                                'job_dict'      : record['job_dict'],
+                                'body'          : body})
+            with self._lock, open(self.dead_letter, 'a') as fh:
+                fh.write(line + '\n')
+        else:
+            assert self.dead_letter.send_batch([record['job_dict']], [record['body'] or '']) != [None]
+
+    def _body(self, record):
+        ''' the full message body (fetched from the claim-check store if it was offloaded) '''
+        resolve_body = getattr(self.consumer.mpcsqs, 'resolve_body', None)
+        return resolve_body(record) if resolve_body is not None else record['body']
+
+    # ----- background house-keeping ---------------------------------
+    def _heartbeat_loop(self,):
+        ''' extend the visibility of held jobs & delete finished ones '''
+        while not self._stop.wait(min(self.heartbeat_interval, self.default_ack_interval)):
+            self._flush()
+            if time.monotonic() - self._last_beat >= self.heartbeat_interval:
+                self._last_beat = time.monotonic()
+                with self._lock:
+                    held = list(self._in_flight.values())
+                for record in held:
+                    self._safely(self.consumer.extend, record)
+
+    def _flush(self,):
+        ''' delete finished messages in batches '''
+        with self._lock:
+            records, self._to_delete = self._to_delete, []
+        if records and self.consumer.ack(records) is False:
+            log.warning('failed to delete %d messages', len(records))
+
+    @staticmethod
+    def _safely(function, *args):
+        ''' house-keeping failures must not stop the worker '''
+        try:
+            function(*args)
+        except Exception:
+            log.exception('%s failed', function.__name__)
+
+
+
+# Run the worker on the orbit-extension queue ...
+if __name__ == '__main__':
+    max_workers = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    SQSWorker(mpc_sqs.OrbfitExtensionSQS(), max_workers=max_workers).run()
@@ -0,0 +1,140 @@
+# Import third-party packages
+# --------------------------------------------------------------
+import sys, os
+import json
+import threading
+import pytest
+
+# Import neighboring packages
+# ---------------------------------------------------------------
+sys.path.append(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+import claim_check
+import mpc_sqs
+import queue_backends
+import sockets_class as sc
+
+
+# Helper functions
+# ---------------------------------------------------------------
+
+@pytest.fixture(autouse=True)
+def in_tmp_path(tmp_path, monkeypatch):
+    ''' The mpc_sqs logs get written to the current directory '''
+    monkeypatch.chdir(tmp_path)
+
+@pytest.fixture
+def CC(tmp_path):
+    return claim_check.ClaimCheck(claim_check.BlobStore(str(tmp_path / 'blobs')), threshold=1000)
+
+def n_blobs(store):
+    return sum(len(files) for root, dirs, files in os.walk(store.root) if root != store.root)
+
+def big_body(n=5000):
+    return json.dumps({'K15HI1Q': {'obslist': [{'obs80': 'x' * 80, 'n': i} for i in range(n)]}})
+
+
+# Tests of the blob-store
+# ---------------------------------------------------------------
+
+def test_blob_store(CC):
+    ''' Blobs are compressed, stored once per content, & reference-counted '''
+    store, data = CC.store, big_body().encode()
+    key = store.put(data)
+    assert store.put(data) == key and n_blobs(store) == 1 and store.refs(key) == 2
+    assert os.path.getsize(store._path(key)) < len(data) / 10
+    assert store.get(key) == data
+
+    # Only unreferenced blobs are garbage-collected (after a grace period)
+    store.release(key)
+    assert store.gc(grace=0) == 0
+    store.release(key)
+    assert store.gc(grace=3600) == 0
+    assert store.gc(grace=0) == 1 and n_blobs(store) == 0
+    with pytest.raises(KeyError):
+        store.get(key)
+
+    # Blobs whose references were lost are collected eventually
+    key = store.put(data)
+    assert store.gc(max_age=-1) == 1
+
+    # ... but not while they are still being given new references
+    key = store.put(data)
+    store._db.execute('UPDATE blobs SET created=created-100, last_used=last_used-100')
+    store.put(data)
+    assert store.gc(max_age=50) == 0 and store.get(key) == data
+    store.release(key)
+    store._db.execute('UPDATE blobs SET last_used=last_used-100')
+    assert store.gc(max_age=50) == 1
+
+def test_claim_check_offload_and_cache(CC):
+    ''' Only large payloads are offloaded, & fetched blobs are cached locally '''
+    assert CC.offload('small') == 'small' and CC.resolve('small') == 'small'
+    body = big_body()
+    reference = CC.offload(body)
+    assert CC.is_reference(reference) and len(reference) < 100
+    assert CC.resolve(reference) == body
+
+    # The second resolve comes from the cache
+    os.remove(CC.store._path(reference[len(CC.prefix):]))
+    assert CC.resolve(reference) == body
+
+
+# Tests of the integration with queues & sockets
+# ---------------------------------------------------------------
+
+def test_queue_messages_are_claim_checked(CC):
+    ''' Large bodies go via the blob-store, & are released once the message is deleted '''
+    OES = mpc_sqs.OrbfitExtensionSQS(backend=queue_backends.MemoryBackend(), claim_check=CC)
+    OES.send_delay_seconds = 0
+    job_dicts = [{'trackletID': f'trk{i}', 'desig12': 'K15HI1Q', 'mpc_local_queue_destination': 'MBAMOPP'} for i in range(3)]
+    body = big_body(50000)
+    assert len(body) > OES.max_message_bytes
+    assert None not in OES.send_batch(job_dicts, [body, body, 'small'])
+
+    records = OES.read_batch(visibility_timeout=60)
+    assert [len(record['body']) < 100 for record in records] == [True, True, True]
+    assert [OES.resolve_body(record) for record in records] == [body, body, 'small']
+
+    key = records[0]['body'][len(CC.prefix):]
+    assert CC.store.refs(key) == 2
+    assert OES.delete_batch(records) == [True, True, True]
+    assert CC.store.refs(key) == 0 and CC.gc(grace=0) == 1
+
+def test_socket_frames_are_claim_checked(CC):
+    ''' Large requests & replies go via the blob-store, with only a reference in the frame '''
+    S = sc.Server(host='127.0.0.1', port=0)
+    S.claim_check = CC
+    S.sock.listen(5)
+    threading.Thread(target=S._listen, daemon=True).start()
+
+    C = sc.ClientPool(host='127.0.0.1', port=S.sock.getsockname()[1])
+    C.claim_check = CC
+
+    body = big_body()
+    reply = C.connect_raw('test', body.encode())
+    assert json.loads(reply.read()) == {'tested': {'test': json.loads(body)}}
+
+    # Both blobs (request & reply) were released once received
+    assert n_blobs(CC.store) == 2 and CC.gc(grace=0) == 2
+    C.close()
+
+def test_pickled_frames_are_claim_checked(CC):
+    ''' Large pickled requests (sent without a trace-context) & replies go via the blob-store too '''
+    class BigReplyServer(sc.Server):
+        def _function_to_be_evaluated(self, data_dict):
+            return {'tested': data_dict, 'padding': 'x' * 200000}
+    S = BigReplyServer(host='127.0.0.1', port=0)
+    S.claim_check = CC
+    S.sock.listen(5)
+    threading.Thread(target=S._listen, daemon=True).start()
+    port = S.sock.getsockname()[1]
+
+    request = json.loads(big_body())
+    for C in (sc.Client(host='127.0.0.1', port=port), sc.ClientPool(host='127.0.0.1', port=port)):
+        C.claim_check = CC
+        reply = C.connect(request)
+        assert reply['tested'] == request and len(reply['padding']) == 200000
+        # The request & the reply were both offloaded (& released once received)
+        assert n_blobs(CC.store) == 2 and CC.gc(grace=0) == 2
@@ -0,0 +1,119 @@
+# Import third-party packages
+# --------------------------------------------------------------
+import sys, os
+import datetime
+import threading
+import numpy as np
+import pytest
+
+# Import neighboring packages
+# ---------------------------------------------------------------
+sys.path.append(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+import iod
+import sockets_class as sc
+
+
+# Helper functions
+# ---------------------------------------------------------------
+
+def keplerian_state(a, e, inc, node, peri, M):
+    ''' heliocentric ecliptic position & velocity from elements (angles in degrees) '''
+    inc, node, peri, M = np.radians([inc, node, peri, M])
+    E = M
+    for _ in range(50):
+        E -= (E - e * np.sin(E) - M) / (1 - e * np.cos(E))
+    n       = np.sqrt(iod.gm_sun / a**3)
+    Edot    = n / (1 - e * np.cos(E))
+    p       = np.array([a * (np.cos(E) - e), a * np.sqrt(1 - e**2) * np.sin(E), 0])
+    v       = np.array([-a * np.sin(E) * Edot, a * np.sqrt(1 - e**2) * np.cos(E) * Edot, 0])
+    cw, sw, ci, si, cn, sn = np.cos(peri), np.sin(peri), np.cos(inc), np.sin(inc), np.cos(node), np.sin(node)
+    rotation = np.array([[cn * cw - sn * sw * ci, -cn * sw - sn * cw * ci,  sn * si],
+                         [sn * cw + cn * sw * ci, -sn * sw + cn * cw * ci, -cn * si],
+                         [sw * si,                 cw * si,                  ci]])
+    return rotation @ p, rotation @ v
+
+def simulated_obslist(r0, v0, epoch, mjd_utc):
+    ''' geocentric observations (in the obslist schema) of an object with state r0, v0 at epoch (MJD TT) '''
+    t_tt    = np.asarray(mjd_utc) + iod.tt_minus_utc
+    R       = iod.earth_position(t_tt)
+    r0, v0  = np.tile(r0, (len(t_tt), 1)), np.tile(v0, (len(t_tt), 1))
+    rho     = np.zeros(len(t_tt))
+    for _ in range(3):
+        rho = np.linalg.norm(iod.propagate(r0, v0, t_tt - rho / iod.speed_of_light - epoch) - R, axis=1)
+    ra, dec = iod.radec(iod.propagate(r0, v0, t_tt - rho / iod.speed_of_light - epoch) - R)
+    return [{'obstime'  : (datetime.datetime(1858, 11, 17) + datetime.timedelta(days=float(t))).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z',
+             'ra'       : f'{r:.7f}',
+             'dec'      : f'{d:.7f}',
+             'stn'      : '500'}
+            for t, r, d in zip(mjd_utc, ra, dec)]
+
+def simulated_tracklets(n, seed=1):
+    ''' n main-belt-like objects, each observed three times a night on four nights over a week '''
+    rng             = np.random.default_rng(seed)
+    times           = np.array([night + hour / 24 for night in (0, 1, 3, 7) for hour in (0, 0.5, 1)])
+    data, truth     = {}, {}
+    for i in range(n):
+        elements    = (rng.uniform(1.8, 3.5), rng.uniform(0, 0.3), rng.uniform(0, 25),
+                       rng.uniform(0, 360), rng.uniform(0, 360), rng.uniform(0, 360))
+        epoch       = 59000 + rng.uniform(0, 365)
+        data[f'trk{i}']     = {'obslist': simulated_obslist(*keplerian_state(*elements), epoch, epoch + times)}
+        truth[f'trk{i}']    = elements
+    return data, truth
+
+
+# Tests of the IOD engine
+# ---------------------------------------------------------------
+
+def test_recovers_orbits():
+    ''' Most orbits are recovered (from a week-long arc), as eq0dicts, with ~ milli-arcsec residuals '''
+    data, truth = simulated_tracklets(50)
+    results     = iod.GaussIOD().fit(data)
+
+    n_recovered = 0
+    for key, result in results.items():
+        eq0dict = result['eq0dict']
+        assert set(eq0dict) == {'CAR', 'COM', 'COT', 'EQU', 'KEP', 'eph', 'format', 'name', 'rectype', 'refsys'}
+        assert eq0dict['name'] == key and eq0dict['CAR']['coordtype'] == 'CAR' and eq0dict['COT'] == {}
+        assert result['candidates'][0]['eq0dict'] is eq0dict and result['candidates'][0]['rms_arcsec'] < 0.01
+        if abs(float(eq0dict['KEP']['element0']) - truth[key][0]) < 0.01 * truth[key][0]:
+            assert abs(float(eq0dict['KEP']['element2']) - truth[key][2]) < 0.1
+            n_recovered += 1
+    assert n_recovered >= 40
+
+def test_unusable_tracklets():
+    ''' Tracklets with too few (usable) observations are reported, without affecting the others '''
+    data, _     = simulated_tracklets(1)
+    obs         = data['trk0']['obslist']
+    data['short']       = {'obslist': obs[:2]}
+    data['no_arc']      = {'obslist': [obs[0]] * 3}
+    data['bad_values']  = {'obslist': obs[:2] + [dict(obs[2], ra='None')]}
+    results = iod.GaussIOD().fit(data)
+    assert results['trk0']['candidates']
+    for key in ['short', 'no_arc', 'bad_values']:
+        assert results[key]['eq0dict'] == {} and results[key]['candidates'] == [] and 'exception' in results[key]
+
+def test_large_batch():
+    ''' Thousands of tracklets can be fitted in a single request '''
+    data, _ = simulated_tracklets(1000, seed=2)
+    results = iod.GaussIOD().fit(data)
+    assert sum(bool(r['candidates']) for r in results.values()) > 900
+
+
+# Tests of the server
+# ---------------------------------------------------------------
+
+def test_iod_server():
+    ''' The IOD server checks & fits (wrapped) requests, & its replies pass the client-side checks '''
+    S = sc.OrbfitIODServer(host='127.0.0.1', port=0)
+    S.sock.listen(5)
+    threading.Thread(target=S._listen, daemon=True).start()
+
+    data, _ = simulated_tracklets(3)
+    sc.IOD()._check_data_format_from_client(data)
+    reply   = sc.Client(host='127.0.0.1', port=S.sock.getsockname()[1]).connect({'iod': data})
+    assert set(reply) == set(data)
+    sc.IOD()._check_data_format_from_server(reply)
+
+    with pytest.raises(AssertionError):
+        sc.IOD()._check_data_format_from_client({'trk': {'obslist': data['trk0']['obslist'][:2]}})
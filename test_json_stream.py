@@ -0,0 +1,43 @@
+# Import third-party packages
+# --------------------------------------------------------------
+import sys, os
+import json
+import pytest
+
+# Import neighboring packages
+# ---------------------------------------------------------------
+sys.path.append(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+import json_stream
+import sample_data
+
+
+def chunked(data, size):
+    ''' split bytes into chunks of the given size '''
+    return [data[i:i+size] for i in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7, 64, 10**9])
+def test_iter_object_items(size):
+    ''' The same (key, value) pairs should come out however the bytes are chunked '''
+    obj = { 'K15HI3Q'   : {'obslist': [{'ra': '331.1', 'dec': -7.52}], 'n': 12345678},
+            'numbers'   : 1234567890,
+            'float'     : -1.5e-10,
+            'unicode'   : 'Väisälä ☃',
+            'nested'    : [[], {}, [1, [2, [3]]], None, True, False],
+            'exception' : 'x}y{",:'}
+    data = json.dumps(obj, indent=1, ensure_ascii=False).encode()
+
+    assert list(json_stream.iter_object_items(chunked(data, size))) == list(obj.items())
+
+def test_iter_object_items_sample_data():
+    ''' A realistic payload '''
+    obj = sample_data.sample_orbfit_extension_input_dict()
+    data = json.dumps(obj).encode()
+    assert dict(json_stream.iter_object_items(chunked(data, 1000))) == obj
+
+def test_iter_object_items_edge_cases():
+    assert list(json_stream.iter_object_items([b' {', b' } \n'])) == []
+    for bad in [b'', b'[1,2]', b'{"a":1', b'{"a":1,}', b'{"a" 1}', b'{"a":1} x', b'{a:1}']:
+        with pytest.raises(ValueError):
+            list(json_stream.iter_object_items(chunked(bad, 2)))
@@ -0,0 +1,94 @@
+# Import third-party packages
+# --------------------------------------------------------------
+import sys, os
+import json
+import queue
+import logging
+import subprocess
+import pytest
+
+# Import neighboring packages
+# ---------------------------------------------------------------
+sys.path.append(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+import mpc_logging
+import mpc_sqs
+
+
+# Helper functions
+# ---------------------------------------------------------------
+
+def queue_handlers(logger):
+    ''' the handlers added by mpc_logging (pytest may add its own) '''
+    return [h for h in logger.handlers if isinstance(h, mpc_logging._QueueHandler)]
+
+def read_json_lines(path):
+    mpc_logging.flush()
+    with open(path) as fh:
+        return [json.loads(line) for line in fh]
+
+
+# Tests of the logging pipeline
+# ---------------------------------------------------------------
+
+def test_json_records(tmp_path):
+    ''' Records are written as json-lines, including any extra fields & exceptions '''
+    log = mpc_logging.get_logger('test_json_records', log_file=str(tmp_path / 'a.log'))
+    log.info('hello %s', 'world', extra={'n_bytes': 12})
+    try:
+        1/0
+    except ZeroDivisionError:
+        log.exception('failed')
+    first, second = read_json_lines(tmp_path / 'a.log')
+    assert first['message'] == 'hello world' and first['n_bytes'] == 12
+    assert first['level'] == 'INFO' and first['logger'] == 'test_json_records' and 'time' in first
+    assert second['level'] == 'ERROR' and 'ZeroDivisionError' in second['exception']
+
+    # The same logger (& file-handler) is re-used
+    assert mpc_logging.get_logger('test_json_records') is log and len(queue_handlers(log)) == 1
+
+def test_sampling(tmp_path):
+    ''' Only a sample of the low-level records are written, but every warning '''
+    log = mpc_logging.get_logger('test_sampling', log_file=str(tmp_path / 'b.log'), sample_rate=0)
+    for i in range(100):
+        log.info('frequent')
+    log.info('always', extra={'sample_rate': 1})
+    log.warning('important')
+    assert [r['message'] for r in read_json_lines(tmp_path / 'b.log')] == ['always', 'important']
+
+def test_never_blocks():
+    ''' If the writer cannot keep up, records are dropped rather than block the caller '''
+    handler = mpc_logging._QueueHandler(queue.Queue(maxsize=1), 'unused.log')
+    log = logging.getLogger('test_never_blocks')
+    log.addHandler(handler)
+    log.propagate = False
+    for i in range(10):
+        log.warning('x')
+    assert handler.dropped == 9
+
+def test_mpc_sqs_logs(tmp_path, monkeypatch):
+    ''' mpc_sqs logs to its usual files, via long-lived handlers '''
+    monkeypatch.chdir(tmp_path)
+    mpc_sqs.log_success('delete', [True])
+    mpc_sqs.log_success('delete', [False])
+    logger = mpc_sqs._generate_log('delete', 'INFO')
+    assert len(queue_handlers(logger)) == 1
+    path = queue_handlers(logger)[0].path
+    assert os.path.basename(path) == 'delete_INFO.log'
+    assert [r['message'] for r in read_json_lines(path)][-2:] == ['Deleted: [True]', 'Deleted: [False]']
+
+def test_log_dir(tmp_path, monkeypatch):
+    ''' Log-files named without a directory go to the configured log_dir, as it is when written '''
+    log = mpc_logging.get_logger('test_log_dir')
+    monkeypatch.setattr(mpc_logging, 'log_dir', None)
+    mpc_logging.configure(str(tmp_path))
+    log.warning('configured after the logger was created')
+    assert [r['message'] for r in read_json_lines(tmp_path / 'test_log_dir.log')] == ['configured after the logger was created']
+
+def test_lazy_start():
+    ''' Importing the socket code neither starts the background writer nor opens any file '''
+    code = 'import threading, sockets_class, mpc_logging; print(threading.active_count(), mpc_logging._listener)'
+    output = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.realpath(__file__)),
+                            capture_output=True, text=True, check=True).stdout
+    assert output.split() == ['1', 'None']
@@ -0,0 +1,277 @@
+'''
+Tests of mpc_sqs that do not need access to AWS
+ - (c.f. test_mpc_sqs.py, which sends to the real queue)
+'''
+# Import third-party packages
+# --------------------------------------------------------------
+import sys, os
+import time
+import threading
+import pytest
+from botocore.stub import Stubber, ANY
+
+# Import neighboring packages
+# ---------------------------------------------------------------
+sys.path.append(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+import mpc_sqs
+import queue_backends
+
+
+# Helper functions
+# ---------------------------------------------------------------
+
+@pytest.fixture(autouse=True)
+def in_tmp_path(tmp_path, monkeypatch):
+    ''' The logs get written to the current directory '''
+    monkeypatch.chdir(tmp_path)
+
+def sample_job_dicts(n):
+    return [{'trackletID': f'trk{i}', 'desig12': '     KBA00B', 'mpc_local_queue_destination': 'MBAMOPP'} for i in range(n)]
+
+def aws_message(OES, n):
+    return {'MessageId': f'id{n}', 'ReceiptHandle': f'rh{n}', 'Body': f'body{n}',
+            'MessageAttributes': OES.transform_standard_dict_to_aws_dict(sample_job_dicts(n+1)[n])}
+
+
+# Tests of batching
+# ---------------------------------------------------------------
+
+def test_send_batch_packs_and_retries():
+    '''
+    25 messages -> 3 calls of <= 10 entries
+    Entries that fail through no fault of their own are retried, others are not
+    '''
+    OES = mpc_sqs.OrbfitExtensionSQS()
+    OES.batch_retry_delay = 0
+    job_dicts = sample_job_dicts(25)
+
+    with Stubber(mpc_sqs.sqs.client) as stub:
+        stub.add_response('send_message_batch',
+                          {'Successful': [{'Id': str(i), 'MessageId': f'm{i}', 'MD5OfMessageBody': 'x'} for i in range(8)],
+                           'Failed': [{'Id': '8', 'SenderFault': False, 'Code': 'InternalError'},
+                                      {'Id': '9', 'SenderFault': True, 'Code': 'InvalidParameterValue'}]},
+                          {'QueueUrl': OES.queue_url, 'Entries': ANY})
+        stub.add_response('send_message_batch',
+                          {'Successful': [{'Id': str(i), 'MessageId': f'm{i}', 'MD5OfMessageBody': 'x'} for i in range(10, 20)],
+                           'Failed': []},
+                          {'QueueUrl': OES.queue_url, 'Entries': ANY})
+        stub.add_response('send_message_batch',
+                          {'Successful': [{'Id': str(i), 'MessageId': f'm{i}', 'MD5OfMessageBody': 'x'} for i in range(20, 25)],
+                           'Failed': []},
+                          {'QueueUrl': OES.queue_url, 'Entries': ANY})
+        # The retry only contains the entry that failed through no fault of its own
+        stub.add_response('send_message_batch',
+                          {'Successful': [{'Id': '8', 'MessageId': 'm8', 'MD5OfMessageBody': 'x'}], 'Failed': []},
+                          {'QueueUrl': OES.queue_url, 'Entries': [ANY]})
+
+        message_ids = OES.send_batch(job_dicts)
+
+    assert message_ids == [f'm{i}' if i != 9 else None for i in range(25)]
+
+def test_batch_call_failures(monkeypatch):
+    ''' A failed call is retried, its entries are reported as failed one by one, & there is no sleep after the last attempt '''
+    class FlakyBackend(queue_backends.MemoryBackend):
+        n_failures = 0
+        def send_message_batch(self, QueueUrl, Entries):
+            if self.n_failures > 0:
+                self.n_failures -= 1
+                raise ConnectionError('queue unavailable')
+            return queue_backends.MemoryBackend.send_message_batch(self, QueueUrl, Entries)
+    sleeps = []
+    monkeypatch.setattr(mpc_sqs.time, 'sleep', sleeps.append)
+    OES = mpc_sqs.OrbfitExtensionSQS(backend=FlakyBackend())
+
+    OES.backend.n_failures = 4
+    assert None not in OES.send_batch(sample_job_dicts(25))
+    assert sleeps == [OES.batch_retry_delay, 2 * OES.batch_retry_delay]
+
+    sleeps.clear()
+    OES.backend.n_failures = 100
+    assert OES.send_batch(sample_job_dicts(3)) == [None] * 3
+    assert len(sleeps) == OES.max_batch_retries
+
+def test_read_and_delete_batch():
+    ''' Receipt-handles are kept per message, & used to delete in batches; the queue's visibility timeout is used by default '''
+    OES = mpc_sqs.OrbfitExtensionSQS()
+    with Stubber(mpc_sqs.sqs.client) as stub:
+        stub.add_response('receive_message',
+                          {'Messages': [aws_message(OES, n) for n in range(3)]},
+                          {'QueueUrl': OES.queue_url, 'AttributeNames': ANY, 'MaxNumberOfMessages': 10,
+                           'MessageAttributeNames': ANY, 'WaitTimeSeconds': ANY})
+        stub.add_response('delete_message_batch',
+                          {'Successful': [{'Id': '0'}, {'Id': '1'}], 'Failed': [{'Id':'2', 'SenderFault': True, 'Code': 'x'}]},
+                          {'QueueUrl': OES.queue_url,
+                           'Entries': [{'Id': str(n), 'ReceiptHandle': f'rh{n}'} for n in range(3)]})
+
+        records = OES.read_batch()
+        assert [record['job_dict']['trackletID'] for record in records] == ['trk0', 'trk1', 'trk2']
+        assert [record['receipt_handle'] for record in records] == ['rh0', 'rh1', 'rh2']
+        assert OES.delete_batch(records) == [True, True, False]
+
+def test_auto_ack_batch_send(monkeypatch):
+    ''' The autoack path groups observations by tracklet, & sends one orbit-extension job per tracklet '''
+    monkeypatch.setattr(mpc_sqs, 'sqs', queue_backends.MemoryBackend())
+    monkeypatch.setattr(mpc_sqs.OrbfitExtensionSQS, 'send_delay_seconds', 0)
+    obs_dict = {f'obs{i}': ('MBAMOPP', f'trk{i // 3}', '     KBA00B') for i in range(30)}
+    status = mpc_sqs.auto_ack_batch_send_to_sqs_queue(obs_dict)
+    assert list(status) == [f'trk{i}' for i in range(10)] and None not in status.values()
+
+    # ... which the orbit-extension queue can read back
+    OES = mpc_sqs.OrbfitExtensionSQS()
+    records = OES.read_batch(visibility_timeout=60)
+    assert [record['job_dict'] for record in records] == [{'trackletID': f'trk{i}', 'desig12': '     KBA00B',
+                                                          'mpc_local_queue_destination': 'MBAMOPP'} for i in range(10)]
+    assert [record['message_id'] for record in records] == list(status.values())
+
+def test_batches_respect_size_limit():
+    ''' Batch calls are limited by the total size of their messages, as well as their number '''
+    OES = mpc_sqs.OrbfitExtensionSQS()
+    entries = [{'Id': str(n), 'MessageBody': 'x' * 100000} for n in range(5)]
+    assert [len(batch) for batch in OES._batches(entries)] == [2, 2, 1]
+
+
+# Tests of the tracklet router
+# ---------------------------------------------------------------
+
+def routed_tracklets(n):
+    return [{'trackletID': f'trk{i}', 'desig12': f'desig{i % 7}', 'mpc_local_queue_destination': ['MBAMOPP', 'NEOCP', 'OTHER'][i % 3]}
+            for i in range(n)]
+
+def test_router_packs_and_routes(monkeypatch):
+    ''' Tracklets are packed into size-limited messages on the queue for their destination '''
+    monkeypatch.setattr(mpc_sqs.PackedTrackletSQS, 'send_delay_seconds', 0)
+    backend = queue_backends.MemoryBackend()
+    router  = mpc_sqs.TrackletRouter({'MBAMOPP': 'q-mba', 'NEOCP': 'q-neocp'}, default_queue_url='q-general',
+                                     backend=backend, max_message_bytes=4096)
+    tracklets = routed_tracklets(300)
+    status = router.send(tracklets)
+    assert set(status) == {t['trackletID'] for t in tracklets} and None not in status.values()
+
+    for queue_url, destination in [('q-mba', 'MBAMOPP'), ('q-neocp', 'NEOCP'), ('q-general', 'OTHER')]:
+        PTS = mpc_sqs.PackedTrackletSQS(queue_url, backend=backend)
+        received = []
+        while True:
+            records = PTS.read_batch(visibility_timeout=60)
+            if not records:
+                break
+            for record in records:
+                assert len(record['body'].encode()) <= 4096
+                assert record['job_dict'] == {'mpc_local_queue_destination': destination,
+                                              'n_tracklets': str(len(mpc_sqs.unpack_tracklets(record)))}
+                received.extend(mpc_sqs.unpack_tracklets(record))
+        assert received == [t for t in tracklets if t['mpc_local_queue_destination'] == destination]
+        # Several tracklets per message, several messages per destination
+        assert 10 < len(received) and len(set(status[t['trackletID']] for t in received)) > 1
+
+def test_router_needs_its_own_queues():
+    ''' Packed messages never go to the general orbit-extension queue '''
+    with pytest.raises(AssertionError):
+        mpc_sqs.TrackletRouter()
+    with pytest.raises(AssertionError):
+        mpc_sqs.TrackletRouter(default_queue_url=mpc_sqs.OrbfitExtensionSQS().queue_url)
+    with pytest.raises(AssertionError):
+        mpc_sqs.TrackletRouter({'NEOCP': 'q-neocp'}, backend=queue_backends.MemoryBackend()).send(routed_tracklets(3))
+
+def test_router_reports_failures(monkeypatch):
+    ''' Tracklets whose message could not be sent are reported as None '''
+    class FailingBackend(queue_backends.MemoryBackend):
+        def send_message_batch(self, QueueUrl, Entries):
+            if QueueUrl == 'q-broken':
+                raise ConnectionError('queue unavailable')
+            return queue_backends.MemoryBackend.send_message_batch(self, QueueUrl, Entries)
+    monkeypatch.setattr(mpc_sqs.PackedTrackletSQS, 'batch_retry_delay', 0)
+    router = mpc_sqs.TrackletRouter({'NEOCP': 'q-broken'}, default_queue_url='q-general', backend=FailingBackend())
+    status = router.send(routed_tracklets(30))
+    assert [trackletID for trackletID, message_id in status.items() if message_id is None] == [f'trk{i}' for i in range(1, 30, 3)]
+
+# Tests of the prefetching consumer
+# ---------------------------------------------------------------
+
+class FakeQueueSQS():
+    '''
+    Stand-in for an MPCSQS : serves records from a list, 
+    recording the arguments of each receive
+    '''
+    def __init__(self, records):
+        self.records, self.calls, self.visibility, self.deleted = list(records), [], {}, []
+    def read_batch(self, max_messages=None, wait_time_seconds=0, visibility_timeout=None):
+        self.calls.append((max_messages, wait_time_seconds, visibility_timeout))
+        if not self.records:
+            time.sleep(0.01)
+        batch, self.records = self.records[:max_messages], self.records[max_messages:]
+        return batch
+    def change_visibility(self, record, visibility_timeout):
+        self.visibility[record['receipt_handle']] = visibility_timeout
+    def delete_batch(self, records):
+        self.deleted.extend(record['receipt_handle'] for record in records)
+        return [True for record in records]
+
+def sample_records(n):
+    return [{'job_dict': job_dict, 'receipt_handle': f'rh{i}', 'message_id': f'id{i}', 'body': None,
+             'receive_count': 1, 'received_at': time.monotonic()}
+            for i, job_dict in enumerate(sample_job_dicts(n))]
+
+def test_read_batch_long_polls():
+    ''' The wait-time & visibility-timeout are passed through, & the receive-count is kept '''
+    OES = mpc_sqs.OrbfitExtensionSQS()
+    message = dict(aws_message(OES, 0), Attributes={'ApproximateReceiveCount': '3'})
+    with Stubber(mpc_sqs.sqs.client) as stub:
+        stub.add_response('receive_message', {'Messages': [message]},
+                          {'QueueUrl': OES.queue_url, 'AttributeNames': ANY, 'MaxNumberOfMessages': 5,
+                           'MessageAttributeNames': ANY, 'VisibilityTimeout': 600, 'WaitTimeSeconds': 20})
+        stub.add_response('change_message_visibility', {},
+                          {'QueueUrl': OES.queue_url, 'ReceiptHandle': 'rh0', 'VisibilityTimeout': 0})
+        records = OES.read_batch(max_messages=5, wait_time_seconds=20, visibility_timeout=600)
+        assert records[0]['receive_count'] == 3
+        OES.change_visibility(records[0], 0)
+
+def test_consumer_prefetches_and_acks():
+    ''' The buffer is filled in the background & never over-filled; acks use the per-message handles '''
+    fake = FakeQueueSQS(sample_records(12))
+    consumer = mpc_sqs.MPCSQSConsumer(fake, wait_time_seconds=20, visibility_timeout=600, prefetch=4)
+    records = [consumer.get(timeout=5) for _ in range(12)]
+    assert [record['job_dict']['trackletID'] for record in records] == [f'trk{i}' for i in range(12)]
+    assert consumer.get(timeout=0.05) is None
+    consumer.stop()
+
+    assert all(n <= 4 and wait == 20 and visibility == 600 for n, wait, visibility in fake.calls)
+    assert consumer.ack(records[:2]) == [True, True]
+    assert fake.deleted == ['rh0', 'rh1']
+    consumer.nack(records[2])
+    consumer.extend(records[3])
+    assert fake.visibility == {'rh2': 0, 'rh3': 600}
+
+def test_consumer_drops_expired_messages():
+    ''' Messages whose visibility timeout lapsed while buffered may be with another worker : drop them '''
+    fake = FakeQueueSQS(sample_records(3))
+    for record in fake.records[:2]:
+        record['received_at'] -= 100
+    consumer = mpc_sqs.MPCSQSConsumer(fake, visibility_timeout=60)
+    assert consumer.get(timeout=5)['receipt_handle'] == 'rh2'
+    consumer.stop()
+
+def test_consumer_restart_waits_for_old_fetchers():
+    ''' Restarting after stop(wait=False) never leaves more than n_fetchers polling '''
+    class SlowQueueSQS(FakeQueueSQS):
+        def __init__(self, records):
+            super().__init__(records)
+            self.lock, self.polling, self.max_polling = threading.Lock(), 0, 0
+        def read_batch(self, max_messages=None, wait_time_seconds=0, visibility_timeout=None):
+            with self.lock:
+                self.polling += 1
+                self.max_polling = max(self.max_polling, self.polling)
+            time.sleep(0.2)
+            with self.lock:
+                self.polling -= 1
+            return []
+    fake = SlowQueueSQS([])
+    consumer = mpc_sqs.MPCSQSConsumer(fake, n_fetchers=2).start()
+    time.sleep(0.05)
+    consumer.stop()
+    threads = consumer.start()._threads
+    assert consumer.start()._threads == threads and len(threads) == 2
+    time.sleep(0.3)
+    consumer.stop(wait=True)
+    assert fake.max_polling == 2
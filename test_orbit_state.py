@@ -0,0 +1,85 @@
+# Import third-party packages
+# --------------------------------------------------------------
+import sys, os
+import json
+import pickle
+import numpy as np
+import pytest
+
+# Import neighboring packages
+# ---------------------------------------------------------------
+sys.path.append(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+import orbit_state
+
+
+# Helper functions
+# ---------------------------------------------------------------
+
+@pytest.fixture
+def eq0dicts():
+    with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'testdict.json')) as fh:
+        return {desig: v['eq0dict'] for desig, v in json.load(fh).items()}
+
+def same_values(original, converted):
+    ''' same keys, & every string that parses as a float parses to the identical float '''
+    assert set(original) == set(converted)
+    for k, v in original.items():
+        if isinstance(v, dict):
+            same_values(v, converted[k])
+        elif isinstance(v, list):
+            assert [float(x) for x in v] == [float(x) for x in converted[k]], k
+        else:
+            try:
+                assert float(v) == float(converted[k]), k
+            except ValueError:
+                assert v == converted[k], k
+
+
+# Tests
+# ---------------------------------------------------------------
+
+def test_lossless_dict_conversion(eq0dicts):
+    ''' Parsing & re-formatting an eq0dict gives back the same values '''
+    for eq0dict in eq0dicts.values():
+        state = orbit_state.OrbitState.from_dict(eq0dict)
+        same_values(eq0dict, state.to_dict())
+        assert orbit_state.OrbitState.from_dict(state.to_dict()) == state
+
+def test_parsed_arrays(eq0dicts):
+    ''' Elements & the packed covariance are float64 arrays, & the covariance unpacks symmetrically '''
+    equ = orbit_state.OrbitState.from_dict(eq0dicts['K15HI3Q'])['EQU']
+    assert equ.elements.dtype == np.float64 and equ.elements[0] == float('2.7399005433209478E+00')
+    assert equ.covariance.shape == (21,) and equ.epoch == 58222.741829012
+
+    matrix = equ.covariance_matrix()
+    assert np.array_equal(matrix, matrix.T)
+    assert matrix[0, 5] == equ.covariance[5] and matrix[1, 1] == equ.covariance[6] and matrix[5, 5] == equ.covariance[20]
+    assert np.all(equ.sigmas() > 0)
+    assert equ.extra['coordtype'] == 'EQU' and 'cov00' not in equ.extra
+
+def test_partial_section():
+    ''' Absent numeric fields stay absent '''
+    state = orbit_state.CoordinateState.from_dict({'coordtype': 'KEP', 'element0': '1', 'element1': '2'})
+    assert state.elements is None and state.covariance is None
+    assert state.to_dict() == {'coordtype': 'KEP', 'element0': '1', 'element1': '2'}
+
+def test_pickle(eq0dicts):
+    ''' OrbitStates go through pickle (the socket codec) unchanged, & smaller than the dicts '''
+    for eq0dict in eq0dicts.values():
+        state       = orbit_state.OrbitState.from_dict(eq0dict)
+        restored    = pickle.loads(pickle.dumps(state))
+        assert restored == state and restored['EQU'].elements.flags.writeable
+        assert len(pickle.dumps(state['EQU'])) < len(pickle.dumps(eq0dict['EQU']))
+
+def test_parse_and_format_orbits():
+    ''' The {desig: {'eq0dict': ...}} dicts are converted in-place, & back again '''
+    with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'testdict.json')) as fh:
+        data = json.load(fh)
+    original = json.loads(json.dumps(data))
+    orbit_state.parse_orbits(data)
+    assert all(isinstance(v['eq0dict'], orbit_state.OrbitState) for v in data.values())
+    orbit_state.format_orbits(data)
+    for desig, v in data.items():
+        same_values(original[desig]['eq0dict'], v['eq0dict'])
+        assert v['obslist'] == original[desig]['obslist']
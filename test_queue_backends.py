@@ -0,0 +1,132 @@
+# Import third-party packages
+# --------------------------------------------------------------
+import sys, os
+import threading
+import time
+import pytest
+
+# Import neighboring packages
+# ---------------------------------------------------------------
+sys.path.append(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+import mpc_sqs
+import queue_backends
+import bench_queue_backends
+
+
+# Helper functions
+# ---------------------------------------------------------------
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def backend(request, tmp_path):
+    if request.param == 'memory':
+        return queue_backends.MemoryBackend()
+    return queue_backends.SQLiteBackend(str(tmp_path / 'queues.sqlite'))
+
+@pytest.fixture(autouse=True)
+def in_tmp_path(tmp_path, monkeypatch):
+    ''' The mpc_sqs logs get written to the current directory '''
+    monkeypatch.chdir(tmp_path)
+
+def send(backend, bodies, queue_url='q', delay=0):
+    return backend.send_message_batch(queue_url, [{'Id': str(n), 'MessageBody': body, 'DelaySeconds': delay,
+                                                   'MessageAttributes': {'a': {'DataType': 'String', 'StringValue': body}}}
+                                                  for n, body in enumerate(bodies)])
+
+def receive(backend, n=10, visibility=30, wait=0, queue_url='q'):
+    return backend.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=n,
+                                   VisibilityTimeout=visibility, WaitTimeSeconds=wait).get('Messages', [])
+
+
+# Tests of the local backends
+# ---------------------------------------------------------------
+
+def test_send_receive_delete(backend):
+    ''' Messages come back with their attributes, are hidden once received, & can be deleted '''
+    assert [s['Id'] for s in send(backend, ['x', 'y', 'z'])['Successful']] == ['0', '1', '2']
+    messages = receive(backend, n=2)
+    assert [m['Body'] for m in messages] == ['x', 'y']
+    assert messages[0]['MessageAttributes'] == {'a': {'DataType': 'String', 'StringValue': 'x'}}
+    assert messages[0]['Attributes']['ApproximateReceiveCount'] == '1'
+    assert [m['Body'] for m in receive(backend)] == ['z']
+    assert receive(backend) == [] and receive(backend, queue_url='other') == []
+
+    response = backend.delete_message_batch('q', [{'Id': str(n), 'ReceiptHandle': m['ReceiptHandle']}
+                                                  for n, m in enumerate(messages + [{'ReceiptHandle': 'nonsense:1'}])])
+    assert [s['Id'] for s in response['Successful']] == ['0', '1']
+    assert [f['Id'] for f in response['Failed']] == ['2'] and response['Failed'][0]['SenderFault']
+
+def test_visibility_timeouts(backend):
+    ''' Messages re-appear after their visibility timeout, with a new receipt-handle '''
+    send(backend, ['x'])
+    first = receive(backend, visibility=0.2)[0]
+    assert receive(backend) == []
+    time.sleep(0.3)
+    second = receive(backend, visibility=0.2)[0]
+    assert second['Attributes']['ApproximateReceiveCount'] == '2'
+
+    # Only the latest receipt-handle is valid
+    with pytest.raises(ValueError):
+        backend.delete_message(QueueUrl='q', ReceiptHandle=first['ReceiptHandle'])
+
+    # The visibility can be extended, or ended early
+    backend.change_message_visibility(QueueUrl='q', ReceiptHandle=second['ReceiptHandle'], VisibilityTimeout=10)
+    time.sleep(0.3)
+    assert receive(backend) == []
+    backend.change_message_visibility(QueueUrl='q', ReceiptHandle=second['ReceiptHandle'], VisibilityTimeout=0)
+    third = receive(backend)[0]
+    backend.delete_message(QueueUrl='q', ReceiptHandle=third['ReceiptHandle'])
+    assert receive(backend) == []
+
+def test_delay_and_long_poll(backend):
+    ''' Delayed messages are not visible straight away, & long-polling waits for them '''
+    send(backend, ['x'], delay=0.3)
+    assert receive(backend) == []
+    start = time.monotonic()
+    assert [m['Body'] for m in receive(backend, wait=5)] == ['x']
+    assert 0.2 < time.monotonic() - start < 3
+
+def test_concurrent_receivers_get_distinct_messages(backend):
+    ''' No message is handed to two receivers '''
+    send(backend, [str(i) for i in range(500)])
+    received, lock = [], threading.Lock()
+    def consume():
+        while True:
+            messages = receive(backend)
+            if not messages:
+                return
+            with lock:
+                received.extend(m['Body'] for m in messages)
+    threads = [threading.Thread(target=consume) for _ in range(4)]
+    [thread.start() for thread in threads]
+    [thread.join() for thread in threads]
+    assert sorted(received, key=int) == [str(i) for i in range(500)]
+
+def test_sqlite_is_durable(tmp_path):
+    ''' Messages (& their visibility) survive re-opening the file, e.g. from another process '''
+    path = str(tmp_path / 'queues.sqlite')
+    send(queue_backends.SQLiteBackend(path), ['x', 'y'])
+    receive(queue_backends.SQLiteBackend(path), n=1)
+    assert [m['Body'] for m in receive(queue_backends.SQLiteBackend(path))] == ['y']
+
+def test_mpcsqs_with_local_backend(backend):
+    ''' MPCSQS works the same on a local backend as on SQS '''
+    OES = mpc_sqs.OrbfitExtensionSQS(backend=backend)
+    OES.send_delay_seconds = 0
+    job_dict = {'trackletID': 'trk0', 'desig12': '     KBA00B', 'mpc_local_queue_destination': 'MBAMOPP'}
+    assert OES.send(job_dict, 'body')
+    assert OES.read() == job_dict
+    assert OES.delete()
+    assert OES.read() == {}
+
+def test_sqs_backend_is_lazy():
+    ''' No boto3 client is created until the first call '''
+    backend = queue_backends.SQSBackend()
+    assert backend._client is None
+    assert backend.client is backend.client
+
+def test_benchmark(tmp_path):
+    ''' The benchmark runs (a small number of messages) on the local backends '''
+    results = bench_queue_backends.benchmark(queue_backends.MemoryBackend(), 'q', n_messages=200)
+    assert set(results) == {'send', 'receive', 'delete'} and all(rate > 0 for rate in results.values())
@@ -0,0 +1,397 @@
+# Import third-party packages
+# --------------------------------------------------------------
+import sys, os
+import json
+import threading
+import time
+import pytest
+from wsgiref.simple_server import make_server
+
+# Import neighboring packages
+# ---------------------------------------------------------------
+sys.path.append(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+import remote
+import remote_gateway
+import remote_cache
+import request_policies
+
+
+# Helper functions
+# ---------------------------------------------------------------
+
+class EchoApp(remote_gateway.Gateway):
+    '''
+    Stand-in for the gateway : replies with {desig: {'fitted': value}} for each input designation
+     - Any designation starting with "BAD" causes an error reply for the whole request
+     - The remote_version endpoint is the real one
+    '''
+    def __init__(self,):
+        remote_gateway.Gateway.__init__(self, result_version='v1')
+        self.n_requests = 0
+        self.desigs_received = []
+        self.content_encodings = []
+        self.delay = 0
+        self.version_delay = 0
+        self.n_failures = 0
+    def __call__(self, environ, start_response):
+        if environ['PATH_INFO'].endswith('remote_version'):
+            time.sleep(self.version_delay)
+            return self.version(environ, start_response)
+        self.n_requests += 1
+        time.sleep(self.delay)
+        if self.n_failures > 0:
+            self.n_failures -= 1
+            start_response('503 Service Unavailable', [('Content-Length', '0')])
+            return [b'']
+        self.content_encodings.append(environ.get('HTTP_CONTENT_ENCODING'))
+        input_dict = json.loads(self._read_body(environ))
+        self.desigs_received.extend(input_dict)
+        if any(desig.startswith('BAD') for desig in input_dict):
+            result_dict = {'exception': 'bad designation', 'file': __file__}
+        else:
+            result_dict = {desig: {'fitted': v} for desig, v in input_dict.items()}
+        return self._respond(environ, start_response, '200 OK', result_dict)
+
+def start_gateway():
+    ''' Launch an EchoApp on an ephemeral local port : returns (app, base_url, httpd) '''
+    app = EchoApp()
+    httpd = make_server('127.0.0.1', 0, app,
+                        server_class=remote_gateway.ThreadingWSGIServer,
+                        handler_class=remote_gateway.QuietWSGIRequestHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return app, f'http://127.0.0.1:{httpd.server_port}/cgi-bin/cgipy', httpd
+
+@pytest.fixture
+def local_gateway():
+    ''' An EchoApp on an ephemeral local port : returns (app, base_url) '''
+    app, base_url, httpd = start_gateway()
+    yield app, base_url
+    httpd.shutdown()
+    httpd.server_close()
+
+@pytest.fixture
+def backup_gateway():
+    ''' A second EchoApp '''
+    app, base_url, httpd = start_gateway()
+    yield app, base_url
+    httpd.shutdown()
+    httpd.server_close()
+
+
+# Tests of the batch API
+# ---------------------------------------------------------------
+
+def test_chunk_json():
+    ''' Chunks should respect the designation & byte limits, and be valid json '''
+    R = remote.Remote(base_url='http://127.0.0.1:1')
+    input_dict = {f'desig{i}': {'obslist': [i]*i} for i in range(100)}
+
+    chunks = R._chunk_json(input_dict, max_designations=7, max_bytes=10**9)
+    assert [len(desigs) for desigs, _ in chunks] == [7]*14 + [2]
+
+    chunks = R._chunk_json(input_dict, max_designations=1000, max_bytes=500)
+    recombined = {}
+    for desigs, chunk_json in chunks:
+        assert len(chunk_json) <= 500 or len(desigs) == 1
+        chunk_dict = json.loads(chunk_json)
+        assert list(chunk_dict) == desigs
+        recombined.update(chunk_dict)
+    assert recombined == input_dict
+
+def test_request_orbit_extension_many(local_gateway):
+    ''' Results from all chunks are merged, & failed chunks are reported separately '''
+    app, base_url = local_gateway
+    input_dict = {f'desig{i}': i for i in range(95)}
+    input_dict['BAD1'] = -1
+
+    R = remote.Remote(base_url=base_url, max_workers=3)
+    reply = R.request_orbit_extension_many(input_dict, max_designations=10)
+
+    assert app.n_requests == 10
+    assert reply['results'] == {f'desig{i}': {'fitted': i} for i in range(90)}
+    assert len(reply['errors']) == 1
+    assert reply['errors'][0]['designations'] == [f'desig{i}' for i in range(90,95)] + ['BAD1']
+    assert reply['errors'][0]['exception'] == 'bad designation'
+
+    # Async version gives the same answer
+    future = R.request_orbit_extension_many_async(input_dict, max_designations=10)
+    assert future.result(timeout=10) == reply
+
+def test_request_compression(local_gateway):
+    ''' Compressed requests (& replies) are transparent to the caller '''
+    app, base_url = local_gateway
+    input_dict = {f'desig{i}': {'obslist': ['None']*100} for i in range(20)}
+
+    R = remote.Remote(base_url=base_url, request_encoding='gzip')
+    reply = R.request_orbit_extension_many(input_dict, max_designations=10)
+    assert reply['results'] == {desig: {'fitted': v} for desig, v in input_dict.items()}
+    assert app.content_encodings == ['gzip', 'gzip']
+
+    with pytest.raises(AssertionError):
+        remote.Remote(base_url=base_url, request_encoding='br')
+
+def test_iter_orbit_extension(local_gateway):
+    ''' Streamed results are the same as the non-streamed ones '''
+    app, base_url = local_gateway
+    input_dict = {f'desig{i}': {'obslist': ['None']*i} for i in range(50)}
+    R = remote.Remote(base_url=base_url)
+
+    pairs = list(R.iter_orbit_extension(json.dumps(input_dict)))
+    assert dict(pairs) == R.request_orbit_extension_json(json.dumps(input_dict))
+    assert [desig for desig, _ in pairs] == list(input_dict)
+
+    # Errors are reported as an 'exception' pair
+    pairs = list(remote.Remote(base_url='http://127.0.0.1:1').iter_orbit_extension(json.dumps(input_dict)))
+    assert len(pairs) == 1 and pairs[0][0] == 'exception'
+
+
+# Tests of the result cache
+# ---------------------------------------------------------------
+
+def test_cache_only_sends_changed_designations(local_gateway, tmp_path):
+    ''' Unchanged designations should never touch the network '''
+    app, base_url = local_gateway
+    cache = remote_cache.ResultCache(path=str(tmp_path / 'cache.sqlite'))
+    R = remote.Remote(base_url=base_url, cache=cache)
+    input_dict = {f'desig{i}': i for i in range(20)}
+
+    first = R.request_orbit_extension_many(input_dict)
+    assert len(app.desigs_received) == 20 and len(cache) == 20
+
+    # Nothing changed : nothing sent
+    app.desigs_received.clear()
+    assert R.request_orbit_extension_many(input_dict) == first
+    assert app.desigs_received == []
+
+    # One designation changed : only that one is sent
+    input_dict['desig3'] = 'changed'
+    reply = R.request_orbit_extension_many(input_dict)
+    assert app.desigs_received == ['desig3']
+    assert reply['results']['desig3'] == {'fitted': 'changed'}
+    assert reply['results']['desig4'] == {'fitted': 4}
+
+def test_cache_revalidation(local_gateway):
+    ''' Stale entries are re-used only while the server's result-version is unchanged '''
+    app, base_url = local_gateway
+    cache = remote_cache.ResultCache(path=':memory:', ttl=-1)
+    R = remote.Remote(base_url=base_url, cache=cache)
+    input_dict = {f'desig{i}': i for i in range(5)}
+
+    R.request_orbit_extension_many(input_dict)
+    assert R._version == 'v1'
+
+    # Stale, but version unchanged (304 from the server) : nothing re-sent
+    app.desigs_received.clear()
+    R.request_orbit_extension_many(input_dict)
+    assert app.desigs_received == []
+
+    # Version changed : everything re-sent
+    app.result_version = 'v2'
+    R.request_orbit_extension_many(input_dict)
+    assert sorted(app.desigs_received) == sorted(input_dict)
+    assert R._version == 'v2'
+
+def test_cache_revalidation_timeout(local_gateway):
+    ''' If the result-version does not arrive in time, stale entries are simply fetched afresh '''
+    app, base_url = local_gateway
+    cache = remote_cache.ResultCache(path=':memory:', ttl=-1)
+    R = remote.Remote(base_url=base_url, cache=cache)
+    R.default_version_timeout = 0.2
+    input_dict = {f'desig{i}': i for i in range(5)}
+    R.request_orbit_extension_many(input_dict)
+
+    # (had we waited for the version, it would be 'v1' : unchanged, so nothing would be re-sent)
+    app.version_delay, app.desigs_received = 2.0, []
+    assert R.request_orbit_extension_many(input_dict)['results'] == {desig: {'fitted': v} for desig, v in input_dict.items()}
+    assert sorted(app.desigs_received) == sorted(input_dict) and R._version is None
+
+def test_cache_size_eviction():
+    ''' Least-recently-used entries are evicted first '''
+    cache = remote_cache.ResultCache(path=':memory:', max_bytes=100)
+    cache.put_many({'a': 'x'*40})
+    cache.put_many({'b': 'y'*40})
+    cache.get_many(['a'])
+    cache.put_many({'c': 'z'*40})
+    fresh, stale = cache.get_many(['a', 'b', 'c'])
+    assert sorted(fresh) == ['a', 'c'] and stale == {}
+
+
+# Tests of retries & hedging
+# ---------------------------------------------------------------
+
+def test_retry_after_failures(local_gateway, backup_gateway):
+    ''' Failed attempts are retried (on the next backend) while the budget allows '''
+    app, base_url = local_gateway
+    backup_app, backup_url = backup_gateway
+    app.n_failures = 10
+    sample = json.dumps({'desig': 1})
+
+    retry = request_policies.RetryPolicy(max_attempts=3, base_delay=0.01)
+    R = remote.Remote(base_url=base_url, backup_base_urls=[backup_url], retry=retry)
+    assert R.request_test_json(sample) == {'desig': {'fitted': 1}}
+    assert (app.n_requests, backup_app.n_requests) == (1, 1)
+
+    # With no backup & an empty budget there are no retries
+    budget = request_policies.RetryBudget(initial_tokens=0)
+    R = remote.Remote(base_url=base_url, retry=retry, retry_budget=budget)
+    assert 'exception' in R.request_test_json(sample)
+    assert app.n_requests == 2
+
+    # Unless given their own, instances share a budget
+    assert remote.Remote(base_url=base_url).retry_budget is remote.Remote(base_url=base_url, retry=True).retry_budget
+
+def test_no_retry_of_submissions(local_gateway, backup_gateway):
+    ''' Job submissions would run the job twice : they are never retried or hedged '''
+    app, base_url = local_gateway
+    backup_app, backup_url = backup_gateway
+    sample = json.dumps({'desig': 1})
+    R = remote.Remote(base_url=base_url, backup_base_urls=[backup_url], retry=True,
+                      hedge=request_policies.HedgePolicy(default_delay=0.01))
+
+    app.n_failures = 1
+    assert 'exception' in R.submit_orbit_extension_json(sample)
+    app.delay = 0.2
+    R.submit_orbit_extension_json(sample)
+    assert (app.n_requests, backup_app.n_requests) == (2, 0)
+
+    # ... & nor is anything that is not in idempotent_scripts
+    R = remote.Remote(base_url=base_url, backup_base_urls=[backup_url], retry=True, idempotent_scripts=[])
+    app.n_failures = 1
+    assert 'exception' in R.request_test_json(sample)
+    assert backup_app.n_requests == 0
+
+def test_hedged_request(local_gateway, backup_gateway):
+    ''' A stalled backend is hedged against : the first reply wins '''
+    app, base_url = local_gateway
+    backup_app, backup_url = backup_gateway
+    app.delay = 2.0
+    sample = json.dumps({'desig': 1})
+
+    hedge = request_policies.HedgePolicy(default_delay=0.1)
+    R = remote.Remote(base_url=base_url, backup_base_urls=[backup_url], hedge=hedge)
+    start = time.monotonic()
+    assert R.request_test_json(sample) == {'desig': {'fitted': 1}}
+    assert time.monotonic() - start < 1.0
+    assert backup_app.n_requests == 1
+
+def test_hedged_orbit_fit(local_gateway, backup_gateway):
+    ''' A stalled orbit-fit is hedged against (& retried) like any other idempotent request '''
+    app, base_url = local_gateway
+    backup_app, backup_url = backup_gateway
+    app.delay = 2.0
+    sample = json.dumps({'desig': 1})
+
+    R = remote.Remote(base_url=base_url, backup_base_urls=[backup_url], hedge=request_policies.HedgePolicy(default_delay=0.1),
+                      retry=request_policies.RetryPolicy(base_delay=0.01), retry_budget=request_policies.RetryBudget())
+    assert R.request_orbit_extension_json(sample) == {'desig': {'fitted': 1}}
+    assert R.request_iod_json(sample) == {'desig': {'fitted': 1}}
+    assert backup_app.n_requests == 2
+
+def test_hedge_closes_losing_reply():
+    ''' The reply to the losing request of a hedge is closed (so that its connection is released) '''
+    class FakeReply():
+        def __init__(self, delay):
+            self.delay, self.closed = delay, False
+        def close(self):
+            self.closed = True
+    replies = {'slow': FakeReply(0.3), 'fast': FakeReply(0)}
+    def timed_put(url, data, headers, stream=False):
+        time.sleep(replies[url].delay)
+        return replies[url]
+
+    R = remote.Remote(base_url='http://127.0.0.1:1', hedge=request_policies.HedgePolicy(default_delay=0.05),
+                      retry_budget=request_policies.RetryBudget())
+    R._timed_put = timed_put
+    assert R._hedged_put(['slow', 'fast'], b'', {}, stream=True) is replies['fast']
+    for _ in range(100):
+        if replies['slow'].closed:
+            break
+        time.sleep(0.01)
+    assert replies['slow'].closed and not replies['fast'].closed
+
+def test_policies():
+    ''' Unit tests of the budget, back-off & latency-percentiles '''
+    budget = request_policies.RetryBudget(ratio=0.5, max_tokens=2, initial_tokens=0)
+    assert not budget.withdraw()
+    budget.deposit(); budget.deposit()
+    assert budget.withdraw() and not budget.withdraw()
+
+    retry = request_policies.RetryPolicy(base_delay=1, max_delay=3)
+    assert all(0 <= retry.backoff(n) <= min(3, 2**(n-1)) for n in range(1, 10) for _ in range(10))
+
+    tracker = request_policies.LatencyTracker(min_samples=10)
+    assert tracker.percentile(95) is None
+    for latency in range(1, 101):
+        tracker.record(latency)
+    assert tracker.percentile(50) in (50, 51) and tracker.percentile(95) in (95, 96)
+
+def test_adaptive_limiter():
+    ''' The limit grows while latency is flat, & shrinks (once per overload) on rejections or queueing '''
+    limiter = request_policies.AdaptiveLimiter(initial_limit=2, max_limit=8)
+    assert limiter.acquire() and limiter.acquire() and not limiter.acquire(timeout=0.01)
+    limiter.release(1e-6); limiter.release(1e-6)
+
+    # Flat latency (& the limit in use) : additive increase, up to max_limit
+    for _ in range(100):
+        n = limiter.limit
+        for _ in range(n):
+            limiter.acquire()
+        for _ in range(n):
+            limiter.release(1e-6)
+    assert limiter.limit == 8 and limiter.in_flight == 0
+
+    # A rejection : multiplicative decrease ...
+    limiter.acquire(); limiter.acquire()
+    limiter.release(1e-6, dropped=True)
+    assert limiter.limit == 6
+    # ... but a request that was already in flight at the time does not decrease it again
+    limiter.release(1e3, dropped=True)
+    assert limiter.limit == 6 and limiter.metrics()['n_dropped'] == 2
+
+    # Slower requests of another kind are not mistaken for queueing, but slow-downs of the same kind are
+    for _ in range(20):
+        limiter.acquire()
+        limiter.release(1e-3, key='slow')
+    assert limiter.metrics()['n_decreases'] == 1
+    for _ in range(20):
+        limiter.acquire()
+        limiter.release(1e-5)
+    assert limiter.metrics()['n_decreases'] > 1 and limiter.limit < 6
+
+def test_adaptive_limiter_finds_capacity():
+    ''' Against a server whose latency grows once more than 4 requests are in flight, the limit settles near 4 '''
+    capacity, base_latency = 4, 0.005
+    limiter = request_policies.AdaptiveLimiter(initial_limit=1, max_limit=32)
+    lock, in_server, limits = threading.Lock(), [0], []
+
+    def client():
+        for _ in range(60):
+            with limiter.slot():
+                with lock:
+                    in_server[0] += 1
+                    latency = base_latency * max(1, in_server[0] / capacity)
+                time.sleep(latency)
+                with lock:
+                    in_server[0] -= 1
+            limits.append(limiter.limit)
+
+    threads = [threading.Thread(target=client) for _ in range(16)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    settled = limits[len(limits) // 2:]
+    assert 2 <= sum(settled) / len(settled) <= 10
+
+def test_request_many_with_limiter(local_gateway):
+    ''' With a limiter the batch results are unchanged, & failed chunks count as rejections '''
+    app, base_url = local_gateway
+    input_dict = {f'desig{i}': i for i in range(95)}
+    input_dict['BAD1'] = -1
+
+    R = remote.Remote(base_url=base_url, limiter=True)
+    reply = R.request_orbit_extension_many(input_dict, max_designations=10)
+    assert reply['results'] == {f'desig{i}': {'fitted': i} for i in range(90)}
+    assert len(reply['errors']) == 1
+    assert R.limiter.in_flight == 0 and R.limiter.metrics()['n_dropped'] == 1
@@ -0,0 +1,316 @@
+# Import third-party packages
+# --------------------------------------------------------------
+import sys, os
+import io
+import json
+import threading
+import socket
+import time
+import pytest
+
+# Import neighboring packages
+# ---------------------------------------------------------------
+sys.path.append(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+import sockets_class as sc
+import remote_gateway
+import compression
+import sample_data
+
+
+# Helper functions
+# ---------------------------------------------------------------
+
+@pytest.fixture
+def local_server():
+    '''
+    Launch a test server (the base sc.Server echoes its input) on an
+    ephemeral local port & return its port number
+     - NB: the server thread is a daemon, so is left running until the tests exit
+    '''
+    S = sc.Server(host='127.0.0.1', port=0)
+    S.sock.listen(5)
+    threading.Thread(target=S._listen, daemon=True).start()
+    return S.sock.getsockname()[1]
+
+def call_gateway(app, path, body=b'', **extra_environ):
+    '''
+    Call the WSGI app directly & return (status, decoded-json-reply)
+     - decompresses the reply if necessary
+    '''
+    captured = {}
+    def start_response(status, headers):
+        captured['status'] = status
+        captured['headers'] = dict(headers)
+    environ = { 'PATH_INFO' : path,
+                'REQUEST_METHOD' : 'PUT',
+                'CONTENT_LENGTH' : str(len(body)),
+                'wsgi.input' : io.BytesIO(body)}
+    environ.update(extra_environ)
+    iterable = app(environ, start_response)
+    reply = b''.join(iterable)
+    if hasattr(iterable, 'close'):
+        iterable.close()
+    if 'Content-Encoding' in captured['headers']:
+        reply = compression.decompress(reply, captured['headers']['Content-Encoding'])
+    return captured['status'], json.loads(reply)
+
+
+# Tests of the gateway
+# ---------------------------------------------------------------
+
+def test_gateway_routes_to_server(local_server):
+    '''
+    The gateway should give the same reply as the cgi-scripts,
+    with & without the .cgi suffix, re-using its pooled connection
+    '''
+    app = remote_gateway.Gateway(host='127.0.0.1', port=local_server)
+    sample = {'k':'v'}
+
+    for path in ['/remote_test', '/cgi-bin/cgipy/remote_test.cgi', '/remote_test']:
+        status, result_dict = call_gateway(app, path, json.dumps(sample).encode())
+        assert status.startswith('200')
+        assert result_dict == {'tested': {'test': sample}}
+
+    # All of the above went through a single pooled connection
+    assert app.pool._idle.qsize() == 1
+    app.pool.close()
+
+def test_gateway_empty_and_unknown(local_server):
+    ''' Empty input & unknown endpoints are reported back in a dictionary '''
+    app = remote_gateway.Gateway(host='127.0.0.1', port=local_server)
+
+    status, result_dict = call_gateway(app, '/remote_test')
+    assert status.startswith('200') and result_dict['No Usable Input']
+
+    status, result_dict = call_gateway(app, '/remote_nonsense', b'{}')
+    assert status.startswith('404') and 'exception' in result_dict
+
+def test_gateway_metrics(local_server):
+    ''' With a limiter, requests are counted in & out, & the current limit is reported '''
+    app = remote_gateway.Gateway(host='127.0.0.1', port=local_server, max_connections=6, limiter=True)
+    for i in range(5):
+        status, result_dict = call_gateway(app, '/remote_test', json.dumps({'n': i}).encode())
+        assert result_dict == {'tested': {'test': {'n': i}}}
+
+    status, metrics = call_gateway(app, '/remote_metrics')
+    assert status.startswith('200') and metrics['max_connections'] == 6
+    assert 1 <= metrics['concurrency']['limit'] <= 6 and metrics['concurrency']['in_flight'] == 0
+    app.pool.close()
+
+    app = remote_gateway.Gateway(host='127.0.0.1', port=local_server)
+    assert call_gateway(app, '/remote_metrics')[1]['concurrency'] is None
+
+def test_client_pool_reconnects(local_server):
+    ''' A pooled socket that has been closed should be transparently replaced '''
+    pool = sc.ClientPool(host='127.0.0.1', port=local_server)
+    assert pool.connect({'n':1}) == {'tested': {'n':1}}
+
+    # Break the idle connection behind the pool's back
+    pool._idle.queue[0].shutdown(socket.SHUT_RDWR)
+
+    assert pool.connect({'n':2}) == {'tested': {'n':2}}
+    pool.close()
+
+def test_client_pool_no_retry_after_timeout():
+    ''' A request that times out is not sent again, even on a re-used socket (the server may still be running it) '''
+    class SlowServer(sc.Server):
+        n_requests = 0
+        def _function_to_be_evaluated(self, data_dict):
+            SlowServer.n_requests += 1
+            time.sleep(0.5 if 'sleep' in str(data_dict) else 0)
+            return sc.Server._function_to_be_evaluated(self, data_dict)
+    S = SlowServer(host='127.0.0.1', port=0)
+    S.sock.listen(5)
+    threading.Thread(target=S._listen, daemon=True).start()
+
+    pool = sc.ClientPool(host='127.0.0.1', port=S.sock.getsockname()[1])
+    pool.default_timeout = 0.2
+    assert pool.connect({'n':1}) == {'tested': {'n':1}}
+    for request in (pool.connect, lambda data: pool.connect_raw('test', json.dumps(data).encode())):
+        with pytest.raises(socket.timeout):
+            request({'sleep': True})
+    time.sleep(0.5)
+    assert SlowServer.n_requests == 3 and pool._idle.qsize() == 0
+    pool.close()
+
+def test_gateway_passthrough(local_server):
+    '''
+    Pass-through mode should give the same reply as the decode/re-encode path,
+    and the pooled connection should be re-usable afterwards
+    '''
+    app = remote_gateway.Gateway(host='127.0.0.1', port=local_server, passthrough=True)
+    sample = {'K15HI3Q': {'obslist':[{}, {}], 'rwodict':{}, 'eq0dict':{}}}
+
+    for _ in range(3):
+        status, result_dict = call_gateway(app, '/remote_test', b'  ' + json.dumps(sample).encode() + b'\n')
+        assert status.startswith('200')
+        assert result_dict == {'tested': {'test': sample}}
+    assert app.pool._idle.qsize() == 1
+
+    # Things that are obviously not json-objects are rejected without contacting the server
+    status, result_dict = call_gateway(app, '/remote_test', b'[1,2,3]')
+    assert 'exception' in result_dict
+    app.pool.close()
+
+def test_gateway_passthrough_limiter(local_server):
+    ''' Pass-through & streamed requests hold a limiter-slot until their reply has been read '''
+    app = remote_gateway.Gateway(host='127.0.0.1', port=local_server, passthrough=True, limiter=True)
+    limiter, sample = app.pool.limiter, {'K15HI3Q': {'obslist':[{}, {}], 'rwodict':{}, 'eq0dict':{}}}
+    for _ in range(3):
+        status, result_dict = call_gateway(app, '/remote_test', json.dumps(sample).encode())
+        assert result_dict == {'tested': {'test': sample}}
+    assert limiter.in_flight == 0 and limiter.metrics()['n_dropped'] == 0
+
+    # The slot is held while the reply is being read
+    reply = app.pool.connect_raw('test', json.dumps(sample).encode())
+    assert limiter.in_flight == 1
+    assert json.loads(reply.read()) == {'tested': {'test': sample}}
+    assert limiter.in_flight == 0
+
+    assert app.pool.connect_stream(sample, request_type='test') == {'tested': {'test': sample}}
+    assert limiter.in_flight == 0 and limiter.metrics()['n_dropped'] == 0
+    app.pool.close()
+
+def test_check_json_bytes():
+    ''' Light structural checks on json bytes '''
+    import remote_general as rg
+    rg.check_json_bytes(b'{}')
+    rg.check_json_bytes(b' \n{"a": [1]}\r\n')
+    for bad in [b'', b'   ', b'[]', b'{"a":1', b'"{}"']:
+        with pytest.raises(AssertionError):
+            rg.check_json_bytes(bad)
+
+
+# Tests of micro-batching
+# ---------------------------------------------------------------
+
+class CountingClient():
+    ''' Stand-in for a client : replies with one entry per designation & records each call '''
+    max_connections = 4
+    def __init__(self,):
+        self.calls = []
+    def connect(self, request_dict):
+        self.calls.append(request_dict)
+        request_type, input_dict = next(iter(request_dict.items()))
+        reply = {desig: {'fitted': v, 'request_type': request_type} for desig, v in input_dict.items()}
+        reply['n_in_batch'] = len(input_dict)
+        return reply
+
+def test_micro_batcher():
+    '''
+    Concurrent single-designation orbfit requests should be combined,
+    and each caller should only get back their own designation(s)
+    '''
+    C = CountingClient()
+    B = remote_gateway.MicroBatcher(C, window=0.2, max_batch_size=100)
+    n = 20
+    results = [None]*n
+
+    def call(i):
+        results[i] = B.connect({'orbfit': {f'desig{i}': i}})
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(n)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+
+    assert len(C.calls) < n
+    for i, result_dict in enumerate(results):
+        assert result_dict[f'desig{i}'] == {'fitted': i, 'request_type': 'orbfit'}
+        assert len([k for k in result_dict if k.startswith('desig')]) == 1
+        assert result_dict['n_in_batch'] >= 1
+
+def test_micro_batcher_isolates_bad_requests():
+    ''' A request that fails the batch it is in is re-sent on its own, so it only fails its own caller '''
+    class PickyClient(CountingClient):
+        def connect(self, request_dict):
+            input_dict = next(iter(request_dict.values()))
+            if 'BAD' in input_dict:
+                self.calls.append(request_dict)
+                raise ConnectionError('Server closed the connection')
+            if 'ERR' in input_dict:
+                self.calls.append(request_dict)
+                return {'exception': 'unreadable designation'}
+            return CountingClient.connect(self, request_dict)
+
+    C = PickyClient()
+    B = remote_gateway.MicroBatcher(C, window=0.2, max_batch_size=100)
+    requests = [{f'desig{i}': i} for i in range(6)] + [{'BAD': 0}, {'ERR': 0}]
+    results = [None]*len(requests)
+
+    def call(i):
+        try:
+            results[i] = B.connect({'orbfit': requests[i]})
+        except ConnectionError as e:
+            results[i] = e
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(len(requests))]
+    for t in threads: t.start()
+    for t in threads: t.join()
+
+    for i in range(6):
+        assert results[i][f'desig{i}'] == {'fitted': i, 'request_type': 'orbfit'}
+    assert isinstance(results[6], ConnectionError)
+    assert results[7] == {'exception': 'unreadable designation'}
+    # The bad requests were batched with the good ones, & then re-sent on their own
+    batched = [next(iter(call.values())) for call in C.calls]
+    assert any('BAD' in input_dict and len(input_dict) > 1 for input_dict in batched)
+    assert {'BAD': 0} in batched and {'ERR': 0} in batched
+
+def test_micro_batcher_split_and_passthrough():
+    ''' Duplicate designations go in separate batches, & other request-types are not batched '''
+    batch = [('orbfit', {'a':1, 'b':2}, None), ('orbfit', {'b':3}, None), ('orbfit', {'c':4}, None)]
+    sub_batches = remote_gateway.MicroBatcher._split(batch)
+    assert [[item[1] for item in sub] for sub in sub_batches] == [[{'a':1, 'b':2}, {'c':4}], [{'b':3}]]
+
+    C = CountingClient()
+    B = remote_gateway.MicroBatcher(C, window=0.01)
+    assert B.connect({'test': {'x':1}})['x']['request_type'] == 'test'
+    assert B._thread is None
+
+
+# Tests of compression
+# ---------------------------------------------------------------
+
+@pytest.mark.parametrize('passthrough', [False, True])
+@pytest.mark.parametrize('encoding', ['gzip', 'deflate'])
+def test_gateway_compression(local_server, passthrough, encoding):
+    ''' Compressed requests are decompressed, & replies compressed when accepted '''
+    app = remote_gateway.Gateway(host='127.0.0.1', port=local_server, passthrough=passthrough)
+    sample = sample_data.sample_orbfit_extension_input_dict()
+    body = compression.compress(json.dumps(sample).encode(), encoding)
+    assert len(body) < len(json.dumps(sample)) / 5
+
+    status, result_dict = call_gateway(app, '/remote_test', body,
+                                        HTTP_CONTENT_ENCODING=encoding,
+                                        HTTP_ACCEPT_ENCODING='gzip, deflate')
+    assert status.startswith('200')
+    assert result_dict == {'tested': {'test': sample}}
+
+    # Unknown encodings are rejected
+    status, result_dict = call_gateway(app, '/remote_test', body, HTTP_CONTENT_ENCODING='br')
+    assert status.startswith('400') and 'exception' in result_dict
+    app.pool.close()
+
+@pytest.mark.parametrize('encoding', ['gzip', 'deflate', 'identity'])
+def test_gateway_request_size_limit(local_server, encoding):
+    ''' Request bodies that are (or inflate to) more than max_request_bytes are rejected with a 413 '''
+    app = remote_gateway.Gateway(host='127.0.0.1', port=local_server, max_request_bytes=1000000)
+    sample = sample_data.sample_orbfit_extension_input_dict()
+    body = json.dumps(sample).encode()
+    assert len(body) < 1000000
+    bomb = json.dumps({'padding': ' ' * 50000000}).encode()
+    if encoding != 'identity':
+        body, bomb = compression.compress(body, encoding), compression.compress(bomb, encoding)
+        assert len(bomb) < 1000000
+
+    status, result_dict = call_gateway(app, '/remote_test', body, HTTP_CONTENT_ENCODING=encoding)
+    assert status.startswith('200') and result_dict == {'tested': {'test': sample}}
+    status, result_dict = call_gateway(app, '/remote_test', bomb, HTTP_CONTENT_ENCODING=encoding)
+    assert status.startswith('413') and 'exception' in result_dict
+    app.pool.close()
+
+def test_choose_encoding():
+    assert compression.choose_encoding('gzip, deflate') == 'deflate'
+    assert compression.choose_encoding('gzip;q=1.0, deflate;q=0') == 'gzip'
+    assert compression.choose_encoding('*') == 'deflate'
+    assert compression.choose_encoding('br') is None
+    assert compression.choose_encoding(None) is None
@@ -0,0 +1,109 @@
+# Import third-party packages
+# --------------------------------------------------------------
+import sys, os
+import json
+import threading
+import time
+import pytest
+from wsgiref.simple_server import make_server
+
+# Import neighboring packages
+# ---------------------------------------------------------------
+sys.path.append(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+import remote
+import remote_gateway
+import remote_jobs
+
+
+# Helper functions
+# ---------------------------------------------------------------
+
+class GatedClient():
+    '''
+    Stand-in for a client : replies with one entry per designation,
+    but each call waits until it is allowed to proceed (if gated)
+    '''
+    def __init__(self, gated=False):
+        self.calls = []
+        self.gate = threading.Semaphore(0) if gated else None
+    def connect(self, request_dict):
+        if self.gate is not None:
+            assert self.gate.acquire(timeout=10)
+        request_type, input_dict = next(iter(request_dict.items()))
+        self.calls.append(list(input_dict))
+        return {desig: {'fitted': v} for desig, v in input_dict.items()}
+
+
+# Tests of the job runner
+# ---------------------------------------------------------------
+
+def test_job_partial_results_and_long_poll(tmp_path):
+    ''' Partial results are visible while the job runs, & long-polling waits for the end '''
+    C = GatedClient(gated=True)
+    runner = remote_jobs.JobRunner(C, remote_jobs.JobStore(str(tmp_path / 'jobs.sqlite')), chunk_designations=2)
+    input_dict = {f'desig{i}': i for i in range(5)}
+    job_id = runner.submit('orbfit', input_dict)
+
+    # Let one chunk through
+    C.gate.release()
+    deadline = time.monotonic() + 10
+    while runner.status(job_id)['n_done'] < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    status_dict = runner.status(job_id)
+    assert status_dict['status'] == 'running'
+    assert status_dict['results'] == {'desig0': {'fitted': 0}, 'desig1': {'fitted': 1}}
+
+    # A short long-poll returns the partial state, a longer one the final state
+    assert runner.status(job_id, wait=0.05)['status'] == 'running'
+    threading.Timer(0.1, lambda: [C.gate.release() for _ in range(2)]).start()
+    status_dict = runner.status(job_id, wait=10)
+    assert status_dict['status'] == 'done' and status_dict['n_done'] == status_dict['n_total'] == 5
+    assert status_dict['results'] == {desig: {'fitted': v} for desig, v in input_dict.items()}
+
+def test_job_resumes_from_checkpoint(tmp_path):
+    ''' A job left unfinished (e.g. by a restart) only re-runs the designations without results '''
+    store = remote_jobs.JobStore(str(tmp_path / 'jobs.sqlite'))
+    job_id = store.create('orbfit', {f'desig{i}': i for i in range(4)})
+    store.set_status(job_id, 'running')
+    store.save_results(job_id, {'desig0': {'fitted': 0}, 'desig2': {'fitted': 2}})
+
+    C = GatedClient()
+    runner = remote_jobs.JobRunner(C, remote_jobs.JobStore(store.path))
+    assert runner.resume() == 1
+    status_dict = runner.status(job_id, wait=10)
+    assert status_dict['status'] == 'done' and status_dict['n_done'] == 4
+    assert C.calls == [['desig1', 'desig3']]
+
+def test_job_expiry(tmp_path):
+    ''' Finished jobs are purged once their results have expired '''
+    store = remote_jobs.JobStore(str(tmp_path / 'jobs.sqlite'))
+    runner = remote_jobs.JobRunner(GatedClient(), store, result_ttl=-1)
+    job_id = runner.submit('orbfit', {'a': 1})
+    assert runner.status(job_id, wait=10)['status'] == 'done'
+    assert store.purge() == 1
+    assert runner.status(job_id) is None
+
+
+# Tests via the gateway & Remote
+# ---------------------------------------------------------------
+
+def test_remote_job_submission(tmp_path):
+    ''' Submit via Remote, then wait for the result '''
+    app = remote_gateway.Gateway(job_store=str(tmp_path / 'jobs.sqlite'))
+    app.jobs.client = GatedClient()
+    httpd = make_server('127.0.0.1', 0, app,
+                        server_class=remote_gateway.ThreadingWSGIServer,
+                        handler_class=remote_gateway.QuietWSGIRequestHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    R = remote.Remote(base_url=f'http://127.0.0.1:{httpd.server_port}')
+
+    input_dict = {f'desig{i}': i for i in range(25)}
+    job_id = R.submit_orbit_extension_json(json.dumps(input_dict))['job_id']
+    result_dict = R.wait_for_job(job_id, timeout=10)
+    assert result_dict['status'] == 'done'
+    assert result_dict['results'] == {desig: {'fitted': v} for desig, v in input_dict.items()}
+
+    assert 'exception' in R.poll_job('nonsense')
+    httpd.shutdown()
+    httpd.server_close()
@@ -0,0 +1,175 @@
+# Import third-party packages
+# --------------------------------------------------------------
+import sys, os
+import json
+import threading
+import time
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+
+# Import neighboring packages
+# ---------------------------------------------------------------
+sys.path.append(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+import mpc_sqs
+import queue_backends
+import sqs_worker
+
+
+# Helper functions
+# ---------------------------------------------------------------
+
+@pytest.fixture(autouse=True)
+def in_tmp_path(tmp_path, monkeypatch):
+    ''' The mpc_sqs logs get written to the current directory '''
+    monkeypatch.chdir(tmp_path)
+
+def local_queue(backend=None):
+    ''' An orbit-extension queue held in memory (messages can be received as soon as they are sent) '''
+    queue = mpc_sqs.OrbfitExtensionSQS(backend=backend if backend is not None else queue_backends.MemoryBackend())
+    queue.send_delay_seconds = 0
+    return queue
+
+def remaining(queue):
+    ''' messages left on the queue (whether or not they are visible) '''
+    return sum(len(q['messages']) for q in queue.backend._queues.values())
+
+def fill(queue, bodies):
+    job_dicts = [{'trackletID': f'trk{i}', 'desig12': f'desig{i}', 'mpc_local_queue_destination': 'MBAMOPP'} for i in range(len(bodies))]
+    message_ids = queue.send_batch(job_dicts, bodies)
+    assert None not in message_ids
+    return message_ids
+
+def count_observations(input_dict):
+    ''' stand-in for update_existing_orbits (module-level, so it can run in a process-pool) '''
+    return {desig: {'n_obs': len(v['obslist']), 'pid': os.getpid()} for desig, v in input_dict.items()}
+
+def body(desig, n_obs=2):
+    return json.dumps({desig: {'obslist': [{}] * n_obs, 'rwodict': {}, 'eq0dict': {}}})
+
+
+# Tests of the worker
+# ---------------------------------------------------------------
+
+def test_worker_runs_jobs_in_process_pool(tmp_path):
+    ''' All jobs get fitted (in other processes) & their messages deleted '''
+    queue, results = local_queue(), {}
+    fill(queue, [body(f'desig{i}', i) for i in range(20)])
+    W = sqs_worker.SQSWorker(queue, fit_function=count_observations, max_workers=3,
+                             dead_letter=str(tmp_path / 'dead.jsonl'),
+                             result_handler=lambda records, result: results.update(result))
+    stats = W.run(idle_timeout=0.5)
+    assert stats == {'n_succeeded': 20, 'n_retried': 0, 'n_dead_lettered': 0, 'n_duplicates': 0, 'n_fits': 20}
+    assert remaining(queue) == 0
+    assert {desig: v['n_obs'] for desig, v in results.items()} == {f'desig{i}': i for i in range(20)}
+    assert os.getpid() not in {v['pid'] for v in results.values()}
+
+def test_worker_heartbeats_long_fits(tmp_path):
+    ''' The visibility of a running job keeps being extended, so it is not received twice '''
+    def slow_fit(input_dict):
+        time.sleep(0.5)
+        return {'ok': True}
+    queue, extensions = local_queue(), []
+    change_visibility = queue.change_visibility
+    queue.change_visibility = lambda record, vt: [extensions.append(vt), change_visibility(record, vt)]
+    fill(queue, [body('desig0')])
+    W = sqs_worker.SQSWorker(queue, fit_function=slow_fit, max_workers=1, executor=ThreadPoolExecutor(1),
+                             visibility_timeout=10, heartbeat_interval=0.1, dead_letter=str(tmp_path / 'dead.jsonl'))
+    assert W.run(idle_timeout=0.3)['n_succeeded'] == 1
+    assert len(extensions) >= 2 and set(extensions) == {10}
+
+def test_worker_dead_letters_poison_messages(tmp_path):
+    ''' Unreadable messages are dead-lettered at once, failing fits after max_receives attempts '''
+    def failing_fit(input_dict):
+        if 'bad' in input_dict:
+            return {'exception': 'fit did not converge', 'file': __file__}
+        return {'ok': True}
+    queue, dead_letter = local_queue(), tmp_path / 'dead.jsonl'
+    message_ids = fill(queue, ['not json', body('bad'), body('good')])
+    W = sqs_worker.SQSWorker(queue, fit_function=failing_fit, max_workers=2, executor=ThreadPoolExecutor(2),
+                             max_receives=2, dead_letter=str(dead_letter))
+    assert W.run(idle_timeout=0.5) == {'n_succeeded': 1, 'n_retried': 1, 'n_dead_lettered': 2, 'n_duplicates': 0, 'n_fits': 3}
+    assert remaining(queue) == 0
+
+    dead = [json.loads(line) for line in dead_letter.read_text().splitlines()]
+    assert sorted(d['message_id'] for d in dead) == sorted(message_ids[:2])
+    assert [d['receive_count'] for d in dead if d['message_id'] == message_ids[1]] == [2]
+    assert all(d['reason'] for d in dead)
+
+def test_worker_dead_letter_queue():
+    ''' Poison messages can go to a dead-letter queue instead '''
+    backend = queue_backends.MemoryBackend()
+    queue, dead_letter = local_queue(backend), mpc_sqs.MPCSQS('dead-letter', backend=backend)
+    dead_letter.transform_standard_dict_to_aws_dict = queue.transform_standard_dict_to_aws_dict
+    dead_letter.transform_aws_dict_to_standard_dict = queue.transform_aws_dict_to_standard_dict
+    fill(queue, ['[]'])
+    W = sqs_worker.SQSWorker(queue, fit_function=count_observations, max_workers=1,
+                             executor=ThreadPoolExecutor(1), dead_letter=dead_letter)
+    assert W.run(max_jobs=1)['n_dead_lettered'] == 1
+    assert [record['body'] for record in dead_letter.read_batch(wait_time_seconds=5)] == ['[]']
+    assert len(backend._queues[queue.queue_url]['messages']) == 0
+
+
+# Tests of deduplication & coalescing
+# ---------------------------------------------------------------
+
+def test_worker_dedupes_and_coalesces(tmp_path):
+    ''' Replayed tracklets are not re-fitted, & tracklets for the same designation are fitted together '''
+    fits = []
+    def recording_fit(input_dict):
+        fits.append(input_dict)
+        return {desig: {'n_obs': len(v['obslist'])} for desig, v in input_dict.items()}
+
+    queue = local_queue()
+    job_dicts = [{'trackletID': trackletID, 'desig12': desig, 'mpc_local_queue_destination': 'MBAMOPP'}
+                 for trackletID, desig in [('trkA', 'K15HI1Q'), ('trkB', 'K15HI1Q'), ('trkA', 'K15HI1Q'), ('trkC', 'K20A00B')]]
+    bodies = [json.dumps({job_dict['desig12']: {'obslist': [{'obs80': job_dict['trackletID']}, {'obs80': 'old'}],
+                                                 'rwodict': {}, 'eq0dict': {'epoch': 1}}}) for job_dict in job_dicts]
+    queue.send_batch(job_dicts, bodies)
+
+    W = sqs_worker.SQSWorker(queue, fit_function=recording_fit, max_workers=2, executor=ThreadPoolExecutor(2),
+                             coalesce_window=0.3, dead_letter=str(tmp_path / 'dead.jsonl'))
+    stats = W.run(idle_timeout=0.5)
+    assert stats == {'n_succeeded': 3, 'n_retried': 0, 'n_dead_lettered': 0, 'n_duplicates': 1, 'n_fits': 2}
+    assert remaining(queue) == 0
+
+    # One fit per designation, with the union of the observations
+    assert sorted(fits, key=lambda d: list(d)) == [
+        {'K15HI1Q': {'obslist': [{'obs80': 'trkA'}, {'obs80': 'old'}, {'obs80': 'trkB'}], 'rwodict': {}, 'eq0dict': {'epoch': 1}}},
+        {'K20A00B': {'obslist': [{'obs80': 'trkC'}, {'obs80': 'old'}], 'rwodict': {}, 'eq0dict': {'epoch': 1}}}]
+
+def test_failed_tracklets_are_not_duplicates(tmp_path):
+    ''' A tracklet whose fit failed is fitted again when its message comes back '''
+    n_calls = []
+    def flaky_fit(input_dict):
+        n_calls.append(1)
+        return {'exception': 'first attempt fails'} if len(n_calls) == 1 else {'ok': True}
+    queue = local_queue()
+    fill(queue, [body('desig0')])
+    W = sqs_worker.SQSWorker(queue, fit_function=flaky_fit, max_workers=1, executor=ThreadPoolExecutor(1),
+                             coalesce_window=0, dead_letter=str(tmp_path / 'dead.jsonl'))
+    stats = W.run(idle_timeout=0.5)
+    assert (stats['n_retried'], stats['n_succeeded'], stats['n_duplicates']) == (1, 1, 0)
+    assert remaining(queue) == 0
+
+def test_worker_unaffected_by_packed_sends(tmp_path):
+    ''' Packed tracklets go to their own queue, so the worker still reads (& fits) every job on its queue '''
+    backend = queue_backends.MemoryBackend()
+    queue   = local_queue(backend)
+    fill(queue, [body(f'desig{i}') for i in range(5)])
+    router  = mpc_sqs.TrackletRouter({'MBAMOPP': 'q-packed'}, backend=backend)
+    status  = router.send([{'trackletID': f'packed{i}', 'desig12': f'desig{i}', 'mpc_local_queue_destination': 'MBAMOPP'}
+                           for i in range(20)])
+    assert None not in status.values()
+
+    W = sqs_worker.SQSWorker(queue, fit_function=count_observations, max_workers=2, coalesce_window=0,
+                             dead_letter=str(tmp_path / 'dead.jsonl'), executor=ThreadPoolExecutor(2))
+    stats = W.run(idle_timeout=0.5)
+    assert stats['n_succeeded'] == 5 and stats['n_dead_lettered'] == 0
+    assert not os.path.exists(tmp_path / 'dead.jsonl')
+
+    # ... & the packed messages are waiting for their own consumers
+    time.sleep(mpc_sqs.PackedTrackletSQS.send_delay_seconds)
+    records = mpc_sqs.PackedTrackletSQS('q-packed', backend=backend).read_batch(visibility_timeout=60)
+    assert [t['trackletID'] for record in records for t in mpc_sqs.unpack_tracklets(record)] == list(status)
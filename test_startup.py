@@ -0,0 +1,19 @@
+# Import third-party packages
+# --------------------------------------------------------------
+import sys, os
+
+# Import neighboring packages
+# ---------------------------------------------------------------
+sys.path.append(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+import bench_startup
+
+
+# Tests
+# ---------------------------------------------------------------
+
+def test_no_heavy_imports():
+    ''' None of the entry points import numpy, requests, pytest, ... at start-up '''
+    for entry_point in bench_startup.entry_imports:
+        elapsed, heavy = bench_startup.time_import(entry_point)
+        assert heavy == [], f'{entry_point} imports {heavy}'
@@ -0,0 +1,121 @@
+# Import third-party packages
+# --------------------------------------------------------------
+import sys, os
+import threading
+import pytest
+
+# Import neighboring packages
+# ---------------------------------------------------------------
+sys.path.append(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+import sockets_class as sc
+
+
+# Helper functions
+# ---------------------------------------------------------------
+
+class BlockingServer(sc.Server):
+    '''
+    Test server that records the chunks it has checked, & only evaluates
+    a chunk once "proceed" is set
+     - evaluated : set once the first chunk has been evaluated
+    '''
+    def __init__(self, **kwargs):
+        sc.Server.__init__(self, **kwargs)
+        self.n_checked  = 0
+        self.proceed    = threading.Event()
+        self.evaluated  = threading.Event()
+    def _check_data_format_from_client(self, data):
+        sc.Server._check_data_format_from_client(data)
+        assert all(not desig.startswith('BAD') for desig in data.get('test', {}))
+        self.n_checked += 1
+    def _function_to_be_evaluated(self, data_dict):
+        self.proceed.wait(timeout=10)
+        self.evaluated.set()
+        return {desig: {'fitted': v} for desig, v in data_dict['test'].items()}
+
+def start(server):
+    ''' Launch a server on an ephemeral local port : returns the port '''
+    server.sock.listen(5)
+    threading.Thread(target=server._listen, daemon=True).start()
+    return server.sock.getsockname()[1]
+
+
+# Tests
+# ---------------------------------------------------------------
+
+def test_stream_round_trip():
+    ''' A streamed upload gets the same reply as a single request, & leaves the pooled connection usable '''
+    port        = start(sc.Server(host='127.0.0.1', port=0))
+    input_dict  = {f'desig{i}': {'obslist': [i] * 3} for i in range(1000)}
+
+    assert sc.Client(host='127.0.0.1', port=port).connect_stream(input_dict, request_type='test', max_designations=64) \
+        == {'tested': {'test': input_dict}}
+
+    pool = sc.ClientPool(host='127.0.0.1', port=port)
+    assert pool.connect_stream(iter(input_dict.items()), request_type='test') == {'tested': {'test': input_dict}}
+    assert pool.connect({'n': 1}) == {'tested': {'n': 1}}
+    assert pool.connect_stream({}, request_type='test') == {}
+    assert pool._idle.qsize() == 1
+    pool.close()
+
+def test_stream_results_in_frames():
+    ''' The results come back a chunk per frame, so no single frame holds all of them '''
+    class RecordingClient(sc.Client):
+        def _recv_frame(self, s):
+            frame = sc.Client._recv_frame(self, s)
+            self.headers.append(frame[0])
+            return frame
+    port        = start(sc.Server(host='127.0.0.1', port=0))
+    input_dict  = {f'desig{i}': i for i in range(100)}
+    C           = RecordingClient(host='127.0.0.1', port=port)
+    C.headers   = []
+    assert C.connect_stream(input_dict, request_type='test', max_designations=10) == {'tested': {'test': input_dict}}
+    assert [h.get('stream') for h in C.headers] == ['ready'] + ['result'] * 10 + ['end']
+
+def test_stream_evaluated_as_it_arrives():
+    ''' The server starts on the first chunk while the client is still sending the rest '''
+    server  = BlockingServer(host='127.0.0.1', port=0)
+    port    = start(server)
+    server.proceed.set()
+
+    def items():
+        for i in range(10):
+            yield f'desig{i}', i
+        # Only continue once the server has evaluated the first chunk
+        assert server.evaluated.wait(timeout=10)
+        for i in range(10, 20):
+            yield f'desig{i}', i
+
+    reply = sc.Client(host='127.0.0.1', port=port).connect_stream(items(), request_type='test', max_designations=10)
+    assert reply == {f'desig{i}': {'fitted': i} for i in range(20)}
+
+def test_stream_bounded_memory():
+    ''' While evaluation is held up, the server stops reading chunks (rather than buffering the whole upload) '''
+    server  = BlockingServer(host='127.0.0.1', port=0)
+    port    = start(server)
+    replies = []
+
+    input_dict = {f'desig{i}': i for i in range(200)}
+    thread = threading.Thread(target=lambda: replies.append(
+        sc.Client(host='127.0.0.1', port=port).connect_stream(input_dict, request_type='test', max_designations=5)))
+    thread.start()
+    thread.join(timeout=1)
+
+    # One chunk being evaluated, the queued chunks, & one waiting to be queued
+    assert thread.is_alive() and server.n_checked <= server.stream_queue_chunks + 2
+    server.proceed.set()
+    thread.join(timeout=10)
+    assert replies == [{desig: {'fitted': v} for desig, v in input_dict.items()}]
+    assert server.n_checked == 40
+
+def test_stream_rejects_bad_chunk():
+    ''' A chunk that fails its check ends the upload (& the connection) '''
+    server  = BlockingServer(host='127.0.0.1', port=0)
+    port    = start(server)
+    server.proceed.set()
+
+    input_dict = {f'desig{i}': i for i in range(50)}
+    input_dict['BAD1'] = -1
+    with pytest.raises(OSError):
+        sc.Client(host='127.0.0.1', port=port).connect_stream(input_dict, request_type='test', max_designations=10)
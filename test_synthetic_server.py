@@ -0,0 +1,62 @@
+# Import third-party packages
+# --------------------------------------------------------------
+import sys, os
+import json
+import threading
+import time
+import pytest
+
+# Import neighboring packages
+# ---------------------------------------------------------------
+sys.path.append(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+import sockets_class as sc
+
+
+# Helper functions
+# ---------------------------------------------------------------
+
+def start_server(**settings):
+    ''' Launch a synthetic server on an ephemeral local port & return its port number '''
+    S = sc.SyntheticServer(host='127.0.0.1', port=0, **settings)
+    S.sock.listen(5)
+    threading.Thread(target=S._listen, daemon=True).start()
+    return S, S.sock.getsockname()[1]
+
+def request(n_observations=0):
+    return {'orbfit': {'K15HI1Q': {'obslist': [{'obs': i} for i in range(n_observations)], 'rwodict': {}, 'eq0dict': {}}}}
+
+
+# Tests
+# ---------------------------------------------------------------
+
+def test_cpu_and_response_size():
+    ''' Requests use the configured CPU time (scaling with the obslist length), & replies are the configured size '''
+    _, port = start_server(cpu_seconds=0.02, cpu_seconds_per_observation=0.001, response_bytes=10000)
+    start   = time.perf_counter()
+    reply   = sc.Client(host='127.0.0.1', port=port).connect(request(30))
+    assert time.perf_counter() - start >= 0.05
+    assert reply['synthetic']['n_observations'] == 30 and reply['synthetic']['cpu_seconds'] == pytest.approx(0.05)
+    assert 10000 <= len(json.dumps(reply)) < 10200
+
+def test_latency_distributions():
+    ''' Each distribution has (roughly) the configured mean '''
+    for distribution in sc.SyntheticServer.latency_distributions:
+        S           = sc.SyntheticServer(host='127.0.0.1', port=0, latency_distribution=distribution, latency_mean=0.1, seed=1)
+        latencies   = [S._latency() for _ in range(5000)]
+        assert sum(latencies) / len(latencies) == pytest.approx(0.1, rel=0.1) and min(latencies) >= 0
+        S.sock.close()
+    with pytest.raises(AssertionError):
+        sc.SyntheticServer(host='127.0.0.1', port=0, latency_distribution='normal')
+
+def test_failures():
+    ''' Failures are reported as exception-dicts, or as dropped connections (i.e. no reply) '''
+    _, port = start_server(failure_rate=0.5, seed=2)
+    pool    = sc.ClientPool(host='127.0.0.1', port=port)
+    replies = [pool.connect(request()) for _ in range(100)]
+    n_failed = sum('exception' in reply for reply in replies)
+    assert 30 < n_failed < 70 and all('synthetic' in reply for reply in replies if 'exception' not in reply)
+    pool.close()
+
+    _, port = start_server(failure_rate=1.0, failure_mode='disconnect')
+    assert sc.Client(host='127.0.0.1', port=port).connect(request()) is None
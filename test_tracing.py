@@ -0,0 +1,127 @@
+# Import third-party packages
+# --------------------------------------------------------------
+import sys, os
+import json
+import threading
+import time
+import pytest
+from wsgiref.simple_server import make_server
+
+# Import neighboring packages
+# ---------------------------------------------------------------
+sys.path.append(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+import tracing
+import remote
+import remote_gateway
+import remote_general as rg
+import sockets_class as sc
+
+
+# Helper functions
+# ---------------------------------------------------------------
+
+@pytest.fixture
+def trace_file(tmp_path):
+    ''' export spans to a file for the duration of a test '''
+    path = str(tmp_path / 'traces.jsonl')
+    tracing.configure(path)
+    yield path
+    tracing.configure(None)
+
+def exported_spans(path, wait_for=None, timeout=5):
+    '''
+    {(service, span-name) : otlp-span} of everything exported so far
+    (waiting for the span wait_for, e.g. a server span, that ends just after its reply is sent)
+    '''
+    deadline = time.time() + timeout
+    while True:
+        spans = _read_spans(path)
+        if wait_for is None or wait_for in spans or time.time() > deadline:
+            return spans
+        time.sleep(0.01)
+
+def _read_spans(path):
+    tracing.flush()
+    spans = {}
+    if os.path.exists(path):
+        with open(path) as fh:
+            for line in fh:
+                for resource_spans in json.loads(line)['resourceSpans']:
+                    service = resource_spans['resource']['attributes'][0]['value']['stringValue']
+                    for span in resource_spans['scopeSpans'][0]['spans']:
+                        spans[(service, span['name'])] = span
+    return spans
+
+def local_server():
+    S = sc.Server(host='127.0.0.1', port=0)
+    S.sock.listen(5)
+    threading.Thread(target=S._listen, daemon=True).start()
+    return S.sock.getsockname()[1]
+
+
+# Tests
+# ---------------------------------------------------------------
+
+def test_traceparent():
+    ''' Only valid W3C traceparents are accepted '''
+    trace_id, span_id = '4bf92f3577b34da6a3ce929d0e0e4736', '00f067aa0ba902b7'
+    assert tracing.parse_traceparent(f'00-{trace_id}-{span_id}-01') == (trace_id, span_id, True)
+    assert tracing.parse_traceparent(f'00-{trace_id}-{span_id}-00') == (trace_id, span_id, False)
+    for bad in [None, '', 'nonsense', f'00-{"0" * 32}-{span_id}-01', f'00-{trace_id}-{span_id}']:
+        assert tracing.parse_traceparent(bad) is None
+
+def test_sampling_and_propagation(trace_file):
+    ''' Unsampled traces are passed on but not exported; with no exporter, no new traces are started '''
+    tracer = tracing.get_tracer('test')
+    tracing.configure(trace_file, sample_rate=0.0)
+    with tracer.span('root') as root:
+        assert not root.sampled and tracing.inject({})['traceparent'].endswith('-00')
+        with tracer.span('child') as child:
+            assert child.trace_id == root.trace_id and child.parent_id == root.span_id
+    assert exported_spans(trace_file) == {}
+
+    # An incoming sampled context is followed, whatever the local sample-rate
+    with tracer.span('continued', parent=f'00-{"a" * 32}-{"b" * 16}-01'):
+        pass
+    assert exported_spans(trace_file)[('test', 'continued')]['traceId'] == 'a' * 32
+
+    tracing.configure(None)
+    assert tracer.span('untraced') is tracing.no_span and tracing.inject({}) == {}
+    with tracer.span('continued', parent=f'00-{"a" * 32}-{"b" * 16}-01') as span:
+        assert tracing.inject({})['traceparent'].startswith(f'00-{"a" * 32}-')
+
+def test_end_to_end(trace_file):
+    ''' One trace covers Remote -> gateway (http) -> process_cgi_string -> client -> server (socket) '''
+    app     = remote_gateway.Gateway(host='127.0.0.1', port=local_server())
+    httpd   = make_server('127.0.0.1', 0, app, server_class=remote_gateway.ThreadingWSGIServer,
+                          handler_class=remote_gateway.QuietWSGIRequestHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    try:
+        R = remote.Remote(base_url=f'http://127.0.0.1:{httpd.server_port}/cgi-bin/cgipy')
+        assert R.request_test_json(json.dumps({'k': 'v'})) == {'tested': {'test': {'k': 'v'}}}
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        app.pool.close()
+
+    spans = exported_spans(trace_file, wait_for=('sockets_class', 'Server._listenToClient'))
+    chain = [('remote', 'Remote._request'), ('remote', 'Remote._put'), ('remote_gateway', 'Gateway'),
+             ('remote_general', 'process_cgi_string'), ('sockets_class', 'ClientPool.connect'),
+             ('sockets_class', 'Server._listenToClient')]
+    assert len({span['traceId'] for span in spans.values()}) == 1
+    assert 'parentSpanId' not in spans[chain[0]]
+    for parent, child in zip(chain, chain[1:]):
+        assert spans[child]['parentSpanId'] == spans[parent]['spanId']
+    for stage in ['decode', 'check', 'evaluate', 'reply']:
+        assert spans[('sockets_class', stage)]['parentSpanId'] == spans[chain[-1]]['spanId']
+
+def test_cgi_traceparent(trace_file, monkeypatch):
+    ''' A cgi-script continues the trace from the traceparent header (passed on in the environment) '''
+    monkeypatch.setenv('HTTP_TRACEPARENT', f'00-{"c" * 32}-{"d" * 16}-01')
+    result = rg.process_cgi_string(json.dumps({'k': 'v'}), 'remote_test.cgi', client=sc.Client(host='127.0.0.1', port=local_server()))
+    assert result == {'tested': {'test': {'k': 'v'}}}
+    spans = exported_spans(trace_file, wait_for=('sockets_class', 'Server._listenToClient'))
+    assert spans[('remote_general', 'process_cgi_string')]['parentSpanId'] == 'd' * 16
+    assert spans[('sockets_class', 'Client.connect')]['parentSpanId'] == spans[('remote_general', 'process_cgi_string')]['spanId']
+    assert spans[('sockets_class', 'Server._listenToClient')]['traceId'] == 'c' * 32
@@ -0,0 +1,72 @@
+# Import third-party packages
+# --------------------------------------------------------------
+import sys, os
+import json
+import threading
+import pytest
+
+# Import neighboring packages
+# ---------------------------------------------------------------
+sys.path.append(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+import sockets_class as sc
+import traffic_capture
+
+
+# Helper functions
+# ---------------------------------------------------------------
+
+def start_server(capture=None):
+    ''' Launch a test server (that echoes its input) on an ephemeral local port & return its port number '''
+    S = sc.Server(host='127.0.0.1', port=0)
+    S.capture = capture
+    S.sock.listen(5)
+    threading.Thread(target=S._listen, daemon=True).start()
+    return S.sock.getsockname()[1]
+
+
+# Tests
+# ---------------------------------------------------------------
+
+def test_capture_and_replay(tmp_path):
+    ''' Frames received by a capturing server can be replayed (at any speed) against another server '''
+    path    = str(tmp_path / 'server.cap')
+    capture = traffic_capture.CaptureWriter(path)
+    pool    = sc.ClientPool(host='127.0.0.1', port=start_server(capture))
+
+    for i in range(5):
+        assert pool.connect({'n': i}) == {'tested': {'n': i}}
+    raw = pool.connect_raw('test', json.dumps({'k': 'v'}).encode())
+    assert json.loads(raw.read()) == {'tested': {'test': {'k': 'v'}}}
+    pool.close()
+    capture.close()
+
+    frames = list(traffic_capture.read_capture(path))
+    assert len(frames) == 6
+    assert [f[1] for f in frames] == [{'codec': 'pickle'}] * 5 + [{'codec': 'json', 'request_type': 'test'}]
+    assert all(frames[i][0] <= frames[i + 1][0] for i in range(5))
+
+    port = start_server()
+    for speed in [None, 1000.0]:
+        results = traffic_capture.replay(path, host='127.0.0.1', port=port, speed=speed, max_connections=2)
+        assert results['n_requests'] == 6 and results['n_failed'] == 0
+        assert results['throughput'] > 0 and 0 < results['latency_p50'] <= results['latency_max']
+
+    changes = traffic_capture.compare(results, dict(results, throughput=2 * results['throughput']))
+    assert changes['throughput'] == pytest.approx(1.0) and changes['n_requests'] == 0
+
+def test_sampling_and_rotation(tmp_path):
+    ''' Only a sample of frames is captured, & the capture-file is rotated (keeping backup_count files) '''
+    path    = str(tmp_path / 'rotate.cap')
+    capture = traffic_capture.CaptureWriter(path, max_bytes=1000, backup_count=2)
+    for i in range(100):
+        capture.write({'codec': 'pickle'}, b'x' * 100 + bytes([i]))
+    capture.close()
+    assert traffic_capture.capture_files(path) == [path + '.2', path + '.1', path]
+    payloads = [f[2] for f in traffic_capture.read_capture(path)]
+    assert payloads[-1][-1] == 99 and [p[-1] for p in payloads] == sorted(p[-1] for p in payloads)
+
+    capture = traffic_capture.CaptureWriter(str(tmp_path / 'sampled.cap'), sample_rate=0.0)
+    capture.write({'codec': 'pickle'}, b'x')
+    capture.close()
+    assert list(traffic_capture.read_capture(str(tmp_path / 'sampled.cap'))) == []
@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+
+'''
+    --------------------------------------------------------------
+    End-to-end request tracing
+
+    A request passes through several hops (remote.Remote -> the http
+    gateway / cgi-script -> remote_general.process_cgi_string ->
+    sockets_class.Client -> sockets_class.Server), often in different
+    processes. Each hop records "spans" (named, timed stages), and
+    passes its trace-context on to the next hop, so that all of the
+    spans of a request can be put back together afterwards:
+
+     - the trace-context is a W3C "traceparent", e.g.
+       00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01,
+       sent in the http "traceparent" header & in the socket frame-header
+     - traces are sampled when they start (at sample_rate), & every later
+       hop follows that decision (the last field of the traceparent)
+     - spans are exported in the OpenTelemetry (OTLP) json format, by a
+       background thread (never blocking the request), either
+        (i)  as json-lines appended to a file (one ExportTraceServiceRequest
+             per line, as read by the OpenTelemetry collector's
+             "otlpjsonfile" receiver), or
+        (ii) posted to a collector's OTLP/http endpoint (.../v1/traces)
+
+    Tracing is off unless an export destination is configured, either with
+    configure(), or (e.g. for the cgi-scripts) with the environment variables
+     - MPC_TRACE_EXPORT      : file path, or http(s):// collector url
+     - MPC_TRACE_SAMPLE_RATE : fraction of traces to sample (default 1)
+    (a hop without an export destination still passes incoming trace-contexts on)
+
+    Expected usage:
+    ----------------
+    tracing.configure('/tmp/mpc_traces.jsonl', sample_rate=0.1)
+    tracer = tracing.get_tracer('my_service')
+    with tracer.span('stage', kind='client', attributes={'n': 3}) as span:
+        headers = tracing.inject({})   # ... & send headers with the request
+    --------------------------------------------------------------
+'''
+
+
+# Import third-party packages
+# --------------------------------------------------------------
+import atexit
+import contextvars
+import json
+import os
+import queue
+import random
+import re
+import threading
+import time
+
+
+# OTLP span kinds & status codes
+span_kinds      = {'internal': 1, 'server': 2, 'client': 3}
+status_ok       = 1
+status_error    = 2
+
+_traceparent_pattern = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+
+# The span currently in progress (per thread / per context)
+_current = contextvars.ContextVar('mpc_trace_span', default=None)
+
+# Configuration (see configure)
+_exporter       = None
+_sample_rate    = 1.0
+_tracers        = {}
+_lock           = threading.Lock()
+
+
+class Span():
+    '''
+    A named, timed stage of a request
+     - use as a context-manager : it is the current span (the parent of any
+       spans started, & the context passed on by inject) while inside the with-block
+    '''
+
+    __slots__ = ('service', 'name', 'kind', 'trace_id', 'span_id', 'parent_id', 'sampled',
+                 'start_ns', 'end_ns', 'attributes', 'status', '_token')
+
+    def __init__(self, service, name, kind, trace_id, span_id, parent_id, sampled, attributes=None):
+        self.service    = service
+        self.name       = name
+        self.kind       = kind
+        self.trace_id   = trace_id
+        self.span_id    = span_id
+        self.parent_id  = parent_id
+        self.sampled    = sampled
+        self.attributes = dict(attributes) if attributes else {}
+        self.status     = None
+        self.start_ns   = self.end_ns = None
+        self._token     = None
+
+    @property
+    def traceparent(self,):
+        return f'00-{self.trace_id}-{self.span_id}-{"01" if self.sampled else "00"}'
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def __enter__(self):
+        self.start_ns   = time.time_ns()
+        self._token     = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end_ns = time.time_ns()
+        _current.reset(self._token)
+        if exc_type is not None:
+            self.status = f'{exc_type.__name__}: {exc}'
+        if self.sampled and _exporter is not None:
+            _exporter.export(self)
+        return False
+
+    def to_otlp(self,):
+        ''' the span in the OTLP json encoding '''
+        span = {'traceId'           : self.trace_id,
+                'spanId'            : self.span_id,
+                'name'              : self.name,
+                'kind'              : span_kinds[self.kind],
+                'startTimeUnixNano' : str(self.start_ns),
+                'endTimeUnixNano'   : str(self.end_ns),
+                'attributes'        : _otlp_attributes(self.attributes),
+                'status'            : {'code': status_ok} if self.status is None else {'code': status_error, 'message': self.status}}
+        if self.parent_id is not None:
+            span['parentSpanId'] = self.parent_id
+        return span
+
+
+class _NoSpan():
+    ''' stands in for a span when there is no trace to record or pass on '''
+    traceparent = None
+    sampled     = False
+
+    def set_attribute(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+no_span = _NoSpan()
+
+
+class Tracer():
+    ''' Starts the spans of one service (i.e. the "service.name" the spans are exported under) '''
+
+    def __init__(self, service):
+        self.service = service
+
+    def span(self, name, kind='internal', parent=None, attributes=None):
+        '''
+        a new span (to be used as a context-manager)
+
+        name       : name of the stage
+        kind       : 'internal', 'server' (handling a request from another hop) or 'client' (calling another hop)
+        parent     : traceparent (string) received from the previous hop (default : the current span)
+        attributes : dict of extra information to record
+        '''
+        context = parse_traceparent(parent) if isinstance(parent, str) else None
+        if context is None:
+            current = _current.get()
+            if current is not None:
+                context = (current.trace_id, current.span_id, current.sampled)
+
+        # A new trace is only started (& its sampling decided) if we are exporting
+        if context is None:
+            if _exporter is None:
+                return no_span
+            return Span(self.service, name, kind, _random_hex(16), _random_hex(8), None,
+                        random.random() < _sample_rate, attributes)
+        trace_id, parent_id, sampled = context
+        return Span(self.service, name, kind, trace_id, _random_hex(8), parent_id, sampled, attributes)
+
+
+def get_tracer(service):
+    ''' the Tracer for a service (the same one for every call) '''
+    with _lock:
+        if service not in _tracers:
+            _tracers[service] = Tracer(service)
+        return _tracers[service]
+
+
+def configure(export=None, sample_rate=None):
+    '''
+    where to export spans to, & what fraction of traces to sample
+
+    export      : file path (json-lines), http(s):// url of a collector, a SpanExporter, or None (tracing off)
+    sample_rate : fraction of new traces that are sampled (recorded)
+    '''
+    global _exporter, _sample_rate
+    if isinstance(export, str):
+        export = HTTPExporter(export) if export.startswith(('http://', 'https://')) else FileExporter(export)
+    with _lock:
+        previous, _exporter = _exporter, export
+        _sample_rate = sample_rate if sample_rate is not None else 1.0
+    if previous is not None and previous is not export:
+        previous.shutdown()
+
+
+def current_span():
+    ''' the span in progress (or None) '''
+    return _current.get()
+
+
+def inject(headers):
+    ''' add the current trace-context (if any) to a dict of (http / frame) headers : returns headers '''
+    span = _current.get()
+    if span is not None:
+        headers['traceparent'] = span.traceparent
+    return headers
+
+
+def parse_traceparent(traceparent):
+    ''' (trace_id, parent_span_id, sampled) from a W3C traceparent, or None if it is missing / invalid '''
+    match = _traceparent_pattern.match(traceparent.strip().lower()) if traceparent else None
+    if match is None or set(match.group(1)) == {'0'} or set(match.group(2)) == {'0'}:
+        return None
+    return match.group(1), match.group(2), bool(int(match.group(3), 16) & 1)
+
+
+def flush():
+    ''' wait until every span ended so far has been exported '''
+    if _exporter is not None:
+        _exporter.flush()
+
+
+def shutdown():
+    ''' export anything still queued & stop tracing (e.g. at the end of a cgi-script) '''
+    configure(None)
+
+
+# Exporters
+# --------------------------------------------------------------
+class SpanExporter():
+    '''
+    Exports spans in batches from a background thread
+     - export() never blocks : if the queue is full the span is dropped (& counted)
+     - sub-classes implement _write(otlp_request_dict)
+    '''
+
+    max_queue_size  = 10000
+    max_batch_size  = 512
+    flush_interval  = 1.0
+
+    def __init__(self,):
+        self.dropped    = 0
+        self.failed     = 0
+        self._queue     = queue.Queue(maxsize=self.max_queue_size)
+        self._thread    = threading.Thread(target=self._export_loop, daemon=True)
+        self._thread.start()
+
+    def export(self, span):
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self,):
+        self._queue.join()
+
+    def shutdown(self,):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _export_loop(self,):
+        while True:
+            batch, stop = [], False
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+                while True:
+                    if item is None:
+                        stop = True
+                        break
+                    batch.append(item)
+                    if len(batch) >= self.max_batch_size:
+                        break
+                    item = self._queue.get_nowait()
+            except queue.Empty:
+                pass
+            try:
+                if batch:
+                    self._write(_otlp_request(batch))
+            except Exception:
+                self.failed += len(batch)
+            finally:
+                for _ in range(len(batch) + stop):
+                    self._queue.task_done()
+            if stop:
+                return
+
+    def _write(self, request):
+        raise NotImplementedError
+
+
+class FileExporter(SpanExporter):
+    ''' appends each batch to a file, as a line of OTLP json '''
+
+    def __init__(self, path):
+        self.path = path
+        SpanExporter.__init__(self,)
+
+    def _write(self, request):
+        with open(self.path, 'a') as fh:
+            fh.write(json.dumps(request) + '\n')
+
+
+class HTTPExporter(SpanExporter):
+    ''' posts each batch (as OTLP json) to a collector, e.g. http://localhost:4318/v1/traces '''
+
+    timeout = 10
+
+    def __init__(self, url):
+        self.url = url
+        SpanExporter.__init__(self,)
+
+    def _write(self, request):
+        import urllib.request   # (only needed, & only worth the import-time, if posting to a collector)
+        http_request = urllib.request.Request(self.url, data=json.dumps(request).encode(), method='POST',
+                                              headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(http_request, timeout=self.timeout) as response:
+            response.read()
+
+
+# Helper functions
+# --------------------------------------------------------------
+def _random_hex(n_bytes):
+    return os.urandom(n_bytes).hex()
+
+def _otlp_attributes(attributes):
+    ''' OTLP json encoding of a dict of attributes '''
+    encoded = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            encoded.append({'key': key, 'value': {'boolValue': value}})
+        elif isinstance(value, int):
+            encoded.append({'key': key, 'value': {'intValue': str(value)}})
+        elif isinstance(value, float):
+            encoded.append({'key': key, 'value': {'doubleValue': value}})
+        else:
+            encoded.append({'key': key, 'value': {'stringValue': str(value)}})
+    return encoded
+
+def _otlp_request(spans):
+    ''' an OTLP ExportTraceServiceRequest (json encoding) for a batch of spans, grouped by service '''
+    by_service = {}
+    for span in spans:
+        by_service.setdefault(span.service, []).append(span.to_otlp())
+    return {'resourceSpans': [{'resource'   : {'attributes': _otlp_attributes({'service.name': service})},
+                               'scopeSpans' : [{'scope': {'name': 'mpc_remote'}, 'spans': otlp_spans}]}
+                              for service, otlp_spans in by_service.items()]}
+
+
+# Configure from the environment (e.g. for the cgi-scripts)
+if os.environ.get('MPC_TRACE_EXPORT'):
+    configure(os.environ['MPC_TRACE_EXPORT'], float(os.environ.get('MPC_TRACE_SAMPLE_RATE', 1.0)))
+
+atexit.register(shutdown)
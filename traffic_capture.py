@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+
+'''
+    --------------------------------------------------------------
+    Capture & replay of the traffic received by a socket-server
+
+    To reproduce a production traffic-pattern against a new build:
+     - CaptureWriter : set as Server.capture, the server appends (a sample of)
+                       the frames it receives, each with its arrival-time,
+                       to a rotating capture-file
+                       (written by a background thread, never blocking the
+                       server : if the writer falls behind, frames are
+                       dropped & counted)
+     - read_capture  : iterate over the (timestamp, header, payload) of the
+                       frames in a capture-file (& its rotated backups)
+     - replay        : send the captured frames to a server, at the original
+                       rate, an accelerated rate, or as fast as possible,
+                       & measure the latency & throughput
+     - compare       : the differences between two replays (e.g. two builds)
+
+    Each record in a capture-file is
+    [>d arrival-time][>H header-length][>I payload-length][json-header][payload]
+    where header & payload are as returned by Shared._recv_frame
+    (i.e. after any claim-check has been resolved)
+
+    Expected usage:
+    ----------------
+    # On the production server
+    sockets_class.Server.capture = traffic_capture.CaptureWriter('/data/capture/orbfit.cap', sample_rate=0.1)
+
+    # Replay against a local build (x10 speed), saving the results
+    $ python3 traffic_capture.py /data/capture/orbfit.cap --port 40001 --speed 10 --save new.json --baseline old.json
+    --------------------------------------------------------------
+'''
+
+
+# Import third-party packages
+# --------------------------------------------------------------
+import os
+import argparse
+import json
+import queue
+import random
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Import neighboring packages
+# --------------------------------------------------------------
+import sockets_class
+
+
+# Each record starts with : arrival-time, header-length, payload-length
+_record_prefix = struct.Struct('>dHI')
+
+
+class CaptureWriter():
+    '''
+    Appends sampled frames to a rotating capture-file
+
+    path         : capture-file (rotated to path.1, path.2, ... as in logging.handlers.RotatingFileHandler)
+    sample_rate  : fraction of the frames to capture
+    max_bytes    : rotate once the file reaches this size
+    backup_count : number of rotated files to keep
+    '''
+
+    default_sample_rate     = 1.0
+    default_max_bytes       = 256 * 1024 * 1024
+    default_backup_count    = 4
+    max_queue_size          = 10000
+
+    def __init__(self, path, sample_rate=None, max_bytes=None, backup_count=None):
+        self.path           = path
+        self.sample_rate    = sample_rate if sample_rate is not None else self.default_sample_rate
+        self.max_bytes      = max_bytes if max_bytes is not None else self.default_max_bytes
+        self.backup_count   = backup_count if backup_count is not None else self.default_backup_count
+        self.dropped        = 0
+
+        self._queue         = queue.Queue(maxsize=self.max_queue_size)
+        self._file          = None
+        self._thread        = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def write(self, header, payload):
+        ''' capture (a sample of) frames : called from the server's hot path, so never blocks '''
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        try:
+            self._queue.put_nowait((time.time(), header, bytes(payload)))
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self,):
+        ''' wait until everything captured so far has been written '''
+        self._queue.join()
+
+    def close(self,):
+        ''' write out anything still queued & close the file '''
+        self._queue.put(None)
+        self._thread.join()
+
+    # ----- background writer ---------------------------------
+    def _write_loop(self,):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    if self._file is not None:
+                        self._file.close()
+                    return
+                self._write_record(*item)
+            except Exception as e:
+                sockets_class.log.warning('Traffic capture failed: %s', e)
+            finally:
+                self._queue.task_done()
+
+    def _write_record(self, timestamp, header, payload):
+        header_bytes = json.dumps(header).encode()
+        if self._file is None:
+            self._file = open(self.path, 'ab')
+        self._file.write(_record_prefix.pack(timestamp, len(header_bytes), len(payload)) + header_bytes)
+        self._file.write(payload)
+        self._file.flush()
+        if self._file.tell() >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self,):
+        self._file.close()
+        self._file = None
+        for i in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{i}'):
+                os.replace(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+        if self.backup_count > 0:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+
+
+def capture_files(path):
+    ''' the capture-file & its rotated backups, oldest first '''
+    backups = []
+    i = 1
+    while os.path.exists(f'{path}.{i}'):
+        backups.append(f'{path}.{i}')
+        i += 1
+    return backups[::-1] + ([path] if os.path.exists(path) else [])
+
+
+def read_capture(path):
+    ''' iterate over the (timestamp, header, payload) of every captured frame, oldest first '''
+    for filename in capture_files(path):
+        with open(filename, 'rb') as fh:
+            while True:
+                prefix = fh.read(_record_prefix.size)
+                if len(prefix) < _record_prefix.size:
+                    break
+                timestamp, header_len, payload_len = _record_prefix.unpack(prefix)
+                header  = json.loads(fh.read(header_len))
+                payload = fh.read(payload_len)
+                if len(payload) < payload_len:
+                    break   # truncated by a crash mid-write
+                yield timestamp, header, payload
+
+
+class ReplayClient(sockets_class.ClientPool):
+    ''' sends captured frames exactly as they were received, over pooled connections '''
+
+    def replay_frame(self, header, payload):
+        ''' send one frame & read the whole reply : returns the number of reply bytes '''
+        s, _ = self._acquire()
+        healthy = False
+        try:
+            if header == {'codec':'pickle'}:
+                s.sendall(struct.pack('>I', len(payload)) + payload)
+            else:
+                self._send_frame(s, header, payload)
+            reply = self._recv_frame(s)
+            if reply is None:
+                raise ConnectionError('Server closed the connection')
+            healthy = True
+            return len(reply[1])
+        finally:
+            self._release(s, healthy=healthy)
+
+
+def replay(path, host=None, port=None, speed=1.0, max_connections=None):
+    '''
+    send the captured frames to a server & measure how it copes
+
+    inputs
+    -------
+    path            : capture-file
+    host, port      : server to send to
+    speed           : 1 = the original rate, 10 = ten times faster, ..., None (or 0) = as fast as possible
+    max_connections : max number of requests in flight
+
+    returns
+    -------
+    dict of 'n_requests', 'n_failed', 'duration' (s), 'throughput' (requests/s), 'reply_bytes',
+    & the 'latency_mean', 'latency_p50', 'latency_p90', 'latency_p99', 'latency_max' (s)
+    '''
+    client      = ReplayClient(host=host, port=port, max_connections=max_connections)
+    latencies   = []
+    counts      = {'n_failed': 0, 'reply_bytes': 0}
+    lock        = threading.Lock()
+
+    def send(header, payload):
+        start = time.perf_counter()
+        try:
+            n_bytes = client.replay_frame(header, payload)
+        except Exception:
+            with lock:
+                counts['n_failed'] += 1
+            return
+        with lock:
+            latencies.append(time.perf_counter() - start)
+            counts['reply_bytes'] += n_bytes
+
+    start, first = time.perf_counter(), None
+    with ThreadPoolExecutor(max_workers=client.max_connections) as executor:
+        for timestamp, header, payload in read_capture(path):
+            if speed:
+                first = first if first is not None else timestamp
+                delay = (timestamp - first) / speed - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            executor.submit(send, header, payload)
+    duration = time.perf_counter() - start
+    client.close()
+
+    n_requests  = len(latencies) + counts['n_failed']
+    results     = dict(counts, n_requests=n_requests, duration=duration,
+                       throughput=len(latencies) / duration if duration else 0.0)
+    latencies.sort()
+    if latencies:
+        results['latency_mean'] = sum(latencies) / len(latencies)
+        for name, q in [('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0)]:
+            results[f'latency_{name}'] = latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+    return results
+
+
+def compare(baseline, candidate):
+    ''' the relative change (candidate / baseline - 1) in each numeric result of two replays '''
+    return {k: candidate[k] / baseline[k] - 1
+            for k in candidate
+            if k in baseline and isinstance(baseline[k], (int, float)) and baseline[k]}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay captured traffic against a socket-server')
+    parser.add_argument('capture', help='capture-file written by a CaptureWriter')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=sockets_class.Shared.default_server_port)
+    parser.add_argument('--speed', type=float, default=1.0, help='rate multiplier (0 = as fast as possible)')
+    parser.add_argument('--connections', type=int, default=None, help='max requests in flight')
+    parser.add_argument('--save', help='save the results (as json) to this file')
+    parser.add_argument('--baseline', help='results (saved with --save) from a previous build to compare with')
+    args = parser.parse_args()
+
+    results = replay(args.capture, host=args.host, port=args.port, speed=args.speed, max_connections=args.connections)
+    for k, v in results.items():
+        print(f'{k:15s}: {v}')
+
+    if args.save:
+        with open(args.save, 'w') as fh:
+            json.dump(results, fh, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)
+        print('\nChange relative to the baseline:')
+        for k, v in compare(baseline, results).items():
+            print(f'{k:15s}: {v:+.1%}')